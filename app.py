@@ -2,8 +2,20 @@ from __future__ import annotations
 # app.py
 
 from bson.objectid import ObjectId
+import asyncio
+import base64
+import bisect
+import calendar
+import contextvars
+import http.cookies
+import json
 import os
 import re
+import signal
+import socket
+import tempfile
+import threading
+import urllib.parse
 import uuid
 
 def get_user_fields():
@@ -16,7 +28,8 @@ def get_user_fields():
 from datetime import datetime, timedelta
 from functools import wraps
 
-from bson import ObjectId
+from bson import ObjectId, json_util
+from collections import OrderedDict
 
 def admin_required(f):
     @wraps(f)
@@ -34,12 +47,34 @@ def admin_required(f):
     return decorated_function
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, flash, jsonify, abort
+    session, flash, jsonify, abort, g, send_from_directory, has_request_context
 )
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, OperationFailure
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from PIL import Image, ImageOps
+import click
+import gzip
 import hashlib
+import hmac
+import io
+import logging
+import mimetypes
+import time
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip siblings are generated without it
+    brotli = None
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    from pymongo import AsyncMongoClient
+except ImportError:  # optional: only needed for the async serving mode (asgi_app)
+    AsyncMongoClient = WsgiToAsgi = None
+
+# Same logger as app.logger, for the helpers outside create_app()
+logger = logging.getLogger(__name__)
 
 
 # App & Database Configuration
@@ -50,26 +85,159 @@ def create_app():
     app.config["UPLOAD_FOLDER"] = os.path.join(app.static_folder, "images", "medicines")
     app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  
     app.config["ALLOWED_EXTENSIONS"] = {"png", "jpg", "jpeg", "gif"}
+    # Max couriers a single request_delivery click fans out to
+    app.config["DELIVERY_FANOUT_MAX"] = int(os.getenv("DELIVERY_FANOUT_MAX", "20"))
     
     # Create upload directory if it doesn't exist
     os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+
+    # Fingerprinted, precompressed static assets (see StaticManifest)
+    app.static_manifest = StaticManifest(app.static_folder, exclude=[app.config["UPLOAD_FOLDER"]])
+    app.static_manifest.build()
+
+    @app.url_defaults
+    def fingerprint_static_urls(endpoint, values):
+        if endpoint == "static" and "v" not in values:
+            fingerprint = app.static_manifest.fingerprint(values.get("filename"))
+            if fingerprint:
+                values["v"] = fingerprint
+
+    def static_asset(filename):
+        encoding = app.static_manifest.pick_encoding(filename, request.accept_encodings)
+        if encoding:
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            response = send_from_directory(app.static_folder, filename + STATIC_ENCODINGS[encoding],
+                                           mimetype=mimetype)
+            response.headers["Content-Encoding"] = encoding
+        else:
+            response = send_from_directory(app.static_folder, filename)
+        if app.static_manifest.is_encodable(filename):
+            response.vary.add("Accept-Encoding")
+        if app.static_manifest.is_immutable(filename, request.args.get("v")):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = 365 * 24 * 3600
+            response.cache_control.immutable = True
+        return response
+
+    app.view_functions["static"] = static_asset
     
+    # Request and Mongo command metrics; workers on one host share them
+    # through METRICS_DIR so any worker can answer a scrape (see Metrics)
+    app.metrics = Metrics(
+        shared_dir=os.getenv("METRICS_DIR") or os.path.join(tempfile.gettempdir(), "medpanda-metrics"),
+        flush_seconds=float(os.getenv("METRICS_FLUSH_SECONDS", "1")),
+    )
+    app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN", "")
+    app.config["SERVER_TIMING"] = os.getenv("SERVER_TIMING", "0") == "1"
+
     mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/medpanda")
-    client = MongoClient(mongo_uri)
+    app.config["MONGO_URI"] = mongo_uri
+    # connect=False: nothing talks to Mongo until the first query, so
+    # importing the app (tooling, gunicorn boot) does not need the database
+    client = MongoClient(mongo_uri, connect=False,
+                         event_listeners=[MongoCommandMetrics(app.metrics)])
     
     # Explicitly use the medpanda database
     app.db = client.medpanda
 
-    # Ensure indexes and create default admin user
-    ensure_indexes(app.db)
-    create_default_admin(app.db)
+    # Indexes, seed data and migrations are applied by `flask medpanda migrate`;
+    # workers only compare the recorded schema version on their first request
+    app.schema_checked = False
+
+    @app.before_request
+    def check_schema_version():
+        if app.schema_checked or request.endpoint == "static":
+            return
+        # If the lookup fails the next request checks again
+        current = schema_version(app.db)
+        if current < SCHEMA_VERSION:
+            app.logger.warning(
+                "Database schema is at version %s but the code expects %s; "
+                "run `flask --app app medpanda migrate`.", current, SCHEMA_VERSION
+            )
+        app.schema_checked = True
+
+    # Shared version stamps behind the catalog ETags (see CatalogVersion, ListingVersion)
+    app.catalog_version = CatalogVersion(ttl_seconds=float(os.getenv("CATALOG_VERSION_TTL_SECONDS", "2")))
+    app.listing_version = ListingVersion(ttl_seconds=float(os.getenv("CATALOG_VERSION_TTL_SECONDS", "2")))
+
+    # In-memory catalog search index (see MedicineSearchIndex)
+    app.search_index = MedicineSearchIndex(
+        refresh_seconds=int(os.getenv("SEARCH_INDEX_REFRESH_SECONDS", "60"))
+    )
+    # built lazily by ensure_fresh() on the first catalog request
+
+    # Search filter dropdowns and counts (see FacetCache)
+    app.facet_cache = FacetCache(ttl_seconds=int(os.getenv("FACET_CACHE_TTL_SECONDS", "60")))
+
+    # Shopping carts live server-side; the cookie holds only the cart id
+    app.cart_store = CartStore(app.db.carts)
+
+    # Rendered home page for anonymous visitors (see RenderCache)
+    app.home_cache = RenderCache(ttl_seconds=int(os.getenv("HOME_CACHE_TTL_SECONDS", "30")))
+
+    # Slow side effects run in `flask medpanda worker` (see JobQueue);
+    # JOBS_INLINE=1 runs them inside the request instead
+    app.jobs = JobQueue(
+        app.db.jobs,
+        lease_seconds=int(os.getenv("JOB_LEASE_SECONDS", "300")),
+        max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "5")),
+        inline=os.getenv("JOBS_INLINE", "0") == "1",
+    )
+
+    # Owner -> pharmacy / delivery profile ids (see IdentityCache)
+    app.identity_cache = IdentityCache(
+        maxsize=int(os.getenv("IDENTITY_CACHE_SIZE", "4096")),
+        ttl_seconds=int(os.getenv("IDENTITY_CACHE_TTL_SECONDS", "300")),
+    )
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.get("request_started")
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or "-"
+        app.metrics.observe("medpanda_request_duration_seconds",
+                            {"endpoint": endpoint, "method": request.method, "status": str(response.status_code)},
+                            elapsed, Metrics.LATENCY_BUCKETS)
+        mongo = g.get("mongo_stats") or {"commands": 0, "seconds": 0.0}
+        app.metrics.observe("medpanda_request_mongo_round_trips", {"endpoint": endpoint},
+                            mongo["commands"], Metrics.ROUND_TRIP_BUCKETS)
+        if app.config["SERVER_TIMING"]:
+            response.headers.add(
+                "Server-Timing",
+                f'mongo;dur={mongo["seconds"] * 1000:.1f};desc="{mongo["commands"]} commands", '
+                f"app;dur={elapsed * 1000:.1f}",
+            )
+        app.metrics.flush()
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        # Bearer METRICS_TOKEN when one is set; otherwise local scrapers only
+        token = app.config["METRICS_TOKEN"]
+        if token:
+            if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+                abort(403)
+        elif request.remote_addr not in ("127.0.0.1", "::1"):
+            abort(403)
+        return app.metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
     # Small helper: attach current_user to g-like property
     @app.before_request
     def inject_user():
-        
+        if request.endpoint == "static":
+            return  # keep the session (and Vary: Cookie) off asset responses
         app.current_user = session.get("user")  # dict or None
     
+    app.add_template_filter(image_srcset, "srcset")
+
     @app.context_processor
     def inject_user_into_templates():
         return {'user': session.get('user')}
@@ -99,15 +267,132 @@ def create_app():
             return wrapper
         return deco
 
+    # -----------------------------
+    # Catalog version & conditional GET
+    # -----------------------------
+    def _catalog_changed(med=None):
+        # Medicine writes go through here: bump the shared version
+        # (invalidating ETags and search indexes everywhere) and refresh
+        # this worker's caches
+        version = app.catalog_version.bump(app.db)
+        if med is not None:
+            app.search_index.upsert(med, version)
+        app.facet_cache.invalidate()
+        app.home_cache.invalidate()
+
+    def _listing_changed():
+        # Pharmacy writes change the pharmacy filter, not the medicines
+        app.listing_version.bump(app.db)
+        app.facet_cache.invalidate()
+        app.home_cache.invalidate()
+
+    def _stock_changed(medicine_ids):
+        # Stock moves with every order: new ETags, but no index rebuild.
+        # This worker patches the touched medicines in place, the others
+        # re-read them from the listing version's change log.
+        medicine_ids = list(medicine_ids)
+        listing_version = app.listing_version.bump(app.db, medicine_ids)
+        for med in app.db.medicines.find({"_id": {"$in": medicine_ids}}):
+            app.search_index.upsert(med, listing_version=listing_version)
+        app.home_cache.invalidate()
+
+    def _ensure_index_fresh():
+        app.search_index.ensure_fresh(app.db, app.catalog_version.current(app.db),
+                                      app.listing_version.current(app.db))
+
+    def _catalog_etag():
+        return catalog_etag_value(app.catalog_version.current(app.db), app.listing_version.current(app.db),
+                                  request.full_path, session)
+
+    def catalog_etag(f):
+        # ETag = catalog version + everything else the response depends on,
+        # so a matching If-None-Match is answered before the view runs
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if session.get("_flashes"):
+                return f(*args, **kwargs)
+            etag = _catalog_etag()
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+            else:
+                response = app.make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+
+    # -----------------------------
+    # Current user's profile ids
+    # -----------------------------
+    def _current_profile_id(kind, collection, owner_field):
+        # Memoized for the request in g, then in the process-wide cache
+        memo = g.setdefault("profile_ids", {})
+        if kind not in memo:
+            uid = ObjectId(session["user"]["_id"])
+            memo[kind] = app.identity_cache.get(
+                (kind, uid),
+                lambda: (collection.find_one({owner_field: uid}, {"_id": 1}) or {}).get("_id"),
+            )
+        return memo[kind]
+
+    def _current_pharmacy_id():
+        return _current_profile_id("pharmacy", app.db.pharmacies, "owner_id")
+
+    def _current_delivery_profile_id():
+        return _current_profile_id("delivery", app.db.delivery_profiles, "user_id")
+
+    def _owned_pharmacy_ids():
+        # Every pharmacy the user owns, for order_access_filter
+        uid = ObjectId(session["user"]["_id"])
+        return app.identity_cache.get(
+            ("pharmacies", uid),
+            lambda: tuple(p["_id"] for p in app.db.pharmacies.find({"owner_id": uid}, {"_id": 1})) or None,
+        )
+
+    # -----------------------------
+    # Pagination helpers
+    # -----------------------------
+    def _page_args():
+        return {
+            "after": decode_cursor(request.args.get("after")),
+            "before": decode_cursor(request.args.get("before")),
+            "limit": page_size(request.args),
+        }
+
+    def _page_links(page):
+        # Keep the current filters, only swap the cursor
+        args = request.args.to_dict()
+        args.pop("after", None)
+        args.pop("before", None)
+        args.update(request.view_args or {})
+        page["next_url"] = url_for(request.endpoint, **args, after=page["next"]) if page["next"] else None
+        page["prev_url"] = url_for(request.endpoint, **args, before=page["prev"]) if page["prev"] else None
+        return page
+
+    def _page_json(page):
+        return jsonify({
+            "items": to_json_safe(page["items"]),
+            "next": page["next"],
+            "prev": page["prev"],
+            "limit": page["limit"],
+        })
+
     # -------------
     # Basic Pages
     # -------------
     @app.route("/")
     def index():
         # Show featured medicines & quick search bar
-        meds = list(app.db.medicines.find({"is_active": True}).sort("created_at", DESCENDING).limit(8))
-        pharmacies = list(app.db.pharmacies.find({"is_active": True}, {"name": 1}))
-        return render_template("index.html", meds=meds, pharmacies=pharmacies, user=session.get("user"))
+        def render():
+            meds = list(app.db.medicines.find({"is_active": True}).sort("created_at", DESCENDING).limit(8))
+            return render_template("index.html", meds=meds, user=session.get("user"))
+
+        # Anonymous renders are identical unless the session has a cart badge,
+        # pending flashes or a prefilled search box
+        anonymous = not (session.get("user") or session.get("cart_count")
+                         or session.get("_flashes") or request.args)
+        return app.home_cache.get("index", render) if anonymous else render()
 
     # -------------
     # Auth
@@ -156,6 +441,9 @@ def create_app():
                     "rating_count": 0,
                     "created_at": datetime.utcnow(),
                 })
+                _listing_changed()
+                app.identity_cache.invalidate(("pharmacy", res.inserted_id))
+                app.identity_cache.invalidate(("pharmacies", res.inserted_id))
 
             # If delivery role, create delivery profile
             if user_doc["role"] == "delivery":
@@ -170,6 +458,7 @@ def create_app():
                     "rating_count": 0,
                     "created_at": datetime.utcnow(),
                 })
+                app.identity_cache.invalidate(("delivery", res.inserted_id))
 
             flash("Registration successful. Please log in.", "success")
             return redirect(url_for("login"))
@@ -237,31 +526,21 @@ def create_app():
             # For regular user
             user_id = ObjectId(user["_id"])
         
-        # Get orders and ensure items are properly handled
-        orders_cursor = app.db.orders.find({"user_id": user_id}).sort("created_at", DESCENDING).limit(10)
-        orders = []
-        
-        for order in orders_cursor:
-            # Convert BSON document to dict
-            order = dict(order)
-            
-            # Handle items field consistently
-            items = []
-            if isinstance(order.get('items'), list):
-                items = order['items']
-            elif isinstance(order.get('order_items'), list):
-                # Migrate old format to new
-                items = order['order_items']
-                order['items'] = items  # Add the new field
-            
-            order['items'] = items  # Ensure the items field exists
-            orders.append(order)
+        # Recent orders with just the fields the dashboard cards show
+        orders = list(app.db.orders.find(
+            {"user_id": user_id}, order_projection("status", "total", "created_at")
+        ).sort("created_at", DESCENDING).limit(10))
+        for order in orders:
+            order["items"] = order_lines(order)
         
         # Get schedules
         schedules_cursor = app.db.schedules.find({"user_id": user_id}).sort("created_at", DESCENDING).limit(5)
         schedules = list(schedules_cursor)
-        
-        return render_template("user_dashboard.html", orders=orders, schedules=schedules)
+
+        # Reminders the scheduler has fired and the user has not acted on
+        reminders = list(app.db.reminders.find({"user_id": user_id, "read_at": None}).sort("due_at", DESCENDING).limit(5))
+
+        return render_template("user_dashboard.html", orders=orders, schedules=schedules, reminders=reminders)
     
 
     # ----------------------
@@ -270,27 +549,22 @@ def create_app():
     @app.route("/delivery/view")
     @roles_required("admin")
     def delivery_view():
-        # Get all delivery personnel from the database
-        delivery_personnel = list(app.db.users.find({"role": "delivery"}))
-        
-        # Calculate ratings for each delivery person
+        page = _delivery_personnel_page()
+        return render_template("delivery_view.html", delivery_personnel=page["items"], page=_page_links(page))
+
+    def _delivery_personnel_page():
+        # One page of delivery personnel, ordered by name
+        page = keyset_page(app.db.users, {"role": "delivery"}, "name", descending=False,
+                           projection={"password": 0}, **_page_args())
+        delivery_personnel = page["items"]
+
+        # Ratings come from the stored aggregates on each user
         for delivery in delivery_personnel:
-            # Get all reviews for this delivery person
-            reviews = list(app.db.reviews.find({
-                "delivery_person_id": str(delivery["_id"]),
-                "type": "delivery"
-            }))
-            
-            # Calculate average rating and review count
-            if reviews:
-                total_rating = sum(review["rating"] for review in reviews)
-                delivery["avg_rating"] = total_rating / len(reviews)
-                delivery["review_count"] = len(reviews)
-            else:
-                delivery["avg_rating"] = 0
-                delivery["review_count"] = 0
-                
-        return render_template("delivery_view.html", delivery_personnel=delivery_personnel)
+            rating = rating_summary(delivery)
+            delivery["avg_rating"] = rating["avg"]
+            delivery["review_count"] = rating["count"]
+
+        return page
 
     @app.route("/delivery/view/<delivery_id>")
     @roles_required("admin")
@@ -318,16 +592,9 @@ def create_app():
     def complain():
         user = session.get("user")
         if user["role"] == "admin":
-            # For admin, show all complaints
-            complaints = list(app.db.complaints.find().sort("created_at", DESCENDING))
-            # Fetch related user info for each complaint
-            for complaint in complaints:
-                complainant = app.db.users.find_one({"_id": complaint["complainant_id"]})
-                complaint["complainant_name"] = complainant["name"] if complainant else "Unknown User"
-                # No longer using against_id, just show role as label
-                complaint["against_name"] = complaint["against_role"].capitalize()
-                complaint["created_at_formatted"] = complaint["created_at"].strftime("%Y-%m-%d %H:%M:%S")
-            return render_template("admin_complaints.html", complaints=complaints)
+            # For admin, show complaints one page at a time
+            page = _complaints_page()
+            return render_template("admin_complaints.html", complaints=page["items"], page=_page_links(page))
         else:
             # For regular users, show the complaint form
             return render_template("complain.html")
@@ -363,87 +630,48 @@ def create_app():
     @app.route("/get_users_by_role/<role>")
     @login_required
     def get_users_by_role(role):
-        print(f"Fetching users for role: {role}")  # Debug log
-        
-        # First, let's check what fields we have in our documents
-        sample_user, sample_pharmacy = get_user_fields()
-        
-        users = []
-        if role == "pharmacy":
-            # Get all pharmacies
-            pharmacies = list(app.db.pharmacies.find())
-            print(f"Found {len(pharmacies)} pharmacies")
-            for p in pharmacies:
-                # Check what name field is actually available
-                name = p.get('business_name') or p.get('name') or p.get('pharmacy_name', 'Unknown Pharmacy')
-                users.append({
-                    "_id": str(p["_id"]),
-                    "name": name,
-                    "role": "pharmacy"
-                })
-        elif role == "delivery":
-            # Get delivery personnel
-            delivery_users = list(app.db.users.find({"role": "delivery"}))
-            print(f"Found {len(delivery_users)} delivery personnel")
-            for u in delivery_users:
-                name = u.get('username') or u.get('name', 'Unknown')
-                email = u.get('email', 'No email')
-                users.append({
-                    "_id": str(u["_id"]),
-                    "name": f"{name} ({email})",
-                    "role": "delivery"
-                })
-        elif role == "customer":
-            # Get customers
-            customers = list(app.db.users.find({"role": "customer"}))
-            print(f"Found {len(customers)} customers")
-            for u in customers:
-                name = u.get('username') or u.get('name', 'Unknown')
-                email = u.get('email', 'No email')
-                users.append({
-                    "_id": str(u["_id"]),
-                    "name": f"{name} ({email})",
-                    "role": "customer"
-                })
-        elif role == "other":
-            # Get all other users (excluding admin)
-            other_users = list(app.db.users.find(
-                {"role": {"$nin": ["admin"]}}, 
-                {"_id": 1, "name": 1, "email": 1, "role": 1}
-            ))
-            users = [{
-                "_id": str(u["_id"]),
-                "name": f"{u['name']} ({u['role']} - {u['email']})",
-                "role": u["role"]
-            } for u in other_users]
-        
-        print(f"Returning {len(users)} users")  # Debug log
-        print("Sample user data:", users[0] if users else "No users found")  # Debug log
-        return jsonify(users)
+        query = users_by_role_query(role)
+        if not query:
+            return jsonify([])
+        collection, filt, projection = query
+        return jsonify([users_by_role_row(role, doc) for doc in app.db[collection].find(filt, projection)])
 
     @app.route("/admin/complaints")
     @admin_required
     def admin_complaints():
-        print("Session data:", session.get('user'))  # Debug log
-        # Get all complaints from the database
-        complaints = list(app.db.complaints.find().sort("created_at", DESCENDING))
-        
+        page = _complaints_page()
+        return render_template("admin_complaints.html", complaints=page["items"], page=_page_links(page))
+
+    def _complaints_page():
+        # One page of complaints, newest first
+        page = keyset_page(app.db.complaints, {}, "created_at", **_page_args())
+
+        # Complainants and against-users for the whole page in one query
+        people = load_users_by_ids(
+            app.db,
+            [c.get("complainant_id") for c in page["items"]] + [c.get("against_id") for c in page["items"]],
+            fields=("name", "role"),
+        )
+
         # Process complaints to include user details
-        for complaint in complaints:
+        for complaint in page["items"]:
             complaint["_id"] = str(complaint["_id"])
+            complaint["complainant_name"] = "Unknown User"
+            # No longer using against_id, just show role as label
+            complaint["against_name"] = (complaint.get("against_role") or "").capitalize()
+            if complaint.get("created_at"):
+                complaint["created_at_formatted"] = complaint["created_at"].strftime("%Y-%m-%d %H:%M:%S")
             # Get complainant details
-            if "complainant_id" in complaint:
-                complainant = app.db.users.find_one({"_id": ObjectId(complaint["complainant_id"])})
-                if complainant:
-                    complaint["complainant_name"] = complainant["name"]
-                    complaint["complainant_role"] = complainant["role"]
+            complainant = people.get(_as_object_id(complaint.get("complainant_id")))
+            if complainant:
+                complaint["complainant_name"] = complainant["name"]
+                complaint["complainant_role"] = complainant["role"]
             # Get against details if it's a user
-            if "against_id" in complaint:
-                against = app.db.users.find_one({"_id": ObjectId(complaint["against_id"])})
-                if against:
-                    complaint["against_name"] = against["name"]
-        
-        return render_template("admin_complaints.html", complaints=complaints)
+            against = people.get(_as_object_id(complaint.get("against_id")))
+            if against:
+                complaint["against_name"] = against["name"]
+
+        return page
 
     @app.route("/admin/complaints/<complaint_id>", methods=["GET", "POST"])
     @admin_required
@@ -503,13 +731,11 @@ def create_app():
                 "against_name": against_user["name"] if against_user else complaint.get("against_name", "Not specified"),
                 "admin_notes": complaint.get("admin_notes", "")
             }
-            
-            print(f"Rendering complaint details for complaint ID: {complaint_id}")  # Debug log
-            print(f"Complaint data: {complaint_data}")  # Debug log
+
             return render_template("complaint_details.html", complaint=complaint_data)
             
-        except Exception as e:
-            print(f"Error in complaint_details: {str(e)}")  # Debug log
+        except Exception:
+            app.logger.exception("Could not load complaint %s", complaint_id)
             flash("Error loading complaint details", "error")
             return redirect(url_for("admin_complaints"))
 
@@ -569,22 +795,25 @@ def create_app():
                 "status": {"$in": ["Out for Delivery", "Delivered"]}
             }).sort("created_at", DESCENDING))
 
-            # Enhance orders with customer and delivery person details
+            # Enhance orders with customer and delivery person details (one batched lookup)
+            people = load_users_by_ids(
+                app.db,
+                [o.get("user_id") for o in all_orders] + [o.get("delivery_id") for o in all_orders],
+                fields=("name", "phone", "email"),
+            )
             for order in all_orders:
                 # Add customer details
-                if 'user_id' in order:
-                    customer = app.db.users.find_one({"_id": order["user_id"]})
-                    if customer:
-                        order["customer_name"] = customer.get("name")
-                        order["customer_phone"] = customer.get("phone")
-                        order["customer_email"] = customer.get("email")
+                customer = people.get(order.get("user_id"))
+                if customer:
+                    order["customer_name"] = customer.get("name")
+                    order["customer_phone"] = customer.get("phone")
+                    order["customer_email"] = customer.get("email")
 
                 # Add delivery person details
-                if 'delivery_id' in order:
-                    delivery_person = app.db.users.find_one({"_id": order["delivery_id"]})
-                    if delivery_person:
-                        order["delivery_name"] = delivery_person.get("name")
-                        order["delivery_phone"] = delivery_person.get("phone")
+                delivery_person = people.get(order.get("delivery_id"))
+                if delivery_person:
+                    order["delivery_name"] = delivery_person.get("name")
+                    order["delivery_phone"] = delivery_person.get("phone")
 
             # Split orders based on status
             assigned_orders = [order for order in all_orders if order["status"] == "Out for Delivery"]
@@ -604,21 +833,6 @@ def create_app():
             user_id = ObjectId(user["_id"])
             delivery_profile = app.db.users.find_one({"_id": user_id})
 
-            # Get reviews for this delivery person (only count and average)
-            reviews = list(app.db.reviews.find({
-                "delivery_person_id": str(user_id),
-                "type": "delivery"
-            }))
-            
-            # Calculate average rating and review count
-            if reviews:
-                total_rating = sum(review["rating"] for review in reviews)
-                delivery_profile["rating_avg"] = round(total_rating / len(reviews), 1)
-                delivery_profile["rating_count"] = len(reviews)
-            else:
-                delivery_profile["rating_avg"] = 0
-                delivery_profile["rating_count"] = 0
-
             # Get all orders assigned to this delivery person
             pending_requests = list(app.db.delivery_requests.find({
                 "delivery_user_id": user_id,
@@ -706,27 +920,22 @@ def create_app():
         # Convert ObjectIds and handle items for template
         for order in assigned_orders + completed_orders:
             order["_id"] = str(order["_id"])
-            # Ensure items are handled consistently
-            items = []
-            if isinstance(order.get('items'), list):
-                items = order['items']
-            elif isinstance(order.get('order_items'), list):
-                items = order['order_items']
-            order['items'] = items
-            order['items_count'] = len(items)
+            order['items'] = order_lines(order)
+            order['items_count'] = len(order['items'])
         
         for delivery_request in pending_requests:
             delivery_request["_id"] = str(delivery_request["_id"])
             if "order_id" in delivery_request and isinstance(delivery_request["order_id"], ObjectId):
                 delivery_request["order_id"] = str(delivery_request["order_id"])
-            # Get order details for each delivery request
-            order = app.db.orders.find_one({"_id": ObjectId(delivery_request["order_id"])} if delivery_request.get("order_id") else None)
+            # Requests carry an order summary; only older ones need the order itself
+            if delivery_request.get("order_details"):
+                continue
+            order = app.db.orders.find_one(
+                {"_id": ObjectId(delivery_request["order_id"])} if delivery_request.get("order_id") else None,
+                order_projection("total", "address"),
+            )
             if order:
-                # Get items list from either items or order_items field
-                items = order.get("items", []) if isinstance(order.get("items"), list) else order.get("order_items", [])
-                if not isinstance(items, list):
-                    items = []
-                    
+                items = order_lines(order)
                 delivery_request["order_details"] = {
                     "total": order.get("total", 0),
                     "address": order.get("address", ""),
@@ -737,9 +946,13 @@ def create_app():
         # Get user data for the template
         user_data = app.db.users.find_one({"_id": user_id})
         
-        # Merge user data into delivery profile for the form
+        # Merge user data (name and stored rating aggregates) into delivery profile for the form
         if delivery_profile and user_data:
             delivery_profile["name"] = user_data.get("name", "")
+            rating = rating_summary(user_data)
+            delivery_profile["rating_avg"] = rating["avg"]
+            delivery_profile["rating_count"] = rating["count"]
+            delivery_profile["rating_hist"] = rating["hist"]
             
         return render_template("delivery_dashboard.html", 
                             delivery_profile=delivery_profile,
@@ -787,13 +1000,12 @@ def create_app():
             return jsonify({"ok": False, "msg": "Invalid order id"}), 400
 
         # Verify pharmacy owns this order
-        user_id = ObjectId(session["user"]["_id"])
-        pharmacy = app.db.pharmacies.find_one({"owner_id": user_id})
-        
-        if not pharmacy:
+        pharmacy_id = _current_pharmacy_id()
+
+        if not pharmacy_id:
             return jsonify({"ok": False, "msg": "Pharmacy not found"}), 404
 
-        order = app.db.orders.find_one({"_id": oid, "pharmacy_ids": pharmacy["_id"]})
+        order = app.db.orders.find_one({"_id": oid, "pharmacy_ids": pharmacy_id})
         if not order:
             return jsonify({"ok": False, "msg": "Order not found or not authorized"}), 404
 
@@ -814,51 +1026,27 @@ def create_app():
             return jsonify({"ok": False, "msg": "Invalid order id"}), 400
 
         # Verify pharmacy owns this order
-        user_id = ObjectId(session["user"]["_id"])
-        pharmacy = app.db.pharmacies.find_one({"owner_id": user_id})
-        
-        if not pharmacy:
+        pharmacy_id = _current_pharmacy_id()
+
+        if not pharmacy_id:
             return jsonify({"ok": False, "msg": "Pharmacy not found"}), 404
 
-        order = app.db.orders.find_one({"_id": oid, "pharmacy_ids": pharmacy["_id"]})
+        order = app.db.orders.find_one({"_id": oid, "pharmacy_ids": pharmacy_id})
         if not order:
             return jsonify({"ok": False, "msg": "Order not found or not authorized"}), 404
 
-        # Create delivery requests for all registered delivery persons
-        all_delivery_persons = list(app.db.delivery_profiles.find())
-        
-        delivery_requests = []
-        for delivery in all_delivery_persons:
-            # Get user details to include name in the request
-            delivery_user = app.db.users.find_one({"_id": delivery["user_id"]})
-            request_doc = {
-                "order_id": oid,
-                "delivery_user_id": delivery["user_id"],
-                "delivery_user_name": delivery_user.get("name", "Unknown") if delivery_user else "Unknown",
-                "pharmacy_id": pharmacy["_id"],
-                "status": "pending",  # pending, accepted, rejected
-                "requested_at": datetime.utcnow(),
-                "responded_at": None,
-                "order_details": {
-                    "total": order.get("total", 0),
-                    "items": order.get("items", []),  # Use items consistently
-                    "items_count": len(order.get("items", [])),  # Add count based on items
-                    "address": order.get("delivery_address", "Address not available")
-                }
-            }
-            delivery_requests.append(request_doc)
-        
-        # Insert all requests
-        if delivery_requests:
-            app.db.delivery_requests.insert_many(delivery_requests)
-        
         # Update order status
         app.db.orders.update_one(
             {"_id": oid},
             {"$set": {"status": "Ready for Delivery", "updated_at": datetime.utcnow()}}
         )
 
-        flash(f"Delivery request sent to {len(delivery_requests)} delivery persons!", "success")
+        # The worker sends requests to a bounded set of available delivery persons
+        app.jobs.enqueue("dispatch_delivery", {
+            "order_id": oid, "pharmacy_id": pharmacy_id, "fanout": app.config["DELIVERY_FANOUT_MAX"],
+        })
+
+        flash("Delivery request is being sent to available delivery persons.", "success")
         return redirect(url_for("pharmacy_dashboard"))
 
     # Delivery: Accept delivery request
@@ -882,37 +1070,39 @@ def create_app():
         if not delivery_request:
             return jsonify({"ok": False, "msg": "Request not found or already processed"}), 404
 
-        # Update request status
-        app.db.delivery_requests.update_one(
-            {"_id": rid},
-            {"$set": {"status": "accepted", "responded_at": datetime.utcnow()}}
-        )
-
-        # Update order with assigned delivery person
-        app.db.orders.update_one(
-            {"_id": delivery_request["order_id"]},
+        # Assign the order to this delivery person unless another one was
+        # faster (the other pending requests are only rejected by the worker)
+        result = app.db.orders.update_one(
+            {"_id": delivery_request["order_id"], "assigned_delivery_id": None},
             {"$set": {
                 "assigned_delivery_id": user_id,
                 "status": "Out for Delivery",
                 "updated_at": datetime.utcnow()
             }}
         )
+        if not result.modified_count:
+            app.db.delivery_requests.update_one(
+                {"_id": rid},
+                {"$set": {"status": "rejected", "responded_at": datetime.utcnow()}}
+            )
+            flash("This delivery has already been accepted by someone else.", "warning")
+            return redirect(url_for("delivery_dashboard"))
 
-        # Mark delivery person as unavailable
+        # Update request status
+        app.db.delivery_requests.update_one(
+            {"_id": rid},
+            {"$set": {"status": "accepted", "responded_at": datetime.utcnow()}}
+        )
+
+        # Mark delivery person as unavailable (by user_id if the profile id is not known)
+        profile_id = _current_delivery_profile_id()
         app.db.delivery_profiles.update_one(
-            {"user_id": user_id},
+            {"_id": profile_id} if profile_id else {"user_id": user_id},
             {"$set": {"is_available": False}}
         )
 
         # Reject all other pending requests for this order
-        app.db.delivery_requests.update_many(
-            {
-                "order_id": delivery_request["order_id"],
-                "status": "pending",
-                "_id": {"$ne": rid}
-            },
-            {"$set": {"status": "rejected", "responded_at": datetime.utcnow()}}
-        )
+        app.jobs.enqueue("reject_other_requests", {"order_id": delivery_request["order_id"], "accepted_id": rid})
 
         flash("Delivery accepted successfully! Order is now out for delivery.", "success")
         return redirect(url_for("delivery_dashboard"))
@@ -1021,7 +1211,21 @@ def create_app():
     # Search/Catalog
     # ----------------------
     @app.route("/search")
+    @catalog_etag
     def search():
+        page, selected = _search_page()
+
+        # Categories and pharmacies for filters - cached, only from active medicines
+        facets = app.facet_cache.get(app.db, (app.catalog_version.current(app.db),
+                                              app.listing_version.current(app.db)))
+        return render_template("search.html",
+                               meds=page["items"], page=_page_links(page),
+                               categories=facets["categories"], pharmacies=facets["pharmacies"],
+                               category_counts=facets["category_counts"],
+                               pharmacy_counts=facets["pharmacy_counts"],
+                               selected=selected)
+
+    def _search_page():
         q = request.args.get("q", "").strip()
         category = request.args.get("category", "").strip()
         pharmacy_id = request.args.get("pharmacy", "").strip()
@@ -1029,14 +1233,7 @@ def create_app():
         price_max = request.args.get("max", "").strip()
 
         # Build filter
-        filt = {"is_active": True}
-
-        # Text search - search in name and category
-        if q:
-            filt["$or"] = [
-                {"name": {"$regex": re.escape(q), "$options": "i"}},
-                {"category": {"$regex": re.escape(q), "$options": "i"}}
-            ]
+        filt = {}
 
         # Category filter - only apply if not empty and not "all"
         if category and category != "all" and category != "":
@@ -1050,60 +1247,60 @@ def create_app():
                 # If invalid ObjectId, skip this filter
                 pass
 
-        price_query = {}
         if price_min:
             try:
-                price_query["$gte"] = float(price_min)
+                filt["price_min"] = float(price_min)
             except ValueError:
                 pass
         if price_max:
             try:
-                price_query["$lte"] = float(price_max)
+                filt["price_max"] = float(price_max)
             except ValueError:
                 pass
-        if price_query:
-            filt["price"] = price_query
-
-        # Get medicines with filter
-        meds = list(app.db.medicines.find(filt).sort("name", ASCENDING))
 
-        # Get categories and pharmacies for filters - only from active medicines
-        categories = sorted({m.get("category", "") for m in app.db.medicines.find({"is_active": True}, {"category": 1}) if m.get("category")})
-        pharmacies = list(app.db.pharmacies.find({"is_active": True}, {"name": 1, "_id": 1}))
-        return render_template("search.html",
-                               meds=meds, categories=categories, pharmacies=pharmacies,
-                               selected={"q": q, "category": category, "pharmacy": pharmacy_id,
-                                         "min": price_min, "max": price_max})
+        # Text search (name and category) and filters run on the in-memory index
+        _ensure_index_fresh()
+        page = app.search_index.page(q, **filt, **_page_args())
+        selected = {"q": q, "category": category, "pharmacy": pharmacy_id,
+                    "min": price_min, "max": price_max}
+        return page, selected
 
     # ----------------------
     # Cart & Checkout
     # ----------------------
+    def _cart_id(create=False):
+        # Carts from before the server-side store are moved over on first touch
+        legacy = session.pop("cart", None)
+        session.pop("checkout_items", None)
+        cart_id = session.get("cart_id")
+        if not cart_id and (create or legacy):
+            cart_id = session["cart_id"] = app.cart_store.new_id()
+        if isinstance(legacy, dict) and legacy:
+            legacy = {mid: qty for mid, qty in legacy.items() if ObjectId.is_valid(mid)}
+            _set_cart_count(app.cart_store.add(cart_id, legacy))
+        return cart_id
+
+    def _set_cart_count(count):
+        session["cart_count"] = count
+
     def _get_cart():
-        # Get cart from session or create empty dict
-        cart = session.get("cart")
-        if cart is None or not isinstance(cart, dict):
-            session["cart"] = {}
-            cart = {}
-        return cart
+        cart_id = _cart_id()
+        return app.cart_store.lines(cart_id) if cart_id else {}
+
+    def _cart_pharmacies(priced):
+        # Only the pharmacies that actually appear in the priced cart
+        if not priced["pharmacy_ids"]:
+            return []
+        return list(app.db.pharmacies.find(
+            {"_id": {"$in": list(priced["pharmacy_ids"])}, "is_active": True}, {"name": 1, "_id": 1}
+        ))
 
     @app.route("/cart")
     def cart_view():
-        cart = _get_cart()
-        items = []
-        total = 0.0
-        pharmacy_ids = set()  # new variable to track unique pharmacy IDs
-        for mid, qty in cart.items():
-            med = app.db.medicines.find_one({"_id": ObjectId(mid)})
-            if not med:
-                continue
-            line_total = med["price"] * qty
-            total += line_total
-            items.append({"med": med, "qty": qty, "line_total": line_total})
-            if med.get("pharmacy_id"):
-                pharmacy_ids.add(med["pharmacy_id"])
-        pharmacies = list(app.db.pharmacies.find({"is_active": True}, {"name": 1, "_id": 1}))
-        multiple_pharmacies = (len(pharmacy_ids) > 1)
-        return render_template("cart.html", items=items, total=total, pharmacies=pharmacies, multiple_pharmacies=multiple_pharmacies)
+        priced = price_cart(app.db, _get_cart())
+        pharmacies = _cart_pharmacies(priced)
+        multiple_pharmacies = (len(priced["pharmacy_ids"]) > 1)
+        return render_template("cart.html", items=priced["items"], total=priced["total"], pharmacies=pharmacies, multiple_pharmacies=multiple_pharmacies)
 
 
     @app.route("/cart/add", methods=["POST"])
@@ -1123,13 +1320,10 @@ def create_app():
             flash("Invalid medicine selection.", "danger")
             return redirect(request.referrer or url_for('search'))
 
-        # Add to cart - FIXED: Ensure cart is properly handled
-        cart = _get_cart()
-        current_qty = cart.get(med_id, 0)
-        cart[med_id] = current_qty + max(1, qty)
-        session["cart"] = cart  # Explicitly set session cart
-        session.modified = True  # Ensure session is saved
-        
+        # Add to cart
+        med_id = str(medicine_id)
+        _set_cart_count(app.cart_store.add(_cart_id(create=True), {med_id: max(1, qty)}))
+
         flash(f"{medicine['name']} added to cart!", "success")
         return redirect(request.referrer or url_for('search'))
 
@@ -1148,15 +1342,16 @@ def create_app():
             flash("Invalid medicine selection.", "danger")
             return redirect(url_for('cart_view'))
 
-        cart = _get_cart()
+        if not medicine:
+            flash("Medicine not found.", "danger")
+            return redirect(url_for('cart_view'))
+
+        _set_cart_count(app.cart_store.set_qty(_cart_id(create=True), str(medicine_id), qty))
         if qty == 0:
-            cart.pop(med_id, None)
             flash(f"{medicine['name']} removed from cart.", "info")
         else:
-            cart[med_id] = qty
             flash(f"{medicine['name']} quantity updated.", "success")
-        
-        session.modified = True
+
         return redirect(url_for('cart_view'))
 
     @app.route("/checkout", methods=["GET", "POST"])
@@ -1166,28 +1361,16 @@ def create_app():
             # If coming from the cart page with selected items
             selected_items = request.form.getlist("selected_items")
             if selected_items:
-                # Store selected items in session
-                cart = _get_cart()
+                # Remember the selection on the server-side cart
+                cart_id = _cart_id(create=True)
+                cart = app.cart_store.lines(cart_id)
                 selected_cart = {mid: qty for mid, qty in cart.items() if mid in selected_items}
-                session['checkout_items'] = selected_cart
-                session.modified = True
+                app.cart_store.select(cart_id, selected_cart)
                 
                 # Prepare items for display
-                items = []
-                total = 0.0
-                for mid, qty in selected_cart.items():
-                    med = app.db.medicines.find_one({"_id": ObjectId(mid)})
-                    if med:
-                        line_total = med["price"] * qty
-                        total += line_total
-                        items.append({
-                            "med": med,
-                            "qty": qty,
-                            "line_total": line_total
-                        })
-                
-                pharmacies = list(app.db.pharmacies.find({"is_active": True}))
-                return render_template("checkout.html", cart_items=items, cart_total=total, pharmacies=pharmacies)
+                priced = price_cart(app.db, selected_cart)
+                pharmacies = _cart_pharmacies(priced)
+                return render_template("checkout.html", cart_items=priced["items"], cart_total=priced["total"], pharmacies=pharmacies)
 
             # If coming from the checkout page with address (placing order)
             user = session["user"]
@@ -1197,47 +1380,30 @@ def create_app():
                 flash("Delivery address required.", "warning")
                 return redirect(url_for("checkout"))
 
-            # Use the selected items stored in session
-            cart = session.get('checkout_items', {})
-            print("DEBUG: Cart contents before order creation:", cart)
+            # Use the selected items stored with the cart
+            cart_id = _cart_id()
+            cart = app.cart_store.selection(cart_id) if cart_id else {}
             if not cart:
                 flash("Cart is empty.", "warning")
                 return redirect(url_for("cart_view"))
 
             # Build order items
-            items = []
-            total = 0.0
-            pharmacy_ids = set()
-
-            for mid, qty in cart.items():
-                try:
-                    med = app.db.medicines.find_one({"_id": ObjectId(mid), "is_active": True})
-                    if not med:
-                        continue
-
-                    item_total = med["price"] * qty
-                    items.append({
-                        "medicine_id": med["_id"],
-                        "name": med["name"],
-                        "category": med.get("category", "General"),
-                        "unit_price": float(med["price"]),
-                        "qty": int(qty),
-                        "line_total": float(item_total)
-                    })
-                    total += item_total
-
-                    if med.get("pharmacy_id"):
-                        pharmacy_ids.add(med["pharmacy_id"])
-
-                except Exception as e:
-                    continue
-            print(items)
+            priced = price_cart(app.db, cart, active_only=True)
+            items = [{
+                "medicine_id": line["med"]["_id"],
+                "name": line["med"]["name"],
+                "category": line["med"].get("category", "General"),
+                "unit_price": float(line["med"]["price"]),
+                "qty": line["qty"],
+                "line_total": float(line["line_total"])
+            } for line in priced["items"]]
+            total = priced["total"]
+            pharmacy_ids = priced["pharmacy_ids"]
             # NEW: Check if medicines from different pharmacies are present
             if len(pharmacy_ids) > 1:
                 flash("Medicines from different pharmacies cannot be ordered together. Please place separate orders.", "warning")
                 return redirect(url_for('cart_view'))
 
-            print("DEBUG: Items to be saved in order:", items)
             if not items:
                 flash("No valid items in cart.", "danger")
                 return redirect(url_for("cart_view"))
@@ -1251,8 +1417,7 @@ def create_app():
                 "customer_name": user_data.get("name", ""),  # Get name from user profile
                 "phone_number": request.form.get("phone", ""),  # Get phone from checkout form
                 "notes": request.form.get("instructions", ""),  # Get delivery instructions
-                "items": items,  # Use items as the standard field
-                "order_items": items,  # Keep for backward compatibility
+                "items": items,
                 "total": round(total, 2),
                 "address": address,
                 "status": "Processing",
@@ -1262,69 +1427,40 @@ def create_app():
                 "updated_at": datetime.utcnow(),
             }
 
-            # Save to database
-            result = app.db.orders.insert_one(order_doc)
-            order_id = result.inserted_id
-
-            # Deduct stock
-            for item in items:
-                app.db.medicines.update_one(
-                    {"_id": item["medicine_id"]},
-                    {"$inc": {"stock": -item["qty"]}}
+            # Save to database, reserving stock in the same step
+            try:
+                order_id = place_order(app.db, order_doc)
+            except StockShortage as e:
+                lines = ", ".join(
+                    f"{s['name'] or s['medicine_id']} (requested {s['requested']}, available {s['available']})"
+                    for s in e.shortages
                 )
+                flash(f"Not enough stock for: {lines}. Please update your cart.", "danger")
+                return redirect(url_for("cart_view"))
+            _stock_changed(line["medicine_id"] for line in order_doc["items"])
 
-            # Clear checkout items and remove those items from cart
-            checkout_items = session.pop("checkout_items", {})
-            cart = _get_cart()
-            for item_id in checkout_items:
-                cart.pop(item_id, None)
-            session["cart"] = cart
-            session.modified = True
+            # Clear the selection and remove those items from the cart
+            _set_cart_count(app.cart_store.complete_checkout(cart_id, cart))
 
-            print("DEBUG: Order inserted with order_doc:", order_doc, "and order_id:", order_id)
+            app.logger.debug("Order %s placed with %d line(s)", order_id, len(items))
 
             flash("Order placed successfully!", "success")
             return redirect(url_for("order_detail", order_id=str(order_id)))
 
         # GET request
-        selected_cart = session.get('checkout_items')
+        cart_id = _cart_id()
+        selected_cart = app.cart_store.selection(cart_id) if cart_id else {}
         if not selected_cart:
             flash("Please select items from your cart first.", "warning")
             return redirect(url_for("cart_view"))
         
         # Prepare items for display
-        items = []
-        total = 0.0
-        for mid, qty in selected_cart.items():
-            med = app.db.medicines.find_one({"_id": ObjectId(mid)})
-            if med:
-                line_total = med["price"] * qty
-                total += line_total
-                items.append({
-                    "med": med,
-                    "qty": qty,
-                    "line_total": line_total
-                })
-        
-        for mid, qty in cart.items():
-            try:
-                med = app.db.medicines.find_one({"_id": ObjectId(mid)})
-                if med:
-                    line_total = med["price"] * qty
-                    total += line_total
-                    items.append({
-                        "med": med, 
-                        "qty": qty, 
-                        "line_total": line_total
-                    })
-            except:
-                continue
-        
-        pharmacies = list(app.db.pharmacies.find({"is_active": True}))
-        
-        return render_template("checkout.html", 
-                            cart_items=items, 
-                            cart_total=total, 
+        priced = price_cart(app.db, selected_cart)
+        pharmacies = _cart_pharmacies(priced)
+
+        return render_template("checkout.html",
+                            cart_items=priced["items"],
+                            cart_total=priced["total"],
                             pharmacies=pharmacies)
     @app.route("/test/cart")
     def test_cart():
@@ -1350,6 +1486,10 @@ def create_app():
     @app.route("/orders")
     @login_required
     def orders_list():
+        page = _orders_page()
+        return render_template("order_history.html", orders=page["items"], page=_page_links(page))
+
+    def _orders_page():
         user_id = ObjectId(session["user"]["_id"])
         role = session["user"]["role"]
         q = {}
@@ -1358,9 +1498,9 @@ def create_app():
             q["user_id"] = user_id
         elif role == "pharmacy":
             # Show orders containing items from this pharmacy
-            pharmacy = app.db.pharmacies.find_one({"owner_id": user_id})
-            if pharmacy:
-                q["pharmacy_ids"] = pharmacy["_id"]
+            pharmacy_id = _current_pharmacy_id()
+            if pharmacy_id:
+                q["pharmacy_ids"] = pharmacy_id
             else:
                 q["pharmacy_ids"] = None  # none will match
         elif role == "delivery":
@@ -1368,24 +1508,19 @@ def create_app():
         elif role == "admin":
             pass  # all orders
 
-        orders = list(app.db.orders.find(q).sort("created_at", DESCENDING))
-        
-        # Convert any ObjectIds to strings and ensure order_items is properly handled
+        page = keyset_page(app.db.orders, q, "created_at", projection=ORDER_LIST_PROJECTION, **_page_args())
+        orders = page["items"]
+
+        # Convert any ObjectIds to strings for the template and the JSON API
         for order in orders:
             order['_id'] = str(order['_id'])
             order['user_id'] = str(order['user_id'])
             if 'assigned_delivery_id' in order and order['assigned_delivery_id']:
                 order['assigned_delivery_id'] = str(order['assigned_delivery_id'])
-            
-            # Handle both old (items) and new (order_items) field names
-            if 'order_items' in order and isinstance(order['order_items'], list):
-                order['order_items'] = order['order_items']
-            elif 'items' in order and isinstance(order['items'], list):
-                order['order_items'] = order['items']
-            else:
-                order['order_items'] = []
-        
-        return render_template("order_history.html", orders=orders)
+            order['items'] = order_lines(order)
+            order.pop('order_items', None)
+
+        return page
 
     @app.route("/orders/<order_id>")
     @login_required
@@ -1395,87 +1530,38 @@ def create_app():
         except Exception:
             abort(404)
         
-        order = app.db.orders.find_one({"_id": oid})
+        # Access control, the same rule as the status endpoint
+        user = session["user"]
+        access = order_access_filter(user, _owned_pharmacy_ids() if user["role"] == "pharmacy" else ())
+        if access is None:
+            abort(403)
+
+        # Order, customer and delivery person in one round trip
+        order = load_order_tracking(app.db, oid, access)
         if not order:
-            abort(404)
+            abort(403 if app.db.orders.count_documents({"_id": oid}, limit=1) else 404)
 
-        # Access control - FIXED for pharmacy users
-        user = session["user"]
-        uid = ObjectId(user["_id"])
-        role = user["role"]
-        
         # Add customer details
-        if 'user_id' in order:
-            customer = app.db.users.find_one({"_id": order["user_id"]})
-            if customer:
-                order["customer_name"] = customer.get("name")
-                order["customer_phone"] = customer.get("phone")
-                order["customer_email"] = customer.get("email")
+        customer = order.pop("customer", None)
+        if customer:
+            order["customer_name"] = customer.get("name")
+            order["customer_phone"] = customer.get("phone")
+            order["customer_email"] = customer.get("email")
 
         # Add delivery person details if assigned
-        if 'delivery_id' in order:
-            delivery = app.db.users.find_one({"_id": order["delivery_id"]})
-            if delivery:
-                order["delivery_name"] = delivery.get("name")
-                order["delivery_phone"] = delivery.get("phone")
-        
-        # Add user details to order
-        if 'user_id' in order:
-            customer = app.db.users.find_one({"_id": order["user_id"]})
-            if customer:
-                order["customer_name"] = customer.get("name")
-                order["customer_phone"] = customer.get("phone")
-                order["customer_email"] = customer.get("email")
+        delivery_person = order.pop("delivery_person", None)
+        if delivery_person:
+            order["delivery_name"] = delivery_person.get("name")
+            order["delivery_phone"] = delivery_person.get("phone")
+            order["delivery_id_str"] = str(delivery_person["_id"])
 
-        # Add delivery person details if assigned
-        if 'delivery_id' in order:
-            delivery_person = app.db.users.find_one({"_id": order["delivery_id"]})
-            if delivery_person:
-                order["delivery_name"] = delivery_person.get("name")
-                order["delivery_phone"] = delivery_person.get("phone")
-                order["delivery_id_str"] = str(delivery_person["_id"])
-                
-                # Get delivery person's current rating
-                reviews = list(app.db.reviews.find({
-                    "delivery_person_id": order["delivery_id_str"],
-                    "type": "delivery"
-                }))
-                if reviews:
-                    total_rating = sum(review["rating"] for review in reviews)
-                    order["delivery_rating_avg"] = round(total_rating / len(reviews), 1)
-                    order["delivery_rating_count"] = len(reviews)
-                else:
-                    order["delivery_rating_avg"] = 0
-                    order["delivery_rating_count"] = 0
-
-        # Ensure consistent items field
-        if 'items' in order and isinstance(order['items'], list):
-            order['items'] = order['items']
-        elif 'order_items' in order and isinstance(order['order_items'], list):
-            order['items'] = order['order_items']
-        else:
-            order['items'] = []
-        
-        if role == "user":
-            # Users can only see their own orders
-            if order["user_id"] != uid:
-                abort(403)
-                
-        elif role == "pharmacy":
-            # Pharmacies can see orders that contain their medicines
-            pharmacy = app.db.pharmacies.find_one({"owner_id": uid})
-            if not pharmacy:
-                abort(403)
-            # Check if this order contains medicines from this pharmacy
-            if pharmacy["_id"] not in order.get("pharmacy_ids", []):
-                abort(403)
-                
-        elif role == "delivery":
-            # Delivery can only see orders assigned to them
-            if order.get("assigned_delivery_id") != uid:
-                abort(403)
-                
-        # admin can see all orders (no check needed)
+            # Delivery person's current rating from the stored aggregates
+            rating = rating_summary(delivery_person)
+            order["delivery_rating_avg"] = rating["avg"]
+            order["delivery_rating_count"] = rating["count"]
+
+        order['items'] = order_lines(order)
+        order.pop('order_items', None)
 
         # Convert ObjectIds to strings for template safety
         order["_id"] = str(order["_id"])
@@ -1494,17 +1580,11 @@ def create_app():
         if order.get("pharmacy_ids"):
             order["pharmacy_ids"] = [str(pid) if isinstance(pid, ObjectId) else pid for pid in order["pharmacy_ids"]]
         
-        # Get and process order items
-        order_items = order.get('order_items', [])
-        if isinstance(order_items, list):
-            for item in order_items:
-                if 'medicine_id' in item and isinstance(item['medicine_id'], ObjectId):
-                    item['medicine_id'] = str(item['medicine_id'])
-                if 'pharmacy_id' in item and isinstance(item['pharmacy_id'], ObjectId):
-                    item['pharmacy_id'] = str(item['pharmacy_id'])
-        else:
-            order_items = []
-        order['order_items'] = order_items
+        for item in order['items']:
+            if 'medicine_id' in item and isinstance(item['medicine_id'], ObjectId):
+                item['medicine_id'] = str(item['medicine_id'])
+            if 'pharmacy_id' in item and isinstance(item['pharmacy_id'], ObjectId):
+                item['pharmacy_id'] = str(item['pharmacy_id'])
         
         return render_template("order_tracking.html", order=order)    
     # ----------------------
@@ -1514,8 +1594,7 @@ def create_app():
     @login_required
     def order_update_status(order_id):
         new_status = request.form.get("status")
-        valid_flow = ["Pending", "Processing", "Ready for Delivery", "Out for Delivery", "Delivered","Cancelled"]
-        if new_status not in valid_flow:
+        if new_status not in ORDER_STATUSES:
             return jsonify({"ok": False, "msg": "Invalid status"}), 400
 
         try:
@@ -1536,8 +1615,8 @@ def create_app():
         if role == "admin":
             allowed = True
         elif role == "pharmacy":
-            pharm = app.db.pharmacies.find_one({"owner_id": uid})
-            if pharm and pharm["_id"] in order.get("pharmacy_ids", []):
+            pharmacy_id = _current_pharmacy_id()
+            if pharmacy_id and pharmacy_id in order.get("pharmacy_ids", []):
                 allowed = new_status in {"Pending", "Processing", "Out for Delivery"}
         elif role == "delivery":
             allowed = new_status in {"Out for Delivery", "Delivered"} and order.get("assigned_delivery_id") == uid
@@ -1545,10 +1624,19 @@ def create_app():
         if not allowed:
             return jsonify({"ok": False, "msg": "Not allowed"}), 403
 
-        app.db.orders.update_one(
-            {"_id": oid},
+        if new_status == "Cancelled":
+            # Same path as a customer cancellation, so stock and counters are released
+            if not _cancel_order(oid, ORDER_CANCELLABLE_STATUSES):
+                return jsonify({"ok": False, "msg": "Order cannot be cancelled"}), 409
+            return jsonify({"ok": True, "status": new_status})
+
+        # A cancelled order's stock has been released; it cannot be reopened
+        result = app.db.orders.update_one(
+            {"_id": oid, "status": {"$ne": "Cancelled"}},
             {"$set": {"status": new_status, "updated_at": datetime.utcnow()}}
         )
+        if not result.matched_count:
+            return jsonify({"ok": False, "msg": "Order is cancelled"}), 409
         return jsonify({"ok": True, "status": new_status})
     
 
@@ -1556,6 +1644,19 @@ def create_app():
     # ----------------------
     # Order Cancellation
     # ----------------------
+    def _cancel_order(oid, from_statuses):
+        # Only the request that flips the status restores stock
+        result = app.db.orders.update_one(
+            {"_id": oid, "status": {"$in": from_statuses}},
+            {"$set": {"status": "Cancelled", "updated_at": datetime.utcnow()}}
+        )
+        if not result.modified_count:
+            return False
+
+        # Restore stock and take the order out of the revenue counters
+        app.jobs.enqueue("release_order_stock", {"order_id": oid})
+        return True
+
     @app.route("/orders/<order_id>/cancel", methods=["POST"])
     @login_required
     def cancel_order(order_id):
@@ -1581,20 +1682,11 @@ def create_app():
             flash("This order cannot be cancelled at this stage.", "danger")
             return redirect(url_for('order_detail', order_id=order_id))
 
-        # Restore stock
-        for item in order["items"]:
-            app.db.medicines.update_one(
-                {"_id": item["medicine_id"]},
-                {"$inc": {"stock": item["qty"]}}
-            )
-
-        # Update order status
-        app.db.orders.update_one(
-            {"_id": oid},
-            {"$set": {"status": "Cancelled", "updated_at": datetime.utcnow()}}
-        )
+        if not _cancel_order(oid, ["Pending", "Processing"]):
+            flash("This order cannot be cancelled at this stage.", "danger")
+            return redirect(url_for('order_detail', order_id=order_id))
 
-        flash("Order cancelled successfully. Stock has been restored.", "success")
+        flash("Order cancelled successfully. Stock will be restored shortly.", "success")
         return redirect(url_for('order_detail', order_id=order_id))
     # ----------------------
     # Pharmacy Panel - Stock Management
@@ -1640,17 +1732,18 @@ def create_app():
         # Get orders that contain medicines from this pharmacy
         orders = list(app.db.orders.find({"pharmacy_ids": pharmacy["_id"]}).sort("created_at", DESCENDING).limit(20))
         
+        # Customer names for all of these orders in one query
+        customers = load_users_by_ids(app.db, [order.get("user_id") for order in orders])
+
         # Convert order ObjectIds to strings and add user info
         for order in orders:
+            customer = customers.get(order.get("user_id"))
+            if customer:
+                order["user_name"] = customer["name"]
             order["_id"] = str(order["_id"])
             order["user_id"] = str(order["user_id"])
             if "pharmacy_ids" in order:
                 order["pharmacy_ids"] = [str(pid) for pid in order["pharmacy_ids"]]
-            
-            # Get user info for each order
-            user = app.db.users.find_one({"_id": ObjectId(order["user_id"])})
-            if user:
-                order["user_name"] = user["name"]
         
         return render_template("pharmacy_panel.html", 
                             pharmacy=pharmacy, 
@@ -1669,9 +1762,8 @@ def create_app():
     @app.route("/pharmacy/medicine/add", methods=["POST"])
     @roles_required("pharmacy")
     def pharmacy_add_medicine():
-        owner_id = ObjectId(session["user"]["_id"])
-        pharmacy = app.db.pharmacies.find_one({"owner_id": owner_id})
-        if not pharmacy:
+        pharmacy_id = _current_pharmacy_id()
+        if not pharmacy_id:
             return jsonify({"ok": False, "msg": "Pharmacy not found"}), 404
 
         name = request.form.get("name", "").strip()
@@ -1684,29 +1776,32 @@ def create_app():
             return jsonify({"ok": False, "msg": "Name required"}), 400
 
         # Handle image upload
-        image_path = None
+        image_fields = None
         if "image" in request.files:
-            image_path = save_medicine_image(request.files["image"])
+            image_fields = save_medicine_image(request.files["image"])
 
         doc = {
             "name": name,
             "category": category,
             "price": price,
             "stock": stock,
-            "pharmacy_id": pharmacy["_id"],
+            "pharmacy_id": pharmacy_id,
             "is_active": is_active,
-            "image_path": image_path,
+            "image_path": None,
             "created_at": datetime.utcnow()
         }
+        if image_fields:
+            doc.update(image_fields)
         app.db.medicines.insert_one(doc)
+        app.db.pharmacies.update_one({"_id": pharmacy_id}, {"$inc": {"medicine_count": 1}})
+        _catalog_changed(doc)
         return redirect(url_for("pharmacy_dashboard"))
 
     @app.route("/pharmacy/medicine/<mid>/update", methods=["POST"])
     @roles_required("pharmacy")
     def pharmacy_update_medicine(mid):
-        owner_id = ObjectId(session["user"]["_id"])
-        pharmacy = app.db.pharmacies.find_one({"owner_id": owner_id})
-        if not pharmacy:
+        pharmacy_id = _current_pharmacy_id()
+        if not pharmacy_id:
             return jsonify({"ok": False, "msg": "Pharmacy not found"}), 404
 
         try:
@@ -1715,7 +1810,7 @@ def create_app():
             return jsonify({"ok": False, "msg": "Invalid id"}), 400
 
         med = app.db.medicines.find_one({"_id": oid})
-        if not med or med["pharmacy_id"] != pharmacy["_id"]:
+        if not med or med["pharmacy_id"] != pharmacy_id:
             return jsonify({"ok": False, "msg": "Not allowed"}), 403
 
         updates = {}
@@ -1730,6 +1825,8 @@ def create_app():
             return redirect(url_for("pharmacy_dashboard"))
 
         app.db.medicines.update_one({"_id": oid}, {"$set": updates})
+        med.update(updates)
+        _catalog_changed(med)
         status_msg = "Medicine activated" if updates.get("is_active") else "Medicine deactivated"
         flash(status_msg, "success")
         return redirect(url_for("pharmacy_dashboard"))
@@ -1741,9 +1838,8 @@ def create_app():
     @roles_required("pharmacy")
     def update_stock(mid):
         """Update stock for a specific medicine"""
-        owner_id = ObjectId(session["user"]["_id"])
-        pharmacy = app.db.pharmacies.find_one({"owner_id": owner_id})
-        if not pharmacy:
+        pharmacy_id = _current_pharmacy_id()
+        if not pharmacy_id:
             return jsonify({"ok": False, "msg": "Pharmacy not found"}), 404
 
         try:
@@ -1752,7 +1848,7 @@ def create_app():
             return jsonify({"ok": False, "msg": "Invalid medicine id"}), 400
 
         # Verify the medicine belongs to this pharmacy
-        med = app.db.medicines.find_one({"_id": oid, "pharmacy_id": pharmacy["_id"]})
+        med = app.db.medicines.find_one({"_id": oid, "pharmacy_id": pharmacy_id})
         if not med:
             return jsonify({"ok": False, "msg": "Medicine not found or not authorized"}), 404
 
@@ -1769,10 +1865,9 @@ def create_app():
             return jsonify({"ok": False, "msg": "Invalid stock value"}), 400
 
         # Update the stock
-        app.db.medicines.update_one(
-            {"_id": oid},
-            {"$set": {"stock": stock_value, "updated_at": datetime.utcnow()}}
-        )
+        stock_updates = {"stock": stock_value, "updated_at": datetime.utcnow()}
+        app.db.medicines.update_one({"_id": oid}, {"$set": stock_updates})
+        _stock_changed([oid])
 
         flash("Stock updated successfully!", "success")
         return redirect(url_for('pharmacy_dashboard'))
@@ -1794,7 +1889,7 @@ def create_app():
                 return redirect(url_for("home"))
                 
         except Exception as e:
-            print(f"Error in reviews route: {str(e)}")  # Debug log
+            app.logger.debug("Invalid pharmacy id %r for reviews: %s", pharmacy_id, e)
             flash("Invalid pharmacy ID.", "error")
             return redirect(url_for("home"))
 
@@ -1828,35 +1923,21 @@ def create_app():
                 review_doc["delivery_person_id"] = delivery_id
 
             # Insert the review
-            app.db.reviews.insert_one(review_doc)
+            review_id = app.db.reviews.insert_one(review_doc).inserted_id
 
-            # Update ratings based on review type
+            # Update the stored rating aggregates of the reviewed target
             if review_type == "pharmacy":
-                # Update pharmacy ratings
-                agg = list(app.db.reviews.aggregate([
-                    {"$match": {"pharmacy_id": pid, "type": "pharmacy"}},
-                    {"$group": {"_id": "$pharmacy_id", "avg": {"$avg": "$rating"}, "count": {"$sum": 1}}}
-                ]))
-                if agg:
-                    app.db.pharmacies.update_one(
-                        {"_id": pid},
-                        {"$set": {"rating_avg": round(float(agg[0]["avg"]), 2), "rating_count": agg[0]["count"]}}
-                    )
+                app.jobs.enqueue("record_rating", {
+                    "collection": "pharmacies", "target_id": pid, "rating": rating, "review_id": review_id,
+                })
             elif review_type == "delivery" and delivery_id:
-                # Update delivery person ratings
                 try:
-                    delivery_person_id = ObjectId(delivery_id)
-                    agg = list(app.db.reviews.aggregate([
-                        {"$match": {"delivery_person_id": delivery_id, "type": "delivery"}},
-                        {"$group": {"_id": "$delivery_person_id", "avg": {"$avg": "$rating"}, "count": {"$sum": 1}}}
-                    ]))
-                    if agg:
-                        app.db.users.update_one(
-                            {"_id": delivery_person_id},
-                            {"$set": {"rating_avg": round(float(agg[0]["avg"]), 2), "rating_count": agg[0]["count"]}}
-                        )
-                except Exception as e:
-                    print(f"Error updating delivery ratings: {str(e)}")
+                    app.jobs.enqueue("record_rating", {
+                        "collection": "users", "target_id": ObjectId(delivery_id), "rating": rating,
+                        "review_id": review_id,
+                    })
+                except Exception:
+                    app.logger.exception("Could not queue the rating for delivery person %s", delivery_id)
 
             flash("Review submitted successfully.", "success")
             return redirect(url_for("reviews", pharmacy_id=pharmacy_id))
@@ -1888,15 +1969,17 @@ def create_app():
                                 "delivery_person_id": str(delivery_person["_id"]),
                                 "type": "delivery"
                             }).sort("created_at", DESCENDING))
-            except Exception as e:
-                print(f"Error getting order or delivery details: {str(e)}")
+            except Exception:
+                app.logger.exception("Could not load the order or delivery details for review")
 
         return render_template(
             "reviews.html", 
             pharmacy=pharmacy, 
             pharmacy_reviews=pharmacy_reviews,
+            pharmacy_rating=rating_summary(pharmacy),
             delivery_reviews=delivery_reviews,
             delivery_person=delivery_person,
+            delivery_rating=rating_summary(delivery_person),
             order=order
         )
 
@@ -1912,42 +1995,72 @@ def create_app():
             flash("Invalid order ID", "error")
             return redirect(url_for('order_history'))
 
-        order = app.db.orders.find_one({"_id": oid, "user_id": user_id})
+        order = app.db.orders.find_one({"_id": oid, "user_id": user_id}, order_projection())
         if not order:
             flash("Order not found", "error")
             return redirect(url_for('order_history'))
 
-        # Get the items array from the order
-        items = order.get("items") or order.get("order_items", [])
+        items = order_lines(order)
         if not items:
             flash("No items found in the order", "error")
             return redirect(url_for('order_history'))
 
         # Put items back into cart with same quantities
-        cart = _get_cart()
+        added = {}
         added_count = 0
-        
+
+        # Handle both possible item structures
+        wanted = {}
         for item in items:
-            # Handle both possible item structures
             medicine_id = str(item.get("medicine_id", item.get("_id")))
             qty = int(item.get("qty", item.get("quantity", 1)))
-            
-            if medicine_id:
-                # Verify medicine still exists and is in stock
-                medicine = app.db.medicines.find_one({"_id": ObjectId(medicine_id)})
-                if medicine and medicine.get("stock", 0) > 0:
-                    cart[medicine_id] = cart.get(medicine_id, 0) + qty
-                    added_count += qty
+            wanted[medicine_id] = wanted.get(medicine_id, 0) + qty
+
+        # Verify medicines still exist and are in stock
+        priced = price_cart(app.db, wanted)
+        for line in priced["items"]:
+            if line["med"].get("stock", 0) > 0:
+                medicine_id = str(line["med"]["_id"])
+                added[medicine_id] = added.get(medicine_id, 0) + line["qty"]
+                added_count += line["qty"]
 
         if added_count > 0:
-            session["cart"] = cart
-            session.modified = True
+            _set_cart_count(app.cart_store.add(_cart_id(create=True), added))
             flash(f"Added {added_count} items to cart", "success")
         else:
             flash("Could not add any items to cart. Items may be out of stock.", "warning")
         
         return redirect(url_for('cart_view'))
 
+    @app.route("/reminders/<reminder_id>/<action>", methods=["POST"])
+    @login_required
+    def reminder_action(reminder_id, action):
+        try:
+            rid = ObjectId(reminder_id)
+        except Exception:
+            abort(404)
+        if action not in ("cart", "dismiss"):
+            abort(404)
+        reminder = app.db.reminders.find_one_and_update(
+            {"_id": rid, "user_id": ObjectId(session["user"]["_id"]), "read_at": None},
+            {"$set": {"read_at": datetime.utcnow()}},
+        )
+        if not reminder:
+            flash("Reminder not found.", "warning")
+            return redirect(url_for("user_dashboard"))
+        if action == "dismiss" or not reminder.get("cart"):
+            return redirect(url_for("user_dashboard"))
+
+        # Re-check stock now; the cart was resolved when the reminder fired
+        priced = price_cart(app.db, reminder["cart"], active_only=True)
+        wanted = {str(line["med"]["_id"]): line["qty"] for line in priced["items"] if line["med"].get("stock", 0) > 0}
+        if wanted:
+            _set_cart_count(app.cart_store.add(_cart_id(create=True), wanted))
+            flash(f"Added {len(wanted)} scheduled medicines to cart", "success")
+        else:
+            flash("None of the scheduled medicines are available right now.", "warning")
+        return redirect(url_for("cart_view"))
+
     # Schedules / Reminders
     @app.route("/schedules", methods=["GET", "POST", "DELETE"])
     @login_required
@@ -1968,8 +2081,11 @@ def create_app():
                 "user_id": user_id,
                 "frequency": freq,
                 "medicines": medicine_names,
+                "search_terms": schedule_search_terms(medicine_names),
                 "notes": notes,
+                "action": "cart" if request.form.get("action") == "cart" else "reminder",
                 "start_date": start_date,
+                "next_run_at": first_run_at(start_date, freq),
                 "created_at": datetime.utcnow()
             }
             app.db.schedules.insert_one(doc)
@@ -1986,10 +2102,8 @@ def create_app():
 
         # GET
         search = request.args.get("search", "").strip()
-        q = {"user_id": user_id}
-        if search:
-            q["medicines"] = {"$elemMatch": {"$regex": re.escape(search), "$options": "i"}}
-        scheds = list(app.db.schedules.find(q).sort("created_at", DESCENDING))
+        q = schedule_search_filter(user_id, search)
+        scheds = list(app.db.schedules.find(q, {"search_terms": 0}).sort("created_at", DESCENDING))
         return render_template("schedule.html", schedules=scheds)
     @app.route("/debug/order/<order_id>")
     @login_required
@@ -2006,7 +2120,8 @@ def create_app():
             order['user_id'] = str(order['user_id'])
             
             # Check the items field
-            items = order.get('items', [])
+            items = order_lines(order)
+            order['items_stored_as'] = [f for f in ORDER_ITEMS_FIELDS if f in order]
             order['items_type'] = str(type(items))
             order['items_length'] = len(items) if hasattr(items, '__len__') else 'N/A'
             order['items_content'] = items
@@ -2020,7 +2135,7 @@ def create_app():
     @login_required
     def debug_orders():
         user_id = ObjectId(session["user"]["_id"])
-        orders = list(app.db.orders.find({"user_id": user_id}))
+        orders = list(app.db.orders.find({"user_id": user_id}, order_projection("status", "total", "created_at")))
         
         result = []
         for order in orders:
@@ -2028,7 +2143,7 @@ def create_app():
                 '_id': str(order['_id']),
                 'status': order.get('status'),
                 'total': order.get('total'),
-                'items_count': len(order.get('items', [])),
+                'items_count': len(order_lines(order)),
                 'items_type': str(type(order.get('items'))),
                 'created_at': order.get('created_at')
             }
@@ -2049,88 +2164,45 @@ def create_app():
     @app.route("/admin/customers")
     @roles_required("admin")
     def admin_view_customers():
-        # Get all customers (users with role="user")
-        pipeline = [
-            {"$match": {"role": "user"}},
-            {
-                "$lookup": {
-                    "from": "orders",
-                    "localField": "_id",
-                    "foreignField": "user_id",
-                    "as": "orders"
-                }
-            },
-            {
-                "$project": {
-                    "_id": 1,
-                    "name": 1,
-                    "email": 1,
-                    "is_active": 1,
-                    "created_at": 1,
-                    "order_count": {"$size": "$orders"}
-                }
-            },
-            {"$sort": {"created_at": -1}}
-        ]
-        
-        customers = list(app.db.users.aggregate(pipeline))
-        
+        page = _customers_page()
+        return render_template("customer_view.html", customers=page["items"], page=_page_links(page))
+
+    def _customers_page():
+        # One page of customers (users with role="user"), newest first;
+        # order counts are maintained on the user document
+        page = keyset_page(app.db.users, {"role": "user"}, "created_at",
+                           projection=COUNTER_LIST_PROJECTION, **_page_args())
+
         # Convert ObjectIds to strings
-        for customer in customers:
+        for customer in page["items"]:
             customer["_id"] = str(customer["_id"])
-            
-        return render_template("customer_view.html", customers=customers)
+            customer.setdefault("order_count", 0)
+
+        return page
 
     @app.route("/admin/pharmacies")
     @roles_required("admin")
     def admin_view_pharmacies():
-        # Get all pharmacies with their medicine and order counts
-        pipeline = [
-            {
-                "$lookup": {
-                    "from": "users",
-                    "localField": "owner_id",
-                    "foreignField": "_id",
-                    "as": "owner"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "medicines",
-                    "localField": "_id",
-                    "foreignField": "pharmacy_id",
-                    "as": "medicines"
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "orders",
-                    "localField": "_id",
-                    "foreignField": "pharmacy_ids",
-                    "as": "orders"
-                }
-            },
-            {
-                "$project": {
-                    "_id": 1,
-                    "name": 1,
-                    "owner_name": {"$arrayElemAt": ["$owner.name", 0]},
-                    "is_active": 1,
-                    "created_at": 1,
-                    "medicine_count": {"$size": "$medicines"},
-                    "order_count": {"$size": "$orders"}
-                }
-            },
-            {"$sort": {"created_at": -1}}
-        ]
-        
-        pharmacies = list(app.db.pharmacies.aggregate(pipeline))
-        
+        page = _pharmacies_page()
+        return render_template("pharmacy_view.html", pharmacies=page["items"], page=_page_links(page))
+
+    def _pharmacies_page():
+        # One page of pharmacies; medicine and order counts are maintained
+        # on the pharmacy document, owners are resolved in one batch
+        page = keyset_page(app.db.pharmacies, {}, "created_at",
+                           projection=dict(COUNTER_LIST_PROJECTION, owner_id=1), **_page_args())
+        owners = load_users_by_ids(app.db, [p.get("owner_id") for p in page["items"]])
+        for pharmacy in page["items"]:
+            owner = owners.get(pharmacy.pop("owner_id", None))
+            pharmacy["owner_name"] = owner["name"] if owner else None
+            pharmacy.setdefault("medicine_count", 0)
+            pharmacy.setdefault("order_count", 0)
+
         # Convert ObjectIds to strings
-        for pharmacy in pharmacies:
+        for pharmacy in page["items"]:
             pharmacy["_id"] = str(pharmacy["_id"])
-            
-        return render_template("pharmacy_view.html", pharmacies=pharmacies)
+
+        return page
 
     @app.route("/admin/pharmacies/<pharmacy_id>/dashboard")
     @roles_required("admin")
@@ -2205,6 +2277,20 @@ def create_app():
         app.db.users.update_one({"_id": oid}, {"$set": {"is_active": not user.get("is_active", True)}})
         return jsonify({"ok": True})
 
+    @app.route("/admin/toggle_pharmacy/<pid>", methods=["POST"])
+    @roles_required("admin")
+    def admin_toggle_pharmacy(pid):
+        try:
+            oid = ObjectId(pid)
+        except Exception:
+            return jsonify({"ok": False}), 400
+        pharmacy = app.db.pharmacies.find_one({"_id": oid}, {"is_active": 1})
+        if not pharmacy:
+            return jsonify({"ok": False}), 404
+        app.db.pharmacies.update_one({"_id": oid}, {"$set": {"is_active": not pharmacy.get("is_active", True)}})
+        _listing_changed()
+        return jsonify({"ok": True})
+
     # ----------------------
     # Admin Management Functions
     # ----------------------
@@ -2219,15 +2305,26 @@ def create_app():
         status = request.form.get("status")
         if not status:
             return jsonify({"ok": False, "msg": "Status is required"}), 400
-            
-        result = app.db.orders.update_one(
-            {"_id": oid},
-            {"$set": {"status": status, "updated_at": datetime.utcnow()}}
-        )
-        
-        if result.matched_count == 0:
+        if status not in ORDER_STATUSES:
+            return jsonify({"ok": False, "msg": "Invalid status"}), 400
+
+        order = app.db.orders.find_one({"_id": oid}, {"status": 1})
+        if not order:
             return jsonify({"ok": False, "msg": "Order not found"}), 404
-            
+
+        if status == "Cancelled":
+            # Same path as a customer cancellation, so stock and counters are released
+            if order["status"] != "Cancelled" and not _cancel_order(oid, ORDER_CANCELLABLE_STATUSES):
+                return jsonify({"ok": False, "msg": "Order cannot be cancelled"}), 409
+        else:
+            # A cancelled order's stock has been released; it cannot be reopened
+            result = app.db.orders.update_one(
+                {"_id": oid, "status": {"$ne": "Cancelled"}},
+                {"$set": {"status": status, "updated_at": datetime.utcnow()}}
+            )
+            if not result.matched_count:
+                return jsonify({"ok": False, "msg": "Order is cancelled"}), 409
+
         flash("Order status updated successfully!", "success")
         return redirect(url_for("admin_dashboard"))
 
@@ -2261,18 +2358,55 @@ def create_app():
 
     # Lightweight APIs (JSON)
     @app.route("/api/medicines")
+    @catalog_etag
     def api_medicines():
         # For AJAX filters
-        q = request.args.get("q", "").strip()
-        filt = {"is_active": True}
-        if q:
-            filt["name"] = {"$regex": re.escape(q), "$options": "i"}
-        meds = list(app.db.medicines.find(filt).sort("name", ASCENDING).limit(50))
-        for m in meds:
-            m["_id"] = str(m["_id"])
-            if m.get("pharmacy_id"):
-                m["pharmacy_id"] = str(m["pharmacy_id"])
-        return jsonify(meds)
+        _ensure_index_fresh()
+        return jsonify(medicine_api_rows(app.search_index, request.args.get("q", "")))
+
+    @app.route("/api/orders/<order_id>/status")
+    @login_required
+    def api_order_status(order_id):
+        # Polled by the tracking page; the smallest order read there is
+        user = session["user"]
+        owned = _owned_pharmacy_ids() if user["role"] == "pharmacy" else ()
+        filt = order_status_filter(order_id, user, owned)
+        order = app.db.orders.find_one(filt, ORDER_STATUS_FIELDS) if filt else None
+        if not order:
+            return jsonify({"ok": False, "msg": "Order not found"}), 404
+        return jsonify(order_status_payload(order))
+
+    # Paginated JSON counterparts of the list pages (?after= / ?before= / ?limit=)
+    @app.route("/api/search")
+    @catalog_etag
+    def api_search():
+        page, _ = _search_page()
+        return _page_json(page)
+
+    @app.route("/api/orders")
+    @login_required
+    def api_orders():
+        return _page_json(_orders_page())
+
+    @app.route("/api/complaints")
+    @admin_required
+    def api_complaints():
+        return _page_json(_complaints_page())
+
+    @app.route("/api/delivery_personnel")
+    @roles_required("admin")
+    def api_delivery_personnel():
+        return _page_json(_delivery_personnel_page())
+
+    @app.route("/api/customers")
+    @roles_required("admin")
+    def api_customers():
+        return _page_json(_customers_page())
+
+    @app.route("/api/pharmacies")
+    @roles_required("admin")
+    def api_pharmacies():
+        return _page_json(_pharmacies_page())
 
 
     # Update complaint status route is defined above
@@ -2295,6 +2429,199 @@ def create_app():
                 "timestamp": datetime.utcnow().isoformat()
             }), 500
 
+    # ----------------------
+    # Maintenance Commands
+    # ----------------------
+    @app.cli.group("medpanda")
+    def medpanda_cli():
+        """Database setup and migrations."""
+
+    @medpanda_cli.command("migrate")
+    def migrate_command():
+        """Create indexes, apply pending schema migrations and seed data."""
+        before = schema_version(app.db)
+        applied = migrate(app.db)
+        if applied:
+            print(f"Schema migrated from version {before} to {applied[-1]}.")
+        else:
+            print(f"Schema is up to date (version {before}).")
+
+    @medpanda_cli.command("compress-static")
+    def compress_static_command():
+        """Write the precompressed siblings of static text assets."""
+        app.static_manifest.build()
+        count = sum(len(encodings) for encodings in app.static_manifest.encodings.values())
+        print(f"{count} precompressed static file(s) up to date.")
+
+    @medpanda_cli.command("audit-indexes")
+    @click.option("--live", is_flag=True, help="Explain against the app database instead of a seeded scratch copy.")
+    def audit_indexes_command(live):
+        """Flag hot-route queries that scan a collection or sort in memory."""
+        if live:
+            db = app.db
+        else:
+            db = app.db.client[f"{app.db.name}_index_audit"]
+            db.client.drop_database(db.name)
+            ensure_indexes(db)
+            seed_index_audit_data(db)
+        try:
+            results = audit_indexes(db)
+        finally:
+            if not live:
+                db.client.drop_database(db.name)
+        for r in results:
+            status = "FAIL " + ",".join(r["problems"]) if r["problems"] else "ok"
+            print(f"{status:<16} {r['route']:<28} {r['collection']:<18} {' <- '.join(r['stages'])}")
+        failures = sum(1 for r in results if r["problems"])
+        print(f"{len(results)} queries explained, {failures} with problems.")
+        if failures:
+            raise SystemExit(1)
+
+    @medpanda_cli.command("generate-data")
+    @click.option("--pharmacies", default=20, show_default=True)
+    @click.option("--medicines-per-pharmacy", default=50, show_default=True)
+    @click.option("--customers", default=500, show_default=True)
+    @click.option("--couriers", default=30, show_default=True)
+    @click.option("--orders", default=5000, show_default=True)
+    @click.option("--seed", default=42, show_default=True, help="Same seed, same dataset.")
+    @click.option("--drop", is_flag=True, help="Drop the database (and re-run migrations) first.")
+    @click.option("--yes", is_flag=True, help="Do not ask before dropping.")
+    def generate_data_command(pharmacies, medicines_per_pharmacy, customers, couriers, orders, seed, drop, yes):
+        """Fill the database with a reproducible synthetic dataset."""
+        from bench import SYNTHETIC_DOMAIN, SYNTHETIC_PASSWORD, generate_synthetic_data
+
+        if drop:
+            if not yes:
+                click.confirm(f"Drop database {app.db.name!r}?", abort=True)
+            app.db.client.drop_database(app.db.name)
+            migrate(app.db)
+        try:
+            counts = generate_synthetic_data(app.db, pharmacies, medicines_per_pharmacy, customers,
+                                             couriers, orders, seed)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        print(json.dumps(counts, indent=2))
+        print(f"Log in as <role><n>@{SYNTHETIC_DOMAIN} (e.g. user0, pharmacy0, admin0) "
+              f"with password {SYNTHETIC_PASSWORD!r}.")
+
+    @medpanda_cli.command("bench")
+    @click.option("--base-url", default=None, help="Benchmark a running server instead of the app in-process.")
+    @click.option("--users", default=8, show_default=True, help="Concurrent virtual users.")
+    @click.option("--iterations", default=10, show_default=True, help="Flow repetitions per user.")
+    @click.option("--seed", default=42, show_default=True)
+    @click.option("--output", type=click.Path(dir_okay=False), default=None, help="Write the JSON report here.")
+    def bench_command(base_url, users, iterations, seed, output):
+        """Measure the main flows and report latency percentiles and round trips as JSON."""
+        from bench import _HttpBenchClient, run_benchmark
+
+        if base_url:
+            make_client = lambda: _HttpBenchClient(base_url)
+        else:
+            app.config["SERVER_TIMING"] = True
+            make_client = app.test_client
+        try:
+            report = run_benchmark(make_client, app.db, users, iterations, seed)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        text = json.dumps(report, indent=2)
+        if output:
+            with open(output, "w") as fh:
+                fh.write(text + "\n")
+        print(text)
+
+    @medpanda_cli.command("status")
+    def schema_status_command():
+        """Show the recorded schema version and any pending migrations."""
+        current = schema_version(app.db)
+        print(f"Schema version {current} (code expects {SCHEMA_VERSION}).")
+        for version, description, _ in SCHEMA_MIGRATIONS:
+            if version > current:
+                print(f"  pending {version}: {description}")
+        state = app.db.meta.find_one(ORDER_ITEMS_MIGRATION) or {}
+        remaining = app.db.orders.count_documents({"order_items": {"$exists": True}})
+        if remaining:
+            print(f"  order_items collapse: {state.get('migrated', 0)} orders done, {remaining} to go"
+                  " (run `flask medpanda migrate-order-items`)")
+
+    @medpanda_cli.command("bench-read")
+    @click.option("--base-url", required=True, help="Server to measure, e.g. http://127.0.0.1:8000")
+    @click.option("--path", "paths", multiple=True, default=["/health", "/api/medicines?q=na"], show_default=True)
+    @click.option("--connections", default="1,4,16,64,256", show_default=True, help="Comma-separated concurrency levels.")
+    @click.option("--duration", default=10.0, show_default=True, help="Seconds per level.")
+    @click.option("--email", default=None, help="Log in first (for /get_users_by_role and order status).")
+    @click.option("--password", default=None, help="Defaults to the synthetic accounts' password.")
+    @click.option("--output", type=click.Path(dir_okay=False), default=None, help="Write the JSON report here.")
+    def bench_read_command(base_url, paths, connections, duration, email, password, output):
+        """Measure read-endpoint throughput per worker as concurrent connections grow."""
+        from bench import SYNTHETIC_PASSWORD, _HttpBenchClient, run_read_benchmark
+
+        cookie = None
+        if email:
+            client = _HttpBenchClient(base_url)
+            client.open("/login", method="POST", data={"email": email, "password": password or SYNTHETIC_PASSWORD})
+            cookie = "; ".join(f"{c.name}={c.value}" for c in client.cookies)
+        levels = [int(n) for n in connections.split(",") if n.strip()]
+        report = run_read_benchmark(base_url, list(paths), levels, duration, cookie)
+        text = json.dumps(report, indent=2)
+        if output:
+            with open(output, "w") as fh:
+                fh.write(text + "\n")
+        print(text)
+
+    @medpanda_cli.command("worker")
+    @click.option("--poll-interval", default=1.0, show_default=True, help="Seconds to wait when the queue is empty.")
+    @click.option("--burst", is_flag=True, help="Exit once no job is due instead of waiting for more.")
+    def worker_command(poll_interval, burst):
+        """Run queued background jobs and due schedules until stopped (SIGTERM finishes the current batch first)."""
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+        print(f"Worker {worker_id} started.")
+        while not stopping:
+            ran_job = app.jobs.run_next(worker_id)
+            if run_due_schedules(app.db, worker_id) or ran_job:
+                continue
+            if burst:
+                break
+            time.sleep(poll_interval)
+        print(f"Worker {worker_id} stopped. Queue: {app.jobs.stats()}")
+
+    @medpanda_cli.command("migrate-order-items")
+    @click.option("--batch-size", default=500, show_default=True)
+    @click.option("--pause", default=0.0, show_default=True, help="Seconds to sleep between batches.")
+    @click.option("--restart", is_flag=True, help="Discard the saved checkpoint and walk every order again.")
+    def migrate_order_items_command(batch_size, pause, restart):
+        """Collapse legacy order_items copies onto items, resuming from the last checkpoint."""
+        if restart:
+            app.db.meta.delete_one(ORDER_ITEMS_MIGRATION)
+        state = collapse_order_items(
+            app.db, batch_size, pause,
+            progress=lambda st: print(f"{st['migrated']}/{st['total']} orders migrated"),
+        )
+        print("Done." if state["done"] else "Stopped before the end; run again to resume.")
+
+    @medpanda_cli.command("rebuild-ratings")
+    def rebuild_ratings_command():
+        """Recompute stored rating aggregates from the reviews collection."""
+        rebuild_rating_aggregates(app.db)
+        print("Rating aggregates rebuilt.")
+
+    @medpanda_cli.command("rebuild-counters")
+    def rebuild_counters_command():
+        """Recompute pharmacy and customer counters from medicines and orders."""
+        rebuild_entity_counters(app.db)
+        print("Pharmacy and customer counters rebuilt.")
+
+    @medpanda_cli.command("gc-images")
+    @click.option("--dry-run", is_flag=True, help="Only list the files that would be removed.")
+    @click.option("--min-age", default=3600, show_default=True, help="Keep files newer than this many seconds.")
+    def gc_images_command(dry_run, min_age):
+        """Remove generated medicine image variants that no medicine references."""
+        removed = collect_unreferenced_images(app.db, app.config["UPLOAD_FOLDER"], min_age, dry_run)
+        for name in removed:
+            print(name)
+        print(f"{len(removed)} unreferenced image(s) {'found' if dry_run else 'removed'}.")
+
     return app
 
 
@@ -2302,41 +2629,2322 @@ def create_app():
 def ensure_indexes(db):
     db.users.create_index([("email", ASCENDING)], unique=True)
     db.users.create_index([("role", ASCENDING)])
+    db.users.create_index([("role", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)])
+    db.users.create_index([("role", ASCENDING), ("name", ASCENDING), ("_id", ASCENDING)])
+    db.pharmacies.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
     db.pharmacies.create_index([("owner_id", ASCENDING)])
     db.pharmacies.create_index([("name", ASCENDING)])
     db.medicines.create_index([("name", ASCENDING)])
+    db.medicines.create_index([("name", ASCENDING)], name="name_ci", collation=NAME_COLLATION)
     db.medicines.create_index([("category", ASCENDING)])
-    db.medicines.create_index([("pharmacy_id", ASCENDING)])
-    db.orders.create_index([("user_id", ASCENDING)])
-    db.orders.create_index([("status", ASCENDING)])
-    db.orders.create_index([("created_at", DESCENDING)])
-    db.reviews.create_index([("pharmacy_id", ASCENDING)])
+    db.medicines.create_index([("pharmacy_id", ASCENDING), ("name", ASCENDING)])
+    db.medicines.create_index([("is_active", ASCENDING), ("created_at", DESCENDING)])
+    # Compound indexes follow equality fields, then the sort (keyset pages
+    # sort on (created_at, _id))
+    db.orders.create_index([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)])
+    db.orders.create_index([("pharmacy_ids", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)])
+    db.orders.create_index([("assigned_delivery_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)])
+    db.orders.create_index([("assigned_delivery_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)])
+    db.orders.create_index([("delivery_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING)])
+    db.orders.create_index([("status", ASCENDING), ("created_at", DESCENDING)])
+    db.orders.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
+    db.delivery_requests.create_index([("delivery_user_id", ASCENDING), ("status", ASCENDING), ("requested_at", DESCENDING)])
+    db.delivery_requests.create_index([("status", ASCENDING), ("requested_at", DESCENDING)])
+    db.delivery_requests.create_index([("order_id", ASCENDING), ("status", ASCENDING)])
+    db.reviews.create_index([("pharmacy_id", ASCENDING), ("type", ASCENDING), ("created_at", DESCENDING)])
+    db.reviews.create_index([("delivery_person_id", ASCENDING), ("type", ASCENDING), ("created_at", DESCENDING)])
     db.reviews.create_index([("user_id", ASCENDING)])
-    db.schedules.create_index([("user_id", ASCENDING)])
-    db.schedules.create_index([("created_at", DESCENDING)])
+    db.complaints.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
+    db.schedules.create_index([("user_id", ASCENDING), ("created_at", DESCENDING)])
+    db.schedules.create_index([("user_id", ASCENDING), ("search_terms", ASCENDING), ("created_at", DESCENDING)])
+    db.schedules.create_index([("next_run_at", ASCENDING)])
+    db.reminders.create_index([("schedule_id", ASCENDING), ("due_at", ASCENDING)], unique=True)
+    db.reminders.create_index([("user_id", ASCENDING), ("read_at", ASCENDING), ("due_at", DESCENDING)])
+    db.delivery_profiles.create_index([("user_id", ASCENDING)])
+    db.delivery_profiles.create_index([("is_available", ASCENDING), ("last_requested_at", ASCENDING)])
+    db.carts.create_index([("updated_at", ASCENDING)], expireAfterSeconds=CART_TTL_SECONDS)
+    db.jobs.create_index([("status", ASCENDING), ("run_at", ASCENDING)])
+    db.jobs.create_index([("status", ASCENDING), ("locked_until", ASCENDING)])
+    db.jobs.create_index([("finished_at", ASCENDING)], expireAfterSeconds=JOB_RETENTION_SECONDS)
+
+
+# Schema migrations applied in order by `flask medpanda migrate`, as
+# (version, description, fn(db)). Append new entries; never renumber.
+SCHEMA_MIGRATIONS = [
+    (1, "Backfill rating aggregates from reviews", lambda db: rebuild_rating_aggregates(db)),
+    (2, "Backfill pharmacy and customer counters", lambda db: rebuild_entity_counters(db)),
+    (3, "Drop single-field indexes covered by compound ones", lambda db: drop_indexes(db, SUPERSEDED_INDEXES)),
+    (4, "Backfill next_run_at on schedules", lambda db: backfill_schedule_runs(db)),
+    (5, "Backfill schedule search terms", lambda db: backfill_schedule_search(db)),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+
+# Indexes that are now prefixes of (or replaced by) a compound index
+SUPERSEDED_INDEXES = [
+    ("medicines", "pharmacy_id_1"),
+    ("orders", "user_id_1"),
+    ("orders", "status_1"),
+    ("orders", "created_at_-1"),
+    ("reviews", "pharmacy_id_1"),
+    ("schedules", "user_id_1"),
+    ("schedules", "created_at_-1"),
+]
+
+
+def drop_indexes(db, names):
+    existing = {}
+    for collection, name in names:
+        if collection not in existing:
+            existing[collection] = set(db[collection].index_information())
+        if name in existing[collection]:
+            db[collection].drop_index(name)
+
+
+def schema_version(db):
+    doc = db.meta.find_one({"_id": "schema"}, {"version": 1})
+    return doc["version"] if doc else 0
+
+
+def migrate(db):
+    """Bring the database up to SCHEMA_VERSION.
+
+    Indexes are (re)created every time since create_index is idempotent;
+    pending migrations run in order and the version is recorded after each
+    one, so an interrupted run resumes where it stopped. Returns the list
+    of versions applied.
+    """
+    ensure_indexes(db)
+    applied = []
+    for version, description, fn in SCHEMA_MIGRATIONS:
+        if version <= schema_version(db):
+            continue
+        print(f"Applying migration {version}: {description}")
+        fn(db)
+        db.meta.update_one(
+            {"_id": "schema"},
+            {"$set": {"version": version, "migrated_at": datetime.utcnow()}},
+            upsert=True,
+        )
+        applied.append(version)
+    create_default_admin(db)
+    return applied
+
+
+# The find() shapes issued by the hot routes, as
+# (route, collection, filter(sample), sort). `flask medpanda audit-indexes`
+# explains each one; keep this in step with the routes.
+KEYSET_DESC = [("created_at", DESCENDING), ("_id", DESCENDING)]
+KEYSET_NAME_ASC = [("name", ASCENDING), ("_id", ASCENDING)]
+INDEX_AUDIT_QUERIES = [
+    ("index", "medicines", lambda s: {"is_active": True}, [("created_at", DESCENDING)]),
+    ("pharmacy_dashboard", "medicines", lambda s: {"pharmacy_id": s["pharmacy"]}, [("name", ASCENDING)]),
+    ("pharmacy_dashboard", "orders", lambda s: {"pharmacy_ids": s["pharmacy"]}, [("created_at", DESCENDING)]),
+    ("orders_list (user)", "orders", lambda s: {"user_id": s["customer"]}, KEYSET_DESC),
+    ("orders_list (pharmacy)", "orders", lambda s: {"pharmacy_ids": s["pharmacy"]}, KEYSET_DESC),
+    ("orders_list (delivery)", "orders", lambda s: {"assigned_delivery_id": s["courier"]}, KEYSET_DESC),
+    ("orders_list (admin)", "orders", lambda s: {}, KEYSET_DESC),
+    ("user_dashboard", "orders", lambda s: {"user_id": s["customer"]}, [("created_at", DESCENDING)]),
+    ("delivery_dashboard", "orders",
+     lambda s: {"assigned_delivery_id": s["courier"], "status": "Out for Delivery"}, [("created_at", DESCENDING)]),
+    ("delivery_dashboard", "orders",
+     lambda s: {"delivery_id": s["courier"], "status": "Delivered"}, [("created_at", DESCENDING)]),
+    ("delivery_dashboard (admin)", "orders",
+     lambda s: {"status": {"$in": ["Out for Delivery", "Delivered"]}}, [("created_at", DESCENDING)]),
+    ("delivery_dashboard", "delivery_requests",
+     lambda s: {"delivery_user_id": s["courier"], "status": "pending"}, [("requested_at", DESCENDING)]),
+    ("delivery_dashboard (admin)", "delivery_requests", lambda s: {"status": "pending"}, [("requested_at", DESCENDING)]),
+    ("request_delivery", "delivery_requests", lambda s: {"order_id": s["order"], "status": "pending"}, None),
+    ("request_delivery", "delivery_profiles", lambda s: {"is_available": True}, [("last_requested_at", ASCENDING)]),
+    ("reviews", "reviews", lambda s: {"pharmacy_id": s["pharmacy"], "type": "pharmacy"}, [("created_at", DESCENDING)]),
+    ("reviews", "reviews",
+     lambda s: {"delivery_person_id": str(s["courier"]), "type": "delivery"}, [("created_at", DESCENDING)]),
+    ("admin_complaints", "complaints", lambda s: {}, KEYSET_DESC),
+    ("schedules", "schedules", lambda s: {"user_id": s["customer"]}, [("created_at", DESCENDING)]),
+    ("schedules (search)", "schedules", lambda s: schedule_search_filter(s["customer"], "nap"), [("created_at", DESCENDING)]),
+    ("scheduler", "schedules", lambda s: {"next_run_at": {"$lte": datetime.utcnow()}}, [("next_run_at", ASCENDING)]),
+    ("user_dashboard", "reminders",
+     lambda s: {"user_id": s["customer"], "read_at": None}, [("due_at", DESCENDING)]),
+    ("orders_list (admin, next page)", "orders",
+     lambda s: keyset_query("created_at", after=[datetime.utcnow(), ObjectId()])[0], KEYSET_DESC),
+    ("admin_view_customers", "users", lambda s: {"role": "user"}, KEYSET_DESC),
+    ("admin_view_pharmacies", "pharmacies", lambda s: {}, KEYSET_DESC),
+    ("delivery_view", "users", lambda s: {"role": "delivery"}, KEYSET_NAME_ASC),
+    ("delivery_view (next page)", "users",
+     lambda s: {"$and": [{"role": "delivery"}, keyset_query("name", descending=False, after=["m", ObjectId()])[0]]},
+     KEYSET_NAME_ASC),
+]
+INDEX_AUDIT_PROBLEM_STAGES = {"COLLSCAN", "SORT"}
+
+
+def seed_index_audit_data(db):
+    """Fill an empty scratch database with enough rows for explain() to be meaningful."""
+    from bench import generate_synthetic_data
+
+    generate_synthetic_data(db, pharmacies=5, medicines_per_pharmacy=40, customers=50, couriers=10, orders=200)
+
+
+def _plan_stages(plan):
+    stages, stack = [], [plan]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        if "stage" in node:
+            stages.append(node["stage"])
+        for key in ("inputStage", "queryPlan", "innerStage", "outerStage"):
+            if key in node:
+                stack.append(node[key])
+        stack.extend(node.get("inputStages", []))
+    return stages
+
+
+def audit_indexes(db):
+    """Explain every INDEX_AUDIT_QUERIES entry against `db`.
+
+    Returns one dict per query with the winning plan's stages and the
+    problem stages found in it (full collection scans, in-memory sorts).
+    """
+    sample = {
+        "customer": (db.users.find_one({"role": "user"}, {"_id": 1}) or {}).get("_id"),
+        "courier": (db.users.find_one({"role": "delivery"}, {"_id": 1}) or {}).get("_id"),
+        "pharmacy": (db.pharmacies.find_one({}, {"_id": 1}) or {}).get("_id"),
+        "order": (db.orders.find_one({}, {"_id": 1}) or {}).get("_id"),
+    }
+    results = []
+    for route, collection, make_filter, sort in INDEX_AUDIT_QUERIES:
+        cursor = db[collection].find(make_filter(sample)).limit(PAGE_SIZE_DEFAULT + 1)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = _plan_stages(plan)
+        results.append({
+            "route": route,
+            "collection": collection,
+            "stages": stages,
+            "problems": sorted(INDEX_AUDIT_PROBLEM_STAGES.intersection(stages)),
+        })
+    return results
+
+
+# Abandoned server-side carts expire this long after their last change
+CART_TTL_SECONDS = int(os.getenv("CART_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# Finished background jobs are kept this long for inspection
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+
+class CartStore:
+    """Server-side shopping carts kept in a Mongo collection.
+
+    The session cookie only carries an opaque cart id plus the item count
+    shown in the navbar. Each cart is one document
+    {_id, lines: {medicine_id: qty}, checkout: {medicine_id: qty}, updated_at}
+    and every change is a single atomic $inc/$set/$unset, so concurrent
+    requests from the same shopper do not overwrite each other. A TTL
+    index on updated_at removes abandoned carts. Any object with the same
+    methods can be assigned to app.cart_store instead.
+
+    Write methods return the new total item count of the cart.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    def _load(self, cart_id, field):
+        doc = self.collection.find_one({"_id": cart_id}, {field: 1})
+        return (doc or {}).get(field) or {}
+
+    def lines(self, cart_id):
+        return self._load(cart_id, "lines")
+
+    def selection(self, cart_id):
+        return self._load(cart_id, "checkout")
+
+    def _update(self, cart_id, update):
+        update.setdefault("$set", {})["updated_at"] = datetime.utcnow()
+        doc = self.collection.find_one_and_update(
+            {"_id": cart_id}, update, projection={"lines": 1},
+            upsert=True, return_document=ReturnDocument.AFTER,
+        )
+        return sum((doc or {}).get("lines", {}).values())
+
+    def add(self, cart_id, quantities):
+        inc = {f"lines.{mid}": int(qty) for mid, qty in quantities.items()}
+        return self._update(cart_id, {"$inc": inc} if inc else {})
+
+    def set_qty(self, cart_id, med_id, qty):
+        if qty > 0:
+            return self._update(cart_id, {"$set": {f"lines.{med_id}": int(qty)}})
+        return self._update(cart_id, {"$unset": {f"lines.{med_id}": ""}})
+
+    def select(self, cart_id, selected):
+        return self._update(cart_id, {"$set": {"checkout": selected}})
+
+    def complete_checkout(self, cart_id, med_ids):
+        unset = {f"lines.{mid}": "" for mid in med_ids}
+        unset["checkout"] = ""
+        return self._update(cart_id, {"$unset": unset})
+
+
+# Only the fields the cart, checkout and reorder views actually read
+CART_MEDICINE_PROJECTION = {
+    "name": 1,
+    "category": 1,
+    "price": 1,
+    "stock": 1,
+    "pharmacy_id": 1,
+    "is_active": 1,
+    "image_path": 1,
+    "image_variants": 1,
+}
+
+
+def price_cart(db, cart, active_only=False):
+    """Price a {medicine_id: qty} cart with a single $in query.
+
+    Returns a dict with the priced lines (in cart order), the cart total,
+    the set of pharmacy ids involved and whether every line is in stock.
+    Unknown or malformed medicine ids are skipped.
+    """
+    oids = []
+    for mid in cart:
+        try:
+            oids.append(ObjectId(mid))
+        except Exception:
+            continue
+
+    meds = {}
+    if oids:
+        filt = {"_id": {"$in": oids}}
+        if active_only:
+            filt["is_active"] = True
+        for med in db.medicines.find(filt, CART_MEDICINE_PROJECTION):
+            meds[str(med["_id"])] = med
+
+    items = []
+    total = 0.0
+    pharmacy_ids = set()
+    for mid, qty in cart.items():
+        med = meds.get(str(mid))
+        if not med:
+            continue
+        qty = int(qty)
+        line_total = med["price"] * qty
+        total += line_total
+        items.append({
+            "med": med,
+            "qty": qty,
+            "line_total": line_total,
+            "in_stock": med.get("stock", 0) >= qty,
+        })
+        if med.get("pharmacy_id"):
+            pharmacy_ids.add(med["pharmacy_id"])
+
+    return {
+        "items": items,
+        "total": total,
+        "pharmacy_ids": pharmacy_ids,
+        "all_in_stock": all(item["in_stock"] for item in items),
+    }
+
+
+def _as_object_id(value):
+    if isinstance(value, ObjectId) or value is None:
+        return value
+    try:
+        return ObjectId(value)
+    except Exception:
+        return None
+
+
+def load_users_by_ids(db, ids, fields=("name",)):
+    """Fetch the users behind `ids` with one $in query.
+
+    Accepts ObjectIds or their string form (None and malformed ids are
+    skipped) and returns {ObjectId: user} with only `fields` projected.
+    """
+    oids = {oid for oid in (_as_object_id(i) for i in ids) if oid is not None}
+    if not oids:
+        return {}
+    projection = {field: 1 for field in fields}
+    return {u["_id"]: u for u in db.users.find({"_id": {"$in": list(oids)}}, projection)}
+
+
+# Materialized per-pharmacy and per-customer counters, kept up to date by
+# the write paths and recomputed in bulk by rebuild_entity_counters():
+# medicine_count (pharmacies), order_count, revenue_total (non-cancelled
+# orders) and last_order_at (pharmacies and users).
+COUNTER_LIST_PROJECTION = {
+    "name": 1, "email": 1, "is_active": 1, "created_at": 1,
+    "medicine_count": 1, "order_count": 1, "revenue_total": 1, "last_order_at": 1,
+}
+
+
+def record_order_counters(db, order):
+    """Count a newly placed order against its customer and pharmacies.
+
+    Not part of the order's transaction; `flask medpanda rebuild-counters`
+    repairs a count lost to a crash right after the insert.
+    """
+    update = {
+        "$inc": {"order_count": 1, "revenue_total": order.get("total", 0)},
+        "$max": {"last_order_at": order["created_at"]},
+    }
+    db.users.update_one({"_id": order["user_id"]}, update)
+    if order.get("pharmacy_ids"):
+        db.pharmacies.update_many({"_id": {"$in": order["pharmacy_ids"]}}, update)
+
+
+def record_order_cancelled(db, order):
+    """Take a cancelled order's total back out of the revenue counters."""
+    update = {"$inc": {"revenue_total": -order.get("total", 0)}}
+    db.users.update_one({"_id": order["user_id"]}, update)
+    if order.get("pharmacy_ids"):
+        db.pharmacies.update_many({"_id": {"$in": order["pharmacy_ids"]}}, update)
+
+
+def rebuild_entity_counters(db):
+    """Recompute every materialized counter from medicines and orders."""
+    order_stats = {
+        "order_count": {"$sum": 1},
+        "revenue_total": {"$sum": {"$cond": [{"$eq": ["$status", "Cancelled"]}, 0, "$total"]}},
+        "last_order_at": {"$max": "$created_at"},
+    }
+    empty = {"order_count": 0, "revenue_total": 0}
+
+    def apply(collection, rows, reset, unset=()):
+        ops, seen = [], []
+        for row in rows:
+            if row["_id"] is None:
+                continue
+            seen.append(row["_id"])
+            ops.append(UpdateOne({"_id": row["_id"]}, {"$set": {k: v for k, v in row.items() if k != "_id"}}))
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+        update = {"$set": reset}
+        if unset:
+            update["$unset"] = {field: "" for field in unset}
+        collection.update_many({"_id": {"$nin": seen}}, update)
+
+    apply(db.users, db.orders.aggregate([
+        {"$group": dict(order_stats, _id="$user_id")},
+    ]), empty, unset=("last_order_at",))
+    apply(db.pharmacies, db.orders.aggregate([
+        {"$unwind": "$pharmacy_ids"},
+        {"$group": dict(order_stats, _id="$pharmacy_ids")},
+    ]), empty, unset=("last_order_at",))
+    apply(db.pharmacies, db.medicines.aggregate([
+        {"$group": {"_id": "$pharmacy_id", "medicine_count": {"$sum": 1}}},
+    ]), {"medicine_count": 0})
+
+
+# Order lines live in `items`. Orders placed before that was the only field
+# also carry a legacy `order_items` copy until `flask medpanda
+# migrate-order-items` has collapsed them, so readers go through
+# order_lines() and project both ORDER_ITEMS_FIELDS.
+ORDER_ITEMS_FIELDS = ("items", "order_items")
+ORDER_ITEMS_MIGRATION = {"_id": "migration:order_items"}
+
+
+def order_lines(order):
+    """An order's line items, from `items` or the legacy `order_items`."""
+    for field in ORDER_ITEMS_FIELDS:
+        if isinstance(order.get(field), list):
+            return order[field]
+    return []
+
+
+def order_projection(*fields):
+    """find() projection for `fields` plus the line item fields."""
+    return dict.fromkeys(fields + ORDER_ITEMS_FIELDS, 1)
+
+
+# Order fields shown by order_history.html and /api/orders
+ORDER_LIST_PROJECTION = order_projection(
+    "user_id", "status", "total", "address", "pharmacy_ids", "assigned_delivery_id", "created_at",
+)
+
+
+def collapse_order_items(db, batch_size=500, pause=0.0, max_batches=None, progress=None):
+    """Move legacy `order_items` onto `items` in resumable batches.
+
+    Orders are walked in _id order. After each batch the last _id and the
+    running count are saved in meta ORDER_ITEMS_MIGRATION, so an
+    interrupted run resumes where it stopped and `flask medpanda status`
+    can report progress. `pause` seconds between batches keeps the load on
+    a live database down. Returns the saved state.
+    """
+    state = db.meta.find_one(ORDER_ITEMS_MIGRATION, {"_id": 0})
+    if not state:
+        state = {
+            "total": db.orders.count_documents({"order_items": {"$exists": True}}),
+            "migrated": 0, "last_id": None, "started_at": datetime.utcnow(),
+        }
+    # A finished run is re-checked from its checkpoint for orders written since
+    state["done"] = False
+    batches = 0
+    while not state["done"] and (max_batches is None or batches < max_batches):
+        filt = {"order_items": {"$exists": True}}
+        if state["last_id"] is not None:
+            filt["_id"] = {"$gt": state["last_id"]}
+        rows = list(db.orders.find(filt, order_projection()).sort("_id", ASCENDING).limit(batch_size))
+        ops = []
+        for row in rows:
+            update = {"$unset": {"order_items": ""}}
+            if not isinstance(row.get("items"), list):
+                update["$set"] = {"items": order_lines(row)}
+            ops.append(UpdateOne({"_id": row["_id"]}, update))
+        if ops:
+            db.orders.bulk_write(ops, ordered=False)
+            state["last_id"] = rows[-1]["_id"]
+        state["migrated"] += len(rows)
+        state["done"] = len(rows) < batch_size
+        state["updated_at"] = datetime.utcnow()
+        db.meta.update_one(ORDER_ITEMS_MIGRATION, {"$set": state}, upsert=True)
+        batches += 1
+        if progress:
+            progress(state)
+        if pause and not state["done"]:
+            time.sleep(pause)
+    return state
+
+
+# Order fields read by order_tracking.html (plus what access control needs)
+ORDER_TRACKING_FIELDS = [
+    "user_id", "address", "phone_number", "notes", "status", "total",
+    *ORDER_ITEMS_FIELDS, "pharmacy_id", "pharmacy_ids",
+    "assigned_delivery_id", "delivery_id",
+    "created_at", "updated_at", "delivered_at", "confirmed_at",
+]
+
+
+def load_order_tracking(db, oid, access=None):
+    """Load an order with its customer and delivery person.
+
+    One aggregation with $lookups replaces the separate user and courier
+    queries; only the fields the tracking page needs come back.
+    The delivery person is the order's delivery_id, falling back to
+    assigned_delivery_id. `access` (from order_access_filter) is added to
+    the match. Returns None when no such order matches.
+    """
+    projection = {field: 1 for field in ORDER_TRACKING_FIELDS}
+    projection.update({
+        "customer.name": 1, "customer.phone": 1, "customer.email": 1,
+        "delivery_person._id": 1, "delivery_person.name": 1, "delivery_person.phone": 1,
+        "delivery_person.rating_sum": 1, "delivery_person.rating_count": 1,
+        "delivery_person.rating_hist": 1,
+    })
+    rows = list(db.orders.aggregate([
+        {"$match": {"_id": oid, **(access or {})}},
+        {"$addFields": {"delivery_ref": {"$ifNull": ["$delivery_id", "$assigned_delivery_id"]}}},
+        {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "_id", "as": "customer"}},
+        {"$lookup": {"from": "users", "localField": "delivery_ref", "foreignField": "_id", "as": "delivery_person"}},
+        {"$project": projection},
+    ]))
+    if not rows:
+        return None
+    order = rows[0]
+    order["customer"] = order["customer"][0] if order.get("customer") else None
+    order["delivery_person"] = order["delivery_person"][0] if order.get("delivery_person") else None
+    return order
+
+
+class StockShortage(Exception):
+    """A stock reservation could not be satisfied.
+
+    `shortages` lists one {medicine_id, name, requested, available} dict
+    per line that is short.
+    """
+
+    def __init__(self, shortages=None):
+        super().__init__("Insufficient stock")
+        self.shortages = shortages or []
+
+
+def _quantities_by_medicine(items):
+    qty_by_med = {}
+    for item in items:
+        qty_by_med[item["medicine_id"]] = qty_by_med.get(item["medicine_id"], 0) + int(item["qty"])
+    return qty_by_med
+
+
+def _stock_shortages(db, qty_by_med):
+    found = {m["_id"]: m for m in db.medicines.find(
+        {"_id": {"$in": list(qty_by_med)}}, {"name": 1, "stock": 1, "is_active": 1}
+    )}
+    shortages = []
+    for mid, qty in qty_by_med.items():
+        med = found.get(mid) or {}
+        available = max(med.get("stock", 0), 0) if med.get("is_active") else 0
+        if available < qty:
+            shortages.append({"medicine_id": mid, "name": med.get("name", ""),
+                              "requested": qty, "available": available})
+    return shortages
+
+
+def _reserve_filter(mid, qty):
+    # Only ever decrement stock that is actually there
+    return {"_id": mid, "is_active": True, "stock": {"$gte": qty}}
+
+
+def release_stock(db, items):
+    """Give the stock held by `items` back in one bulk write."""
+    qty_by_med = _quantities_by_medicine(items)
+    if qty_by_med:
+        db.medicines.bulk_write(
+            [UpdateOne({"_id": mid}, {"$inc": {"stock": qty}}) for mid, qty in qty_by_med.items()],
+            ordered=False,
+        )
+
+
+def release_order_lines(db, order):
+    """Give a cancelled order's stock back, at most once per medicine.
+
+    Lines are claimed in the order's stock_released_ids before their stock
+    is incremented, so a retried job only releases what is still held.
+    Lines whose increment failed are unclaimed again before the error is
+    raised; a line whose outcome is unknown stays claimed rather than risk
+    restoring its stock twice.
+    """
+    qty_by_med = _quantities_by_medicine(order_lines(order))
+    if not qty_by_med:
+        return
+    before = db.orders.find_one_and_update(
+        {"_id": order["_id"]},
+        {"$addToSet": {"stock_released_ids": {"$each": list(qty_by_med)}}},
+        projection={"stock_released_ids": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    released = set((before or {}).get("stock_released_ids") or [])
+    pending = [mid for mid in qty_by_med if mid not in released]
+    if not pending:
+        return
+    try:
+        db.medicines.bulk_write(
+            [UpdateOne({"_id": mid}, {"$inc": {"stock": qty_by_med[mid]}}) for mid in pending],
+            ordered=False,
+        )
+    except BulkWriteError as e:
+        failed = [pending[err["index"]] for err in e.details.get("writeErrors", [])]
+        if failed:
+            db.orders.update_one({"_id": order["_id"]}, {"$pull": {"stock_released_ids": {"$in": failed}}})
+        raise
+
+
+def place_order(db, order_doc):
+    """Insert `order_doc` and reserve stock for its items atomically.
+
+    On a replica set this is one transaction: a single bulk_write of
+    conditional decrements (stock >= qty) followed by the order insert.
+    Standalone servers have no transactions, so there each line is
+    reserved in turn and released again if a later one is short. The
+    customer and pharmacy counters are bumped after the order is stored,
+    outside the transaction, so concurrent checkouts for one pharmacy do
+    not write-conflict on its document. Raises StockShortage with the
+    per-line shortages; returns the order id.
+    """
+    qty_by_med = _quantities_by_medicine(order_doc["items"])
+
+    def reserve_and_insert(session):
+        ops = [UpdateOne(_reserve_filter(mid, qty), {"$inc": {"stock": -qty}})
+               for mid, qty in qty_by_med.items()]
+        result = db.medicines.bulk_write(ops, ordered=False, session=session)
+        if result.matched_count != len(qty_by_med):
+            raise StockShortage()
+        db.orders.insert_one(order_doc, session=session)
+
+    try:
+        with db.client.start_session() as session:
+            session.with_transaction(reserve_and_insert)
+        record_order_counters(db, order_doc)
+        return order_doc["_id"]
+    except StockShortage:
+        # Aborted, so read the shortages outside the transaction
+        raise StockShortage(_stock_shortages(db, qty_by_med))
+    except OperationFailure as e:
+        if e.code != 20:  # IllegalOperation: transactions need a replica set
+            raise
+
+    reserved = []
+    for mid, qty in qty_by_med.items():
+        if not db.medicines.update_one(_reserve_filter(mid, qty), {"$inc": {"stock": -qty}}).matched_count:
+            release_stock(db, reserved)
+            raise StockShortage(_stock_shortages(db, qty_by_med))
+        reserved.append({"medicine_id": mid, "qty": qty})
+    try:
+        db.orders.insert_one(order_doc)
+    except Exception:
+        release_stock(db, reserved)
+        raise
+    record_order_counters(db, order_doc)
+    return order_doc["_id"]
+
+
+def dispatch_delivery_requests(db, order, pharmacy_id, fanout):
+    """Send a delivery request for `order` to at most `fanout` available couriers.
+
+    Couriers are picked least-recently-dispatched first through the
+    (is_available, last_requested_at) index, skipping those who already
+    hold a pending request for this order. Each request carries the order
+    reference and a small summary, not the order's items. Returns the
+    number of requests created.
+    """
+    already = db.delivery_requests.distinct(
+        "delivery_user_id", {"order_id": order["_id"], "status": "pending"}
+    )
+    profiles = list(
+        db.delivery_profiles.find(
+            {"is_available": True, "user_id": {"$nin": already}},
+            {"user_id": 1},
+        ).sort("last_requested_at", ASCENDING).limit(fanout)
+    )
+    if not profiles:
+        return 0
+
+    courier_ids = [p["user_id"] for p in profiles]
+    names = {u["_id"]: u.get("name", "Unknown")
+             for u in db.users.find({"_id": {"$in": courier_ids}}, {"name": 1})}
+
+    items = order_lines(order)
+    summary = {
+        "total": order.get("total", 0),
+        "items_count": len(items),
+        "address": order.get("address") or order.get("delivery_address", "Address not available"),
+    }
+    now = datetime.utcnow()
+    db.delivery_requests.insert_many([{
+        "order_id": order["_id"],
+        "delivery_user_id": courier_id,
+        "delivery_user_name": names.get(courier_id, "Unknown"),
+        "pharmacy_id": pharmacy_id,
+        "status": "pending",  # pending, accepted, rejected
+        "requested_at": now,
+        "responded_at": None,
+        "order_details": summary,
+    } for courier_id in courier_ids])
+    db.delivery_profiles.update_many(
+        {"user_id": {"$in": courier_ids}},
+        {"$set": {"last_requested_at": now}},
+    )
+    return len(courier_ids)
+
+
+# Ratings are kept as running aggregates on the rated document
+# (pharmacies, and users for delivery personnel): rating_sum,
+# rating_count, rating_avg and a rating_hist star histogram.
+RATING_STARS = (1, 2, 3, 4, 5)
+
+
+def record_rating(collection, target_id, rating):
+    """Fold one 1-5 star rating into the target's stored aggregates."""
+    doc = collection.find_one_and_update(
+        {"_id": target_id},
+        {"$inc": {"rating_sum": rating, "rating_count": 1, f"rating_hist.{rating}": 1}},
+        projection={"rating_sum": 1, "rating_count": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc and doc.get("rating_count"):
+        # Only the writer that saw the latest count refreshes the average
+        collection.update_one(
+            {"_id": target_id, "rating_count": doc["rating_count"]},
+            {"$set": {"rating_avg": round(doc["rating_sum"] / doc["rating_count"], 2)}},
+        )
+    return doc
+
+
+def rating_summary(doc):
+    """Average, count and per-star histogram from a rated document."""
+    doc = doc or {}
+    count = doc.get("rating_count") or 0
+    hist = doc.get("rating_hist") or {}
+    return {
+        "avg": round(doc.get("rating_sum", 0) / count, 1) if count else 0,
+        "count": count,
+        "hist": {star: hist.get(str(star), 0) for star in RATING_STARS},
+    }
+
+
+def rebuild_rating_aggregates(db):
+    """Recompute every stored rating aggregate from the reviews collection.
+
+    Needed once for documents rated before the counters existed, and as a
+    repair job should the counters ever drift.
+    """
+    targets = [
+        ("pharmacy", "$pharmacy_id", db.pharmacies),
+        ("delivery", "$delivery_person_id", db.users),
+    ]
+    # Every review is counted below; queued record_rating jobs must not add theirs again
+    db.reviews.update_many({"rated_at": None}, {"$set": {"rated_at": datetime.utcnow()}})
+    for review_type, field, collection in targets:
+        collection.update_many(
+            {"rating_count": {"$gt": 0}},
+            {"$set": {"rating_sum": 0, "rating_count": 0, "rating_avg": 0.0, "rating_hist": {}}},
+        )
+        rows = db.reviews.aggregate([
+            {"$match": {"type": review_type}},
+            {"$group": {"_id": {"target": field, "rating": "$rating"}, "count": {"$sum": 1}}},
+        ])
+        totals = {}
+        for row in rows:
+            target = row["_id"].get("target")
+            if target is None:
+                continue
+            agg = totals.setdefault(str(target), {"sum": 0, "count": 0, "hist": {}})
+            agg["sum"] += row["_id"]["rating"] * row["count"]
+            agg["count"] += row["count"]
+            agg["hist"][str(row["_id"]["rating"])] = row["count"]
+        ops = []
+        for target, agg in totals.items():
+            try:
+                target_id = ObjectId(target)
+            except Exception:
+                continue
+            ops.append(UpdateOne({"_id": target_id}, {"$set": {
+                "rating_sum": agg["sum"],
+                "rating_count": agg["count"],
+                "rating_avg": round(agg["sum"] / agg["count"], 2),
+                "rating_hist": agg["hist"],
+            }}))
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+
+
+# Background jobs. Routes enqueue slow side effects with app.jobs.enqueue()
+# and `flask medpanda worker` runs them; handlers take (db, payload).
+JOB_HANDLERS = {}
+
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+class JobQueue:
+    """Durable job queue in a Mongo collection.
+
+    A worker claims the oldest due job with one find_one_and_update, so a
+    job runs on one worker at a time. A claim is a lease: if the worker
+    dies, the job becomes claimable again once `locked_until` passes.
+    Failed jobs are retried with exponential backoff and marked "failed"
+    after `max_attempts`. Finished jobs are removed by a TTL index. With
+    `inline` set, enqueue() runs the handler immediately instead (local
+    development, no worker).
+    """
+
+    def __init__(self, collection, lease_seconds=300, max_attempts=5, inline=False):
+        self.collection = collection
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.inline = inline
+
+    def enqueue(self, kind, payload, delay_seconds=0):
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind {kind!r}")
+        if self.inline:
+            JOB_HANDLERS[kind](self.collection.database, payload)
+            return None
+        now = datetime.utcnow()
+        return self.collection.insert_one({
+            "kind": kind, "payload": payload, "status": "queued", "attempts": 0,
+            "run_at": now + timedelta(seconds=delay_seconds), "created_at": now,
+        }).inserted_id
+
+    def claim(self, worker_id):
+        now = datetime.utcnow()
+        return self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                {"status": "running", "locked_until": {"$lt": now}},
+            ]},
+            {"$set": {"status": "running", "locked_by": worker_id,
+                      "locked_until": now + timedelta(seconds=self.lease_seconds)},
+             "$inc": {"attempts": 1}},
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def complete(self, job):
+        self.collection.update_one(
+            {"_id": job["_id"], "locked_by": job["locked_by"]},
+            {"$set": {"status": "done", "finished_at": datetime.utcnow()},
+             "$unset": {"locked_by": "", "locked_until": ""}},
+        )
+
+    def fail(self, job, error):
+        update = {"last_error": error[-2000:]}
+        if job["attempts"] >= self.max_attempts:
+            update["status"] = "failed"
+        else:
+            update["status"] = "queued"
+            update["run_at"] = datetime.utcnow() + timedelta(seconds=min(5 * 2 ** job["attempts"], 3600))
+        self.collection.update_one(
+            {"_id": job["_id"], "locked_by": job["locked_by"]},
+            {"$set": update, "$unset": {"locked_by": "", "locked_until": ""}},
+        )
+
+    def run_next(self, worker_id):
+        """Claim and run one job. Returns False when nothing is due."""
+        job = self.claim(worker_id)
+        if not job:
+            return False
+        try:
+            handler = JOB_HANDLERS[job["kind"]]
+            handler(self.collection.database, job["payload"])
+        except Exception as e:
+            logger.warning("Job %s (%s) failed on attempt %s: %r", job["_id"], job["kind"], job["attempts"], e)
+            self.fail(job, f"{type(e).__name__}: {e}")
+        else:
+            self.complete(job)
+        return True
+
+    def stats(self):
+        return {row["_id"]: row["count"] for row in self.collection.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+        ])}
+
+
+@job_handler("dispatch_delivery")
+def _dispatch_delivery_job(db, payload):
+    order = db.orders.find_one({"_id": payload["order_id"]}, order_projection("total", "address"))
+    if order:
+        dispatch_delivery_requests(db, order, payload["pharmacy_id"], payload["fanout"])
+
+
+@job_handler("reject_other_requests")
+def _reject_other_requests_job(db, payload):
+    db.delivery_requests.update_many(
+        {"order_id": payload["order_id"], "status": "pending", "_id": {"$ne": payload["accepted_id"]}},
+        {"$set": {"status": "rejected", "responded_at": datetime.utcnow()}},
+    )
+
+
+@job_handler("record_rating")
+def _record_rating_job(db, payload):
+    # Claim the review first so a retried job cannot count it twice
+    review_id = payload.get("review_id")
+    if review_id is not None:
+        claimed = db.reviews.find_one_and_update(
+            {"_id": review_id, "rated_at": None}, {"$set": {"rated_at": datetime.utcnow()}}, projection={"_id": 1},
+        )
+        if not claimed:
+            return
+    try:
+        record_rating(db[payload["collection"]], payload["target_id"], payload["rating"])
+    except Exception:
+        if review_id is not None:
+            db.reviews.update_one({"_id": review_id}, {"$set": {"rated_at": None}})
+        raise
+
+
+@job_handler("release_order_stock")
+def _release_order_stock_job(db, payload):
+    order = db.orders.find_one(
+        {"_id": payload["order_id"], "status": "Cancelled", "stock_released_at": None},
+        order_projection("user_id", "total", "pharmacy_ids"),
+    )
+    if not order:
+        return
+    release_order_lines(db, order)
+    # Only the run that finishes the release updates the counters
+    finished = db.orders.update_one(
+        {"_id": order["_id"], "stock_released_at": None},
+        {"$set": {"stock_released_at": datetime.utcnow()}},
+    )
+    if not finished.modified_count:
+        return
+    record_order_cancelled(db, order)
+    ListingVersion().bump(db, _quantities_by_medicine(order_lines(order)))
+
+
+# Medicine schedules fire at their indexed next_run_at. run_due_schedules()
+# turns each due schedule into a reminder (action "cart": one that carries
+# a ready-made cart of its medicines, resolved as it fires) and moves
+# next_run_at on.
+SCHEDULE_FREQUENCIES = {"daily": 1, "weekly": 7}  # days; anything else is monthly
+SCHEDULE_BATCH_SIZE = int(os.getenv("SCHEDULE_BATCH_SIZE", "1000"))
+SCHEDULE_LEASE_SECONDS = int(os.getenv("SCHEDULE_LEASE_SECONDS", "300"))
+SCHEDULE_RUN_FIELDS = {
+    "user_id": 1, "frequency": 1, "medicines": 1, "notes": 1, "action": 1,
+    "start_date": 1, "created_at": 1, "next_run_at": 1, "run_due_at": 1,
+}
+
+
+def _add_months(when, months):
+    month = when.month - 1 + months
+    year, month = when.year + month // 12, month % 12 + 1
+    return when.replace(year=year, month=month, day=min(when.day, calendar.monthrange(year, month)[1]))
+
+
+def next_occurrence(start, frequency, after):
+    """First occurrence of the series starting at `start` later than `after`.
+
+    Computed directly rather than stepped, so a schedule that missed many
+    runs skips straight to its next one.
+    """
+    if start > after:
+        return start
+    days = SCHEDULE_FREQUENCIES.get(frequency)
+    if days:
+        step = timedelta(days=days)
+        return start + step * ((after - start) // step + 1)
+    months = (after.year - start.year) * 12 + after.month - start.month
+    while _add_months(start, months) <= after:
+        months += 1
+    return _add_months(start, months)
+
+
+def first_run_at(start_date, frequency, now=None):
+    """When a new schedule first fires: its start date, or the next occurrence if that has passed."""
+    now = now or datetime.utcnow()
+    if start_date >= now.replace(hour=0, minute=0, second=0, microsecond=0):
+        return start_date
+    return next_occurrence(start_date, frequency, now)
+
+
+def backfill_schedule_runs(db, batch_size=1000):
+    """Give schedules created before the scheduler their next_run_at (never in the past)."""
+    now = datetime.utcnow()
+    ops = []
+    for sched in db.schedules.find({"next_run_at": {"$exists": False}}, {"start_date": 1, "created_at": 1, "frequency": 1}):
+        start = sched.get("start_date") or sched.get("created_at") or now
+        ops.append(UpdateOne({"_id": sched["_id"]},
+                             {"$set": {"next_run_at": next_occurrence(start, sched.get("frequency"), now)}}))
+        if len(ops) >= batch_size:
+            db.schedules.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        db.schedules.bulk_write(ops, ordered=False)
+
+
+# Case-insensitive name matching, served by the medicines name_ci index
+NAME_COLLATION = {"locale": "en", "strength": 2}
+# Longest prefix stored per schedule search token; longer query words are cut to it
+SCHEDULE_PREFIX_MAX = 12
+
+
+def resolve_medicine_names(db, names):
+    """Map lowercased medicine names to the cheapest active, in-stock match, in one indexed query."""
+    if not names:
+        return {}
+    found = {}
+    cursor = db.medicines.find(
+        {"name": {"$in": list(names)}, "is_active": True, "stock": {"$gt": 0}}, {"name": 1, "price": 1}
+    ).collation(NAME_COLLATION).sort("price", ASCENDING)
+    for med in cursor:
+        found.setdefault(med["name"].lower(), med["_id"])
+    return found
+
+
+def _search_words(text):
+    return [word[:SCHEDULE_PREFIX_MAX] for word in re.findall(r"[a-z0-9]+", (text or "").lower())]
+
+
+def schedule_search_terms(names):
+    """Every prefix of every lowercased word in `names`, for the (user_id, search_terms) index."""
+    return sorted({word[:n] for name in names for word in _search_words(name) for n in range(1, len(word) + 1)})
+
+
+def schedule_search_filter(user_id, text):
+    """Indexed filter for a user's schedules whose medicines have words starting with each word of `text`."""
+    words = _search_words(text)
+    return {"user_id": user_id, "search_terms": {"$all": words}} if words else {"user_id": user_id}
+
+
+def backfill_schedule_search(db, batch_size=1000):
+    """Add search_terms to schedules written before they existed."""
+    query = {"search_terms": {"$exists": False}}
+    while True:
+        batch = list(db.schedules.find(query, {"medicines": 1}).limit(batch_size))
+        if not batch:
+            return
+        db.schedules.bulk_write([UpdateOne({"_id": sched["_id"]}, {"$set": {
+            "search_terms": schedule_search_terms(sched.get("medicines", [])),
+        }}) for sched in batch], ordered=False)
+
+
+def run_due_schedules(db, worker_id, batch_size=SCHEDULE_BATCH_SIZE, lease_seconds=SCHEDULE_LEASE_SECONDS):
+    """Fire up to `batch_size` due schedules. Returns how many this worker fired.
+
+    Due schedules are read with one range scan of the next_run_at index
+    and claimed by a compare-and-set on next_run_at that moves them out of
+    the due range for `lease_seconds`. A concurrent worker that read the
+    same rows wins none of them and moves on, and rows left by a crashed
+    worker fall due again when the lease runs out. Reminders are unique per
+    (schedule_id, due_at), so a re-run never duplicates one. Memory stays
+    bounded by the batch size.
+    """
+    now = datetime.utcnow()
+    due = list(db.schedules.find({"next_run_at": {"$lte": now}}, SCHEDULE_RUN_FIELDS)
+               .sort("next_run_at", ASCENDING).limit(batch_size))
+    if not due:
+        return 0
+    token = f"{worker_id}:{uuid.uuid4().hex}"
+    db.schedules.bulk_write([UpdateOne(
+        {"_id": sched["_id"], "next_run_at": sched["next_run_at"]},
+        {"$set": {"next_run_at": now + timedelta(seconds=lease_seconds), "claimed_by": token,
+                  "run_due_at": sched.get("run_due_at") or sched["next_run_at"]}},
+    ) for sched in due], ordered=False)
+    won = {row["_id"] for row in db.schedules.find(
+        {"_id": {"$in": [sched["_id"] for sched in due]}, "claimed_by": token}, {"_id": 1})}
+    due = [sched for sched in due if sched["_id"] in won]
+    if not due:
+        return 0
+
+    # Cart medicines are matched by name now, so a product that went out of
+    # stock or was replaced since the schedule was made is picked up again
+    ids = resolve_medicine_names(db, {name for sched in due if sched.get("action") == "cart"
+                                      for name in sched.get("medicines", [])})
+    reminders, advances = [], []
+    for sched in due:
+        due_at = sched.get("run_due_at") or sched["next_run_at"]
+        reminder = {
+            "user_id": sched["user_id"], "schedule_id": sched["_id"], "due_at": due_at,
+            "medicines": sched.get("medicines", []), "notes": sched.get("notes", ""),
+            "cart": None, "read_at": None, "created_at": now,
+        }
+        if sched.get("action") == "cart":
+            names = {name.lower() for name in sched.get("medicines", [])}
+            reminder["cart"] = {str(ids[name]): 1 for name in names if name in ids}
+        reminders.append(reminder)
+        start = sched.get("start_date") or sched.get("created_at") or due_at
+        advances.append(UpdateOne(
+            {"_id": sched["_id"], "claimed_by": token},
+            {"$set": {"next_run_at": next_occurrence(start, sched.get("frequency"), now), "last_run_at": due_at},
+             "$unset": {"claimed_by": "", "run_due_at": ""}},
+        ))
+    try:
+        db.reminders.insert_many(reminders, ordered=False)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+    db.schedules.bulk_write(advances, ordered=False)
+    return len(due)
+
+
+# Keyset pagination. Pages are ordered by (sort_key, _id) and the URL
+# carries opaque ?after= / ?before= tokens instead of page numbers, so
+# every page costs one bounded index scan however deep it is.
+PAGE_SIZE_DEFAULT = 25
+PAGE_SIZE_MAX = 100
+
+
+def page_size(args, default=PAGE_SIZE_DEFAULT):
+    try:
+        size = int(args.get("limit", default))
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, PAGE_SIZE_MAX))
+
+
+def encode_cursor(values):
+    raw = json_util.dumps(list(values)).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Decode a page token; malformed tokens are treated as absent."""
+    if not token:
+        return None
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception:
+        return None
+    return values if isinstance(values, list) else None
+
+
+KEYSET_VALUE_TYPES = (datetime, str, int, float)
+
+
+def keyset_cursor(cursor):
+    """Return `cursor` if it is a (sort value, _id) pair, else None."""
+    if not isinstance(cursor, list) or len(cursor) != 2 or not isinstance(cursor[1], ObjectId):
+        return None
+    value = cursor[0]
+    if value is not None and (isinstance(value, bool) or not isinstance(value, KEYSET_VALUE_TYPES)):
+        return None
+    return cursor
+
+
+def cursor_matches(cursor, sample):
+    """True if `cursor` has the length and element types of the key `sample`."""
+    if not isinstance(cursor, list) or sample is None or len(cursor) != len(sample):
+        return False
+    for value, expected in zip(cursor, sample):
+        if isinstance(expected, (int, float)) and not isinstance(expected, bool):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return False
+        elif type(value) is not type(expected):
+            return False
+    return True
+
+
+def keyset_query(sort_key, descending=True, after=None, before=None):
+    """Build the match condition and sort spec for one keyset page.
+
+    Returns (condition, sort, backwards). Walking backwards (?before=)
+    scans in the opposite direction; keyset_finish() restores the order.
+    Documents with a null or missing sort key sort lowest, as in MongoDB,
+    and stay reachable past the first page.
+    """
+    backwards = before is not None and after is None
+    cursor = before if backwards else after
+    scan_desc = descending != backwards
+    op = "$lt" if scan_desc else "$gt"
+    cond = {}
+    if keyset_cursor(cursor):
+        value, oid = cursor
+        # {sort_key: None} matches both null and missing keys
+        branches = [{sort_key: value, "_id": {op: oid}}]
+        if value is None:
+            if not scan_desc:
+                branches.append({sort_key: {"$ne": None}})
+        else:
+            branches.insert(0, {sort_key: {op: value}})
+            if scan_desc:
+                branches.append({sort_key: None})
+        cond = {"$or": branches}
+    direction = DESCENDING if scan_desc else ASCENDING
+    return cond, [(sort_key, direction), ("_id", direction)], backwards
+
+
+def keyset_finish(rows, sort_key, limit, after=None, backwards=False):
+    """Turn limit+1 fetched rows into a page dict with next/prev tokens."""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    def token(row):
+        return encode_cursor([row.get(sort_key), row["_id"]])
+
+    next_token = prev_token = None
+    if rows:
+        if backwards:
+            next_token = token(rows[-1])
+            prev_token = token(rows[0]) if has_more else None
+        else:
+            next_token = token(rows[-1]) if has_more else None
+            prev_token = token(rows[0]) if after else None
+    return {"items": rows, "next": next_token, "prev": prev_token, "limit": limit}
+
+
+def keyset_page(collection, filt, sort_key, descending=True, after=None, before=None,
+                limit=PAGE_SIZE_DEFAULT, projection=None):
+    """Fetch one page of `collection` ordered by (sort_key, _id)."""
+    after, before = keyset_cursor(after), keyset_cursor(before)
+    cond, sort, backwards = keyset_query(sort_key, descending, after, before)
+    query = {"$and": [filt, cond]} if cond else filt
+    rows = list(collection.find(query, projection).sort(sort).limit(limit + 1))
+    return keyset_finish(rows, sort_key, limit, after=after, backwards=backwards)
+
+
+def to_json_safe(value):
+    """Recursively convert ObjectIds to strings for jsonify()."""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, dict):
+        return {k: to_json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [to_json_safe(v) for v in value]
+    return value
+
+
+def keyset_window(keys, limit=PAGE_SIZE_DEFAULT, after=None, before=None):
+    """(start, end) of the page after/before the cursors in sorted `keys`."""
+    # A token shaped for another key is treated as absent
+    sample = keys[0] if keys else None
+    after = after if cursor_matches(after, sample) else None
+    before = before if cursor_matches(before, sample) else None
+    if before is not None and after is None:
+        end = bisect.bisect_left(keys, before)
+        return max(0, end - limit), end
+    start = bisect.bisect_right(keys, after) if after is not None else 0
+    return start, min(start + limit, len(keys))
+
+
+def keyset_window_page(items, keys, start, end, limit):
+    """The page dict for `items`, the rows at keys[start:end]."""
+    return {
+        "items": items,
+        "next": encode_cursor(keys[end - 1]) if items and end < len(keys) else None,
+        "prev": encode_cursor(keys[start]) if items and start > 0 else None,
+        "limit": limit,
+        "total": len(keys),
+    }
+
+
+def keyset_slice(rows, key, limit=PAGE_SIZE_DEFAULT, after=None, before=None):
+    """Keyset-paginate an already sorted in-memory list; key(row) -> list."""
+    keys = [key(row) for row in rows]
+    start, end = keyset_window(keys, limit, after, before)
+    return keyset_window_page(rows[start:end], keys, start, end, limit)
+
+
+class MedicineSearchIndex:
+    """Per-process trigram index over active medicines.
+
+    Holds the active catalog in memory and answers substring queries on
+    name/category by intersecting trigram postings, falling back to a
+    trigram-overlap ranking when nothing matches exactly (typos). Price,
+    category and pharmacy filters are applied on the candidate set.
+
+    Each worker keeps its own copy: local writes are applied immediately
+    via upsert()/remove(), writes from other workers are picked up when the
+    index is rebuilt after `refresh_seconds`, or as soon as the shared
+    catalog version (see CatalogVersion) moves past the one it was built at.
+    When only the listing version moves (stock), the medicines it logged as
+    changed are re-read and patched in instead of rebuilding.
+    """
+
+    GRAM = 3
+    FUZZY_MIN_SIMILARITY = 0.3
+
+    def __init__(self, refresh_seconds=60):
+        self.refresh_seconds = refresh_seconds
+        self.docs = {}       # str(_id) -> medicine document
+        self.postings = {}   # trigram -> set of str(_id)
+        self.sorted_keys = []  # sort_key(doc, 0) of every doc, in order
+        self.built_at = None
+        self.version = None  # catalog version the docs reflect
+        self.listing_version = None  # listing version the stock levels reflect
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    @classmethod
+    def _grams(cls, text):
+        text = (text or "").lower()
+        return {text[i:i + cls.GRAM] for i in range(len(text) - cls.GRAM + 1)}
+
+    def _doc_grams(self, doc):
+        return self._grams(doc.get("name")) | self._grams(doc.get("category"))
+
+    def rebuild(self, db, version=None, listing_version=None):
+        # The versions must be read before the docs so the labels are never newer
+        docs = {str(m["_id"]): m for m in db.medicines.find({"is_active": True})}
+        postings = {}
+        for key, doc in docs.items():
+            for gram in self._doc_grams(doc):
+                postings.setdefault(gram, set()).add(key)
+        sorted_keys = sorted(self.sort_key(doc, 0) for doc in docs.values())
+        with self._lock:
+            self.docs, self.postings, self.sorted_keys = docs, postings, sorted_keys
+            self.built_at = datetime.utcnow()
+            self.version = version
+            self.listing_version = listing_version
+
+    def is_fresh(self, version=None, listing_version=None):
+        if self.built_at is None or datetime.utcnow() - self.built_at > timedelta(seconds=self.refresh_seconds):
+            return False
+        if listing_version is not None and (self.listing_version is None or listing_version > self.listing_version):
+            return False
+        return version is None or version == self.version
+
+    def ensure_fresh(self, db, version=None, listing_version=None):
+        if self.is_fresh(version, listing_version):
+            return
+        # One rebuild at a time; threads that waited reuse its result
+        with self._rebuild_lock:
+            if not self.is_fresh(version):
+                self.rebuild(db, version, listing_version)
+            elif not self.is_fresh(version, listing_version):
+                self._catch_up(db)
+
+    def _catch_up(self, db):
+        # Patch in the stock changes logged since our listing version
+        latest, ids = ListingVersion.changes_since(db, self.listing_version or 0)
+        if ids is None or self.listing_version is None:
+            self.rebuild(db, self.version, latest)
+            return
+        for doc in db.medicines.find({"_id": {"$in": list(ids)}}):
+            self.upsert(doc)
+        with self._lock:
+            self.listing_version = max(latest, self.listing_version)
+
+    def _unlink(self, key):
+        old = self.docs.pop(key, None)
+        if old is None:
+            return
+        old_key = self.sort_key(old, 0)
+        i = bisect.bisect_left(self.sorted_keys, old_key)
+        if i < len(self.sorted_keys) and self.sorted_keys[i] == old_key:
+            del self.sorted_keys[i]
+        for gram in self._doc_grams(old):
+            bucket = self.postings.get(gram)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.postings[gram]
+
+    def upsert(self, doc, version=None, listing_version=None):
+        """Add, replace or drop (if inactive) a single medicine.
+
+        `version` (`listing_version`) is the catalog (listing) version this
+        write produced; when it is the one right after ours, the index stays
+        current without a rebuild.
+        """
+        key = str(doc["_id"])
+        with self._lock:
+            if version is not None and self.version is not None and version == self.version + 1:
+                self.version = version
+            if (listing_version is not None and self.listing_version is not None
+                    and listing_version == self.listing_version + 1):
+                self.listing_version = listing_version
+            self._unlink(key)
+            if doc.get("is_active"):
+                self.docs[key] = doc
+                bisect.insort(self.sorted_keys, self.sort_key(doc, 0))
+                for gram in self._doc_grams(doc):
+                    self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, medicine_id):
+        with self._lock:
+            self._unlink(str(medicine_id))
+
+    def _matches(self, q, fields):
+        docs = self.docs
+        grams = self._grams(q)
+        if grams:
+            buckets = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+            candidates = set.intersection(*buckets)
+        else:
+            # Shorter than one trigram: scan the (in-memory) catalog
+            candidates = docs.keys()
+        exact = [(0, docs[k]) for k in candidates
+                 if any(q in (docs[k].get(f) or "").lower() for f in fields)]
+        if exact or not grams:
+            return sorted(exact, key=lambda t: self.sort_key(t[1], 0))
+
+        # No substring hit: rank by trigram overlap to tolerate typos
+        scores = {}
+        for gram in grams:
+            for key in self.postings.get(gram, ()):
+                scores[key] = scores.get(key, 0) + 1
+        fuzzy = []
+        for key, score in scores.items():
+            doc = docs[key]
+            doc_grams = set().union(*(self._grams(doc.get(f)) for f in fields))
+            similarity = len(grams & doc_grams) / len(grams)
+            if similarity >= self.FUZZY_MIN_SIMILARITY:
+                fuzzy.append((-round(similarity, 4), doc))
+        return sorted(fuzzy, key=lambda t: self.sort_key(t[1], t[0]))
+
+    @staticmethod
+    def sort_key(doc, rank=None):
+        """Result ordering (rank, name, id); also used as the page cursor."""
+        if rank is None:
+            rank = doc.get("search_rank", 0)
+        return [rank, doc.get("name", ""), str(doc["_id"])]
+
+    def search(self, q="", category=None, pharmacy_id=None, price_min=None, price_max=None,
+               fields=("name", "category"), limit=None):
+        """Return shallow copies of matching active medicines, sorted by name
+        (or by similarity for typo matches) as given by sort_key()."""
+        q = (q or "").strip().lower()
+        with self._lock:
+            if q:
+                results = self._matches(q, fields)
+            else:
+                results = [(0, self.docs[k[2]]) for k in self.sorted_keys]
+
+        out = []
+        for rank, med in results:
+            if category and med.get("category") != category:
+                continue
+            if pharmacy_id is not None and med.get("pharmacy_id") != pharmacy_id:
+                continue
+            if price_min is not None and med.get("price", 0) < price_min:
+                continue
+            if price_max is not None and med.get("price", 0) > price_max:
+                continue
+            out.append(dict(med, search_rank=rank))
+            if limit and len(out) >= limit:
+                break
+        return out
+
+    def page(self, q="", limit=PAGE_SIZE_DEFAULT, after=None, before=None, **filters):
+        """One keyset page of search(q, **filters), as keyset_slice() returns it.
+
+        The unfiltered listing bisects the pre-sorted keys to the cursor
+        instead of copying and ordering the whole catalog.
+        """
+        if (q or "").strip() or any(value is not None for value in filters.values()):
+            return keyset_slice(self.search(q, **filters), self.sort_key, limit, after, before)
+        with self._lock:
+            keys = self.sorted_keys
+            start, end = keyset_window(keys, limit, after, before)
+            items = [dict(self.docs[k[2]], search_rank=0) for k in keys[start:end]]
+            return keyset_window_page(items, keys, start, end, limit)
+
+
+# Precompressed sibling suffix per Content-Encoding, in order of preference
+STATIC_ENCODINGS = {"br": ".br", "gzip": ".gz"}
+STATIC_COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".txt", ".html"}
+
+
+class StaticManifest:
+    """Content hashes and precompressed siblings for files under static/.
+
+    build() runs once at startup: it hashes every file, and writes .gz (and,
+    when the brotli package is installed, .br) siblings for text assets
+    whose sibling is missing or older than the source. Siblings are written
+    to a temp file and renamed into place, so a worker never serves one
+    that another worker is still writing; `flask medpanda compress-static`
+    writes them ahead of time in a build step. url_for("static")
+    then appends ?v=<hash>, and a request carrying the current hash can be
+    cached forever. Folders in `exclude` (medicine uploads) are not hashed;
+    their files never change once written, so they are immutable by name.
+    """
+
+    def __init__(self, folder, exclude=()):
+        self.folder = folder
+        self.exclude = [os.path.abspath(path) for path in exclude]
+        self.hashes = {}
+        self.encodings = {}
+
+    def _is_excluded(self, path):
+        path = os.path.abspath(path)
+        return any(path == ex or path.startswith(ex + os.sep) for ex in self.exclude)
+
+    def _compress(self, path, encoding):
+        target = path + STATIC_ENCODINGS[encoding]
+        if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+            return True
+        with open(path, "rb") as fh:
+            data = fh.read()
+        if encoding == "br":
+            data = brotli.compress(data, quality=11)
+        else:
+            data = gzip.compress(data, compresslevel=9, mtime=0)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".", suffix=".tmp")
+        except OSError:
+            return False  # read-only deploys just serve the originals
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, target)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def build(self):
+        hashes, encodings = {}, {}
+        wanted = [enc for enc in STATIC_ENCODINGS if enc != "br" or brotli is not None]
+        for root, dirs, files in os.walk(self.folder):
+            dirs[:] = [d for d in dirs if not self._is_excluded(os.path.join(root, d))]
+            for name in files:
+                if os.path.splitext(name)[1] in STATIC_ENCODINGS.values() or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, self.folder).replace(os.sep, "/")
+                with open(path, "rb") as fh:
+                    hashes[rel] = hashlib.sha256(fh.read()).hexdigest()[:12]
+                if os.path.splitext(name)[1] in STATIC_COMPRESSIBLE:
+                    encodings[rel] = [enc for enc in wanted if self._compress(path, enc)]
+        self.hashes, self.encodings = hashes, encodings
+
+    def fingerprint(self, filename):
+        return self.hashes.get(filename)
+
+    def is_encodable(self, filename):
+        return bool(self.encodings.get(filename))
+
+    def is_immutable(self, filename, version):
+        if version and version == self.hashes.get(filename):
+            return True
+        return self._is_excluded(os.path.join(self.folder, filename))
+
+    def pick_encoding(self, filename, accept_encodings):
+        for encoding in self.encodings.get(filename, ()):
+            if accept_encodings[encoding]:
+                return encoding
+        return None
+
+
+class CatalogVersion:
+    """Shared catalog version stamp, stored in the meta collection.
+
+    Every write to the medicine catalog (add, edit, delete) calls bump(),
+    which increments the stamp atomically. current() caches the last value
+    per process for `ttl_seconds`, so conditional GETs usually do not touch
+    Mongo at all; another worker's write shows up once that expires.
+    """
+
+    KEY = "catalog"
+
+    def __init__(self, ttl_seconds=2):
+        self.ttl_seconds = ttl_seconds
+        self._version = None
+        self._read_at = None
+        self._lock = threading.Lock()
+
+    def _remember(self, version):
+        with self._lock:
+            self._version, self._read_at = version, datetime.utcnow()
+        return version
+
+    def _cached(self):
+        with self._lock:
+            if self._read_at and datetime.utcnow() - self._read_at <= timedelta(seconds=self.ttl_seconds):
+                return self._version
+        return None
+
+    def current(self, db):
+        version = self._cached()
+        if version is not None:
+            return version
+        doc = db.meta.find_one({"_id": self.KEY}, {"version": 1})
+        return self._remember(doc["version"] if doc else 0)
+
+    async def current_async(self, db):
+        """current() against an AsyncMongoClient database."""
+        version = self._cached()
+        if version is not None:
+            return version
+        doc = await db.meta.find_one({"_id": self.KEY}, {"version": 1})
+        return self._remember(doc["version"] if doc else 0)
+
+    def bump(self, db):
+        doc = db.meta.find_one_and_update(
+            {"_id": self.KEY}, {"$inc": {"version": 1}},
+            projection={"version": 1}, upsert=True, return_document=ReturnDocument.AFTER,
+        )
+        return self._remember(doc["version"])
+
+
+class ListingVersion(CatalogVersion):
+    """Version stamp for catalog page content kept outside the catalog
+    version: stock levels and the pharmacy list.
+
+    Orders and pharmacy writes bump this one, so they move the catalog
+    ETags without making every worker rebuild its search index. Each bump
+    also appends the medicine ids whose stock it changed to a capped log on
+    the same document, one entry per version, so other workers patch just
+    those medicines (see MedicineSearchIndex.ensure_fresh).
+    """
+
+    KEY = "listing"
+    CHANGE_LOG_SIZE = 256
+
+    def bump(self, db, medicine_ids=()):
+        # $inc and $push in one update keep entry -k in step with version - k + 1
+        doc = db.meta.find_one_and_update(
+            {"_id": self.KEY},
+            {"$inc": {"version": 1},
+             "$push": {"changes": {"$each": [list(medicine_ids)], "$slice": -self.CHANGE_LOG_SIZE}}},
+            projection={"version": 1}, upsert=True, return_document=ReturnDocument.AFTER,
+        )
+        return self._remember(doc["version"])
+
+    @classmethod
+    def changes_since(cls, db, since):
+        """(current version, medicine ids changed after `since`).
+
+        The ids are None when the log no longer reaches back to `since`.
+        """
+        doc = db.meta.find_one({"_id": cls.KEY}, {"version": 1, "changes": 1}) or {}
+        version, changes = doc.get("version", 0), doc.get("changes") or []
+        behind = max(version - since, 0)
+        if behind > len(changes):
+            return version, None
+        ids = set()
+        for entry in changes[len(changes) - behind:]:
+            ids.update(entry)
+        return version, ids
+
+
+class Metrics:
+    """Counters and histograms in Prometheus text format.
+
+    Every gunicorn worker keeps its own values, labelled with its pid, so
+    sum over `worker` when querying. With `shared_dir` set, each worker
+    also writes its values there (at most every `flush_seconds`, after a
+    request) and render() includes those of the other live workers, so a
+    scrape that lands on any one worker sees them all.
+    """
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    ROUND_TRIP_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+    HELP = {
+        "medpanda_request_duration_seconds": ("histogram", "Request latency by endpoint."),
+        "medpanda_request_mongo_round_trips": ("histogram", "Mongo commands issued per request."),
+        "medpanda_mongo_commands_total": ("counter", "Mongo commands by endpoint and command."),
+        "medpanda_mongo_command_failures_total": ("counter", "Failed Mongo commands by endpoint and command."),
+        "medpanda_mongo_command_seconds_total": ("counter", "Time spent in Mongo commands by endpoint."),
+        "medpanda_mongo_documents_returned_total": ("counter", "Documents returned by Mongo by endpoint."),
+    }
+
+    def __init__(self, shared_dir=None, flush_seconds=1.0):
+        self.shared_dir = shared_dir
+        self.flush_seconds = flush_seconds
+        self._counters = {}
+        self._histograms = {}
+        self._flushed_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, labels, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets),
+                                                "sum": 0.0, "count": 0}
+            i = bisect.bisect_left(buckets, value)
+            if i < len(buckets):  # larger values only show up in +Inf
+                hist["counts"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    @staticmethod
+    def _labels(pairs):
+        def esc(v):
+            return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, labels, dict(hist, counts=list(hist["counts"]))]
+                               for (name, labels), hist in self._histograms.items()],
+            }
+
+    def flush(self, force=False):
+        """Write this worker's values to shared_dir, at most every flush_seconds."""
+        now = time.monotonic()
+        if not self.shared_dir or (not force and now - self._flushed_at < self.flush_seconds):
+            return
+        self._flushed_at = now
+        try:
+            os.makedirs(self.shared_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.shared_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as fh:
+                json.dump(self._snapshot(), fh)
+            os.replace(tmp, os.path.join(self.shared_dir, f"{os.getpid()}.json"))
+        except OSError as e:
+            logger.warning("Could not write metrics to %s: %r", self.shared_dir, e)
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass  # exists, owned by someone else
+        return True
+
+    def _peers(self):
+        """(pid, snapshot) for the other live workers that flushed to shared_dir."""
+        if not self.shared_dir or not os.path.isdir(self.shared_dir):
+            return []
+        peers = []
+        for entry in os.scandir(self.shared_dir):
+            pid = entry.name[:-len(".json")]
+            if not entry.name.endswith(".json") or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            if not self._alive(int(pid)):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(entry.path) as fh:
+                    peers.append((pid, json.load(fh)))
+            except (OSError, ValueError):
+                continue
+        return peers
+
+    def render(self):
+        counters, histograms = {}, {}
+        for pid, snapshot in [(str(os.getpid()), self._snapshot())] + self._peers():
+            worker = (("worker", pid),)
+            for name, labels, value in snapshot["counters"]:
+                counters[(name, tuple(map(tuple, labels)) + worker)] = value
+            for name, labels, hist in snapshot["histograms"]:
+                histograms[(name, tuple(map(tuple, labels)) + worker)] = hist
+        lines = []
+        for name, (kind, text) in self.HELP.items():
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+            for (metric, labels), hist in sorted(histograms.items(), key=lambda item: item[0]):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(hist["buckets"], hist["counts"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {hist['count']}")
+                lines.append(f"{name}_sum{self._labels(labels)} {hist['sum']}")
+                lines.append(f"{name}_count{self._labels(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# Endpoint of the AsyncReadAPI request running in the current task
+ASYNC_ENDPOINT = contextvars.ContextVar("medpanda_async_endpoint", default="-")
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """pymongo listener that attributes every command to the Flask endpoint.
+
+    pymongo calls listeners synchronously on the thread that issued the
+    command, so the request context is the one that caused it; commands
+    from AsyncReadAPI take the endpoint from ASYNC_ENDPOINT. Besides the
+    per-endpoint counters, per-request totals are kept in g.mongo_stats for
+    the round-trip histogram and the Server-Timing header.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    @staticmethod
+    def _documents(reply):
+        cursor = reply.get("cursor")
+        if isinstance(cursor, dict):
+            return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+        return 1 if reply.get("value") is not None else 0  # findAndModify
+
+    def _record(self, event, documents=0, failed=False):
+        endpoint = (request.endpoint or "-") if has_request_context() else ASYNC_ENDPOINT.get()
+        labels = {"endpoint": endpoint, "command": event.command_name}
+        seconds = event.duration_micros / 1e6
+        self.metrics.inc("medpanda_mongo_commands_total", labels)
+        if failed:
+            self.metrics.inc("medpanda_mongo_command_failures_total", labels)
+        self.metrics.inc("medpanda_mongo_command_seconds_total", {"endpoint": endpoint}, seconds)
+        if documents:
+            self.metrics.inc("medpanda_mongo_documents_returned_total", {"endpoint": endpoint}, documents)
+        if has_request_context():
+            stats = g.setdefault("mongo_stats", {"commands": 0, "seconds": 0.0})
+            stats["commands"] += 1
+            stats["seconds"] += seconds
+
+    def succeeded(self, event):
+        self._record(event, documents=self._documents(event.reply or {}))
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+
+class RenderCache:
+    """Per-process cache of rendered pages keyed by name.
+
+    Like FacetCache: invalidate() drops every entry at once by bumping the
+    version, and entries expire after `ttl_seconds` so that writes made
+    by other workers show up.
+    """
+
+    def __init__(self, ttl_seconds=30):
+        self.ttl_seconds = ttl_seconds
+        self.version = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def get(self, key, render):
+        now = datetime.utcnow()
+        with self._lock:
+            version = self.version
+            entry = self._entries.get(key)
+            if entry and entry[1] == version and now - entry[2] <= timedelta(seconds=self.ttl_seconds):
+                return entry[0]
+        body = render()
+        with self._lock:
+            if self.version == version:
+                self._entries[key] = (body, version, now)
+        return body
+
+
+class IdentityCache:
+    """Per-process LRU of owner -> profile id lookups with a TTL.
+
+    Keys are (kind, user_id) tuples such as ("pharmacy", uid). Misses are
+    not cached, so a profile created after the first lookup is picked up
+    on the next request. Profile writes call invalidate(); the TTL bounds
+    staleness for writes made by other workers.
+    """
+
+    def __init__(self, maxsize=4096, ttl_seconds=300):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def peek(self, key):
+        """The cached value, or None on a miss or an expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and datetime.utcnow() - entry[1] <= timedelta(seconds=self.ttl_seconds):
+                self._entries.move_to_end(key)
+                return entry[0]
+        return None
+
+    def put(self, key, value):
+        if value is None:
+            return value
+        with self._lock:
+            self._entries[key] = (value, datetime.utcnow())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def get(self, key, loader):
+        value = self.peek(key)
+        return value if value is not None else self.put(key, loader())
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+class FacetCache:
+    """Per-process cache of the search filter facets.
+
+    Category and pharmacy counts over active medicines come from a single
+    $facet aggregation; the active pharmacy list is loaded alongside.
+    Medicine and pharmacy writes call invalidate(), which bumps the local
+    version. get() is passed the shared version stamps and reloads when
+    they move, so writes made by other workers show up under the ETag that
+    announces them; entries also expire after `ttl_seconds`.
+    """
+
+    def __init__(self, ttl_seconds=60):
+        self.ttl_seconds = ttl_seconds
+        self.version = 0
+        self._facets = None
+        self._loaded_version = None
+        self._loaded_stamp = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+
+    def _load(self, db):
+        agg = list(db.medicines.aggregate([
+            {"$match": {"is_active": True}},
+            {"$facet": {
+                "categories": [{"$group": {"_id": "$category", "count": {"$sum": 1}}}],
+                "pharmacies": [{"$group": {"_id": "$pharmacy_id", "count": {"$sum": 1}}}],
+            }},
+        ]))
+        facets = agg[0] if agg else {"categories": [], "pharmacies": []}
+        category_counts = {c["_id"]: c["count"] for c in facets["categories"] if c["_id"]}
+        return {
+            "categories": sorted(category_counts),
+            "category_counts": category_counts,
+            "pharmacies": list(db.pharmacies.find({"is_active": True}, {"name": 1, "_id": 1})),
+            "pharmacy_counts": {str(p["_id"]): p["count"] for p in facets["pharmacies"] if p["_id"]},
+        }
+
+    def get(self, db, stamp=None):
+        with self._lock:
+            version = self.version
+            fresh = (
+                self._facets is not None
+                and self._loaded_version == version
+                and self._loaded_stamp == stamp
+                and datetime.utcnow() - self._loaded_at <= timedelta(seconds=self.ttl_seconds)
+            )
+            if fresh:
+                return self._facets
+        facets = self._load(db)
+        with self._lock:
+            self._facets, self._loaded_version, self._loaded_stamp = facets, version, stamp
+            self._loaded_at = datetime.utcnow()
+        return facets
 
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in app.config["ALLOWED_EXTENSIONS"]
 
+# Resized copies written for every upload: name -> bounding box in pixels
+MEDICINE_IMAGE_VARIANTS = {"thumb": 96, "card": 320, "detail": 800}
+MEDICINE_IMAGE_DEFAULT_VARIANT = "card"
+# Files written by save_medicine_image(); gc-images only ever removes these
+MEDICINE_IMAGE_VARIANT_FILE = re.compile(
+    r"^[0-9a-f]{64}_(%s)\.jpg(\.[0-9a-f]{32}\.tmp)?$" % "|".join(MEDICINE_IMAGE_VARIANTS)
+)
+
+
 def save_medicine_image(file):
-    if not file:
+    """Store an uploaded medicine image as resized JPEG variants.
+
+    Files are named after the SHA-256 of the uploaded bytes, so uploading
+    the same picture twice reuses the files already on disk. Returns the
+    medicine fields to store (image_path for the default variant and
+    image_variants with each variant's path and width), or None when the
+    upload is missing, not an allowed type or not a readable image.
+    """
+    if not file or not allowed_file(file.filename):
         return None
-    
-    if file and allowed_file(file.filename):
-        # Generate a unique filename using hash of original name and timestamp
-        filename = secure_filename(file.filename)
-        name, ext = os.path.splitext(filename)
-        hash_name = hashlib.md5(f"{name}{datetime.utcnow()}".encode()).hexdigest()
-        new_filename = f"{hash_name}{ext}"
-        
-        file_path = os.path.join(app.config["UPLOAD_FOLDER"], new_filename)
-        file.save(file_path)
-        
-        # Return the relative path for database storage
-        return f"images/medicines/{new_filename}"
+
+    data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        source = Image.open(io.BytesIO(data))
+        source = ImageOps.exif_transpose(source)
+        if source.mode in ("RGBA", "LA", "P"):
+            source = source.convert("RGBA")
+            background = Image.new("RGB", source.size, (255, 255, 255))
+            background.paste(source, mask=source.getchannel("A"))
+            source = background
+        else:
+            source = source.convert("RGB")
+    except Exception:
+        return None
+
+    variants = {}
+    for name, box in sorted(MEDICINE_IMAGE_VARIANTS.items(), key=lambda item: item[1]):
+        img = source.copy()
+        img.thumbnail((box, box), Image.LANCZOS)
+        # thumbnail() never upscales: a box wider than the source repeats the
+        # previous variant, so point at that file instead of writing a copy
+        same = next((v for v in variants.values() if v["width"] == img.width), None)
+        if same:
+            variants[name] = dict(same)
+            continue
+        filename = f"{digest}_{name}.jpg"
+        file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+        if not os.path.exists(file_path):
+            # Write then rename so concurrent uploads never see half a file
+            tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+            img.save(tmp_path, "JPEG", quality=82, optimize=True, progressive=True)
+            os.replace(tmp_path, file_path)
+        variants[name] = {"path": f"images/medicines/{filename}", "width": img.width}
+
+    return {
+        "image_path": variants[MEDICINE_IMAGE_DEFAULT_VARIANT]["path"],
+        "image_variants": variants,
+    }
+
+
+def image_srcset(med):
+    """srcset value for a medicine's image variants ("" for legacy uploads).
+
+    Variants that came out at the same real width (a small source is never
+    upscaled) are listed once.
+    """
+    variants = (med or {}).get("image_variants") or {}
+    by_width = {}
+    for v in sorted(variants.values(), key=lambda v: v["width"]):
+        by_width.setdefault(v["width"], v)
+    return ", ".join(f"{url_for('static', filename=v['path'])} {width}w" for width, v in by_width.items())
+
+
+def collect_unreferenced_images(db, folder, min_age_seconds=3600, dry_run=False):
+    """Delete generated image variants in the upload folder that no medicine references.
+
+    Only files named like save_medicine_image() output are considered, so
+    legacy uploads and images committed with the app are never touched.
+    Files younger than `min_age_seconds` are kept so that an upload whose
+    medicine has not been inserted yet is not removed. Returns the list of
+    file names that were (or, with dry_run, would be) deleted.
+    """
+    referenced = set()
+    for med in db.medicines.find(
+        {"$or": [{"image_path": {"$ne": None}}, {"image_variants": {"$exists": True}}]},
+        {"image_path": 1, "image_variants": 1},
+    ):
+        if med.get("image_path"):
+            referenced.add(os.path.basename(med["image_path"]))
+        for variant in (med.get("image_variants") or {}).values():
+            referenced.add(os.path.basename(variant["path"]))
+
+    cutoff = time.time() - min_age_seconds
+    removed = []
+    for entry in os.scandir(folder):
+        if not entry.is_file() or entry.name in referenced:
+            continue
+        if not MEDICINE_IMAGE_VARIANT_FILE.match(entry.name):
+            continue
+        if entry.stat().st_mtime > cutoff:
+            continue
+        removed.append(entry.name)
+        if not dry_run:
+            os.remove(entry.path)
+    return removed
+
+# Read endpoints served both by the Flask views and by AsyncReadAPI.
+# Each keeps its query and response shaping here so the two stay identical.
+def catalog_etag_value(version, listing_version, full_path, session_data):
+    """ETag for a catalog response: both version stamps plus what else the page depends on."""
+    user = session_data.get("user") or {}
+    state = f"{full_path}|{user.get('_id')}|{session_data.get('cart_count')}"
+    return f"{version}.{listing_version}-{hashlib.sha1(state.encode()).hexdigest()[:16]}"
+
+
+def medicine_api_rows(index, q):
+    """/api/medicines: name matches from the in-memory search index, JSON-ready."""
+    meds = index.search(q.strip(), fields=("name",), limit=50)
+    for m in meds:
+        m["_id"] = str(m["_id"])
+        if m.get("pharmacy_id"):
+            m["pharmacy_id"] = str(m["pharmacy_id"])
+    return meds
+
+
+# /get_users_by_role/<role>: role -> (collection, filter, projection)
+USERS_BY_ROLE_QUERIES = {
+    "pharmacy": ("pharmacies", {}, {"business_name": 1, "name": 1, "pharmacy_name": 1}),
+    "delivery": ("users", {"role": "delivery"}, {"username": 1, "name": 1, "email": 1}),
+    "customer": ("users", {"role": "customer"}, {"username": 1, "name": 1, "email": 1}),
+    "other": ("users", {"role": {"$nin": ["admin"]}}, {"name": 1, "email": 1, "role": 1}),
+}
+
+
+def users_by_role_query(role):
+    return USERS_BY_ROLE_QUERIES.get(role)
+
+
+def users_by_role_row(role, doc):
+    if role == "pharmacy":
+        name = doc.get("business_name") or doc.get("name") or doc.get("pharmacy_name", "Unknown Pharmacy")
+    elif role == "other":
+        return {"_id": str(doc["_id"]), "name": f"{doc['name']} ({doc['role']} - {doc['email']})", "role": doc["role"]}
+    else:
+        name = f"{doc.get('username') or doc.get('name', 'Unknown')} ({doc.get('email', 'No email')})"
+    return {"_id": str(doc["_id"]), "name": name, "role": role}
+
+
+ORDER_STATUS_FIELDS = {"status": 1, "updated_at": 1, "assigned_delivery_id": 1}
+
+ORDER_STATUSES = ["Pending", "Processing", "Ready for Delivery", "Out for Delivery", "Delivered", "Cancelled"]
+# Statuses an admin (or the order's staff) may still cancel from
+ORDER_CANCELLABLE_STATUSES = ["Pending", "Processing", "Ready for Delivery", "Out for Delivery"]
+
+
+def order_access_filter(user, owned_pharmacy_ids=()):
+    """Conditions an order must meet for `user` to see it, or None for no access.
+
+    Customers see their own orders, pharmacies any order that includes one
+    of the pharmacies they own, delivery staff the orders assigned to them
+    and admins every order. Shared by order_detail and the status endpoints.
+    """
+    role, uid = user.get("role"), ObjectId(user["_id"])
+    if role == "user":
+        return {"user_id": uid}
+    if role == "pharmacy":
+        if not owned_pharmacy_ids:
+            return None
+        return {"pharmacy_ids": {"$in": list(owned_pharmacy_ids)}}
+    if role == "delivery":
+        return {"assigned_delivery_id": uid}
+    if role == "admin":
+        return {}
     return None
 
+
+def order_status_filter(order_id, user, owned_pharmacy_ids=()):
+    """Filter for order `order_id` if `user` may see it, else None."""
+    try:
+        oid = ObjectId(order_id)
+    except Exception:
+        return None
+    access = order_access_filter(user, owned_pharmacy_ids)
+    if access is None:
+        return None
+    return {"_id": oid, **access}
+
+
+def order_status_payload(order):
+    updated_at = order.get("updated_at")
+    return {
+        "ok": True,
+        "_id": str(order["_id"]),
+        "status": order.get("status"),
+        "updated_at": updated_at.isoformat() if updated_at else None,
+        "delivery_assigned": bool(order.get("assigned_delivery_id")),
+    }
+
+
+class AsyncReadAPI:
+    """ASGI entry point for the opt-in async serving mode.
+
+    `uvicorn app:asgi_app` serves /api/medicines, /get_users_by_role/<role>,
+    /health and /api/orders/<id>/status on the event loop with an
+    AsyncMongoClient, so one worker keeps many slow Mongo round trips in
+    flight instead of blocking a thread on each. Every other request goes
+    to the Flask app through a WSGI adapter (thread pool). The endpoints
+    reuse the Flask app's session cookie, caches and query helpers above;
+    the Mongo client is created once, in the server's loop, at lifespan
+    startup (or by the first request when the server sends no lifespan).
+    Needs `pymongo>=4.13`, `asgiref` and `uvicorn`.
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.db = None
+        self.wsgi = None
+        self._client_lock = asyncio.Lock()
+        self.routes = [
+            (re.compile(r"^/api/medicines$"), "api_medicines", self.api_medicines),
+            (re.compile(r"^/get_users_by_role/(?P<role>[^/]+)$"), "get_users_by_role", self.users_by_role),
+            (re.compile(r"^/health$"), "health", self.health),
+            (re.compile(r"^/api/orders/(?P<order_id>[^/]+)/status$"), "api_order_status", self.order_status),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if AsyncMongoClient is None or WsgiToAsgi is None:
+            raise RuntimeError("The async serving mode needs pymongo>=4.13 and asgiref installed.")
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        await self._connect()
+        if scope["type"] == "http" and scope["method"] == "GET":
+            for pattern, endpoint, handler in self.routes:
+                match = pattern.match(scope["path"])
+                if match:
+                    return await self._dispatch(scope, receive, send, endpoint, handler, match.groupdict())
+        await self.wsgi(scope, receive, send)
+
+    async def _connect(self):
+        if self.db is not None:
+            return
+        # Concurrent first requests must not each build (and leak) a client
+        async with self._client_lock:
+            if self.db is None:
+                client = AsyncMongoClient(self.app.config["MONGO_URI"],
+                                          event_listeners=[MongoCommandMetrics(self.app.metrics)])
+                self.wsgi = WsgiToAsgi(self.app)
+                self.db = client[self.app.db.name]
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self._connect()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _session(self, scope):
+        cookies = http.cookies.SimpleCookie()
+        for name, value in scope.get("headers", []):
+            if name == b"cookie":
+                cookies.load(value.decode("latin-1"))
+        morsel = cookies.get(self.app.config["SESSION_COOKIE_NAME"])
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        if not morsel or serializer is None:
+            return {}
+        try:
+            max_age = int(self.app.permanent_session_lifetime.total_seconds())
+            return serializer.loads(morsel.value, max_age=max_age)
+        except Exception:
+            return {}
+
+    async def _dispatch(self, scope, receive, send, endpoint, handler, params):
+        # A handler returns None to hand the request to the Flask view
+        # (logged out, pending flashes), which already gets those right
+        started = time.perf_counter()
+        token = ASYNC_ENDPOINT.set(endpoint)
+        try:
+            result = await handler(scope, self._session(scope), **params)
+        finally:
+            ASYNC_ENDPOINT.reset(token)
+        if result is None:
+            return await self.wsgi(scope, receive, send)
+        status, payload, headers = result
+        body = b"" if payload is None else self.app.json.dumps(payload).encode()
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + [
+            (k.encode(), v.encode()) for k, v in headers
+        ]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+        self.app.metrics.observe("medpanda_request_duration_seconds",
+                                 {"endpoint": endpoint, "method": "GET", "status": str(status)},
+                                 time.perf_counter() - started, Metrics.LATENCY_BUCKETS)
+        self.app.metrics.flush()
+
+    async def api_medicines(self, scope, session_data):
+        if session_data.get("_flashes"):
+            return None
+        query = scope.get("query_string", b"").decode("latin-1")
+        version = await self.app.catalog_version.current_async(self.db)
+        listing_version = await self.app.listing_version.current_async(self.db)
+        full_path = f"{scope['path']}?{query}"
+        etag = f'"{catalog_etag_value(version, listing_version, full_path, session_data)}"'
+        headers = [("etag", etag), ("cache-control", "private, no-cache")]
+        for name, value in scope.get("headers", []):
+            if name == b"if-none-match" and etag in value.decode("latin-1"):
+                return 304, None, headers
+        index = self.app.search_index
+        if not index.is_fresh(version, listing_version):
+            # Shares the index's rebuild lock with the Flask views
+            await asyncio.to_thread(index.ensure_fresh, self.app.db, version, listing_version)
+        q = urllib.parse.parse_qs(query).get("q", [""])[0]
+        return 200, medicine_api_rows(index, q), headers
+
+    async def users_by_role(self, scope, session_data, role):
+        if not session_data.get("user"):
+            return None
+        query = users_by_role_query(role)
+        if not query:
+            return 200, [], []
+        collection, filt, projection = query
+        docs = await self.db[collection].find(filt, projection).to_list(None)
+        return 200, [users_by_role_row(role, doc) for doc in docs], []
+
+    async def health(self, scope, session_data):
+        try:
+            await self.db.command("ping")
+            return 200, {"status": "healthy", "database": "connected",
+                         "timestamp": datetime.utcnow().isoformat()}, []
+        except Exception as e:
+            return 500, {"status": "unhealthy", "database": "disconnected", "error": str(e),
+                         "timestamp": datetime.utcnow().isoformat()}, []
+
+    async def order_status(self, scope, session_data, order_id):
+        if not session_data.get("user"):
+            return None
+        user = session_data["user"]
+        owned = ()
+        if user.get("role") == "pharmacy":
+            key = ("pharmacies", ObjectId(user["_id"]))
+            owned = self.app.identity_cache.peek(key)
+            if owned is None:
+                docs = await self.db.pharmacies.find({"owner_id": key[1]}, {"_id": 1}).to_list(None)
+                owned = self.app.identity_cache.put(key, tuple(doc["_id"] for doc in docs) or None)
+        filt = order_status_filter(order_id, user, owned)
+        order = await self.db.orders.find_one(filt, ORDER_STATUS_FIELDS) if filt else None
+        if not order:
+            return 404, {"ok": False, "msg": "Order not found"}, []
+        return 200, order_status_payload(order), []
+
+
 def create_default_admin(db):
     # Check if admin user already exists
     admin_user = db.users.find_one({"email": "admin@medpanda.com"})
@@ -2360,6 +4968,12 @@ def create_default_admin(db):
 
 
 app = create_app()
+# Opt-in async serving mode: `uvicorn app:asgi_app` (see AsyncReadAPI)
+asgi_app = AsyncReadAPI(app)
 
 if __name__ == "__main__":
+    # Local development: apply migrations before serving, and run
+    # background jobs in the request since no worker is running
+    migrate(app.db)
+    app.jobs.inline = True
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,405 @@
+"""Synthetic data and benchmarks for MedPanda.
+
+Used by `flask medpanda generate-data`, `bench`, `bench-read` and
+`audit-indexes`. The CLI imports this module on demand, so web workers
+never load it.
+"""
+import asyncio
+import http.cookiejar
+import math
+import os
+import random
+import re
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from app import (
+    CatalogVersion,
+    next_occurrence,
+    rebuild_entity_counters,
+    rebuild_rating_aggregates,
+    schedule_search_terms,
+)
+
+SYNTHETIC_DOMAIN = "synthetic.test"
+SYNTHETIC_PASSWORD = "password"
+SYNTHETIC_CATEGORIES = ["Pain Relief", "Vitamins", "Antibiotics", "First Aid", "Skincare",
+                        "Antacid", "Allergy", "Cardiac", "Diabetes"]
+SYNTHETIC_STEMS = ["Napa", "Ace", "Ciprocin", "Seclo", "Fexo", "Losectil", "Maxpro", "Alatrol",
+                   "Monas", "Ceevit", "Calbo", "Zimax", "Amodis", "Bizoran", "Osartil", "Comet"]
+
+
+def _zipf_weights(n, s=1.1):
+    return [1.0 / (rank + 1) ** s for rank in range(n)]
+
+
+def _insert_batches(collection, docs, batch_size=1000):
+    ids = []
+    for i in range(0, len(docs), batch_size):
+        ids += collection.insert_many(docs[i:i + batch_size]).inserted_ids
+    return ids
+
+
+def generate_synthetic_data(db, pharmacies=20, medicines_per_pharmacy=50, customers=500, couriers=30,
+                            orders=5000, seed=42):
+    """Insert a reproducible synthetic dataset into `db`.
+
+    Medicine popularity and orders per customer are Zipf-like (a few
+    bestsellers and heavy buyers), prices are log-normal, and orders have
+    1-4 lines from a single pharmacy. Order times are skewed towards the
+    last few weeks, with status following age. About 40% of delivered
+    orders get a pharmacy review and 25% a delivery review. Users are
+    <role><n>@synthetic.test with password SYNTHETIC_PASSWORD. Stored
+    counters and rating aggregates are rebuilt at the end. Returns the
+    number of documents inserted per collection.
+    """
+    if db.users.find_one({"email": {"$regex": f"@{re.escape(SYNTHETIC_DOMAIN)}$"}}, {"_id": 1}):
+        raise ValueError("Synthetic data already present; drop the database first.")
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+    password = generate_password_hash(SYNTHETIC_PASSWORD)
+
+    def user(role, i):
+        return {"name": f"{role.title()} {i}", "email": f"{role}{i}@{SYNTHETIC_DOMAIN}", "password": password,
+                "role": role, "is_active": True, "created_at": now - timedelta(days=rnd.randint(0, 365))}
+
+    _insert_batches(db.users, [user("admin", 0)])
+    owner_ids = _insert_batches(db.users, [user("pharmacy", i) for i in range(pharmacies)])
+    pharmacy_ids = _insert_batches(db.pharmacies, [{
+        "owner_id": owner_id, "name": f"Pharmacy {i}", "address": f"{i} Synthetic Road",
+        "phone": f"01{i:09d}", "is_active": rnd.random() < 0.95, "rating_avg": 0.0, "rating_count": 0,
+        "created_at": now - timedelta(days=rnd.randint(30, 365)),
+    } for i, owner_id in enumerate(owner_ids)])
+    courier_ids = _insert_batches(db.users, [user("delivery", i) for i in range(couriers)])
+    _insert_batches(db.delivery_profiles, [{
+        "user_id": uid, "vehicle_type": rnd.choice(["Bike", "Bicycle", "Car"]), "phone": "",
+        "license_number": "", "is_available": rnd.random() < 0.7, "current_location": "",
+        "rating_avg": 0.0, "rating_count": 0, "created_at": now,
+        "last_requested_at": now - timedelta(minutes=rnd.randint(0, 24 * 60)),
+    } for uid in courier_ids])
+    customer_ids = _insert_batches(db.users, [user("user", i) for i in range(customers)])
+
+    meds = []
+    for pharmacy_id in pharmacy_ids:
+        for _ in range(medicines_per_pharmacy):
+            category = rnd.choice(SYNTHETIC_CATEGORIES)
+            meds.append({
+                "name": f"{rnd.choice(SYNTHETIC_STEMS)} {rnd.choice([5, 10, 20, 50, 100, 250, 500])}mg",
+                "category": category, "price": round(rnd.lognormvariate(4.0, 0.8), 2),
+                "stock": 0 if rnd.random() < 0.05 else rnd.randint(1, 500), "pharmacy_id": pharmacy_id,
+                "is_active": rnd.random() < 0.95, "image_path": None,
+                "created_at": now - timedelta(days=rnd.randint(0, 180)),
+            })
+    for med, _id in zip(meds, _insert_batches(db.medicines, meds)):
+        med["_id"] = _id
+    by_pharmacy = {}
+    for med in meds:
+        by_pharmacy.setdefault(med["pharmacy_id"], []).append(med)
+    popular = meds[:]
+    rnd.shuffle(popular)
+    med_weights = _zipf_weights(len(popular))
+    customer_weights = _zipf_weights(len(customer_ids), 0.8)
+
+    order_docs, requests, reviews = [], [], []
+    for _ in range(orders):
+        first = rnd.choices(popular, med_weights)[0]
+        lines = [first] + rnd.sample(by_pharmacy[first["pharmacy_id"]], rnd.choice([0, 0, 1, 1, 2, 3]))
+        items = []
+        for med in {m["_id"]: m for m in lines}.values():
+            qty = rnd.randint(1, 3)
+            items.append({"medicine_id": med["_id"], "name": med["name"], "category": med["category"],
+                          "unit_price": med["price"], "qty": qty, "line_total": round(med["price"] * qty, 2)})
+        age = timedelta(minutes=min(rnd.expovariate(1 / (20 * 24 * 60)), 90 * 24 * 60))
+        if age < timedelta(hours=1):
+            status = "Processing"
+        elif age < timedelta(days=1):
+            status = rnd.choice(["Processing", "Ready for Delivery", "Out for Delivery"])
+        else:
+            status = rnd.choices(["Delivered", "Cancelled", "Processing"], [85, 10, 5])[0]
+        courier = rnd.choice(courier_ids) if status in ("Out for Delivery", "Delivered") else None
+        created_at = now - age
+        order_docs.append({
+            "user_id": rnd.choices(customer_ids, customer_weights)[0], "customer_name": "",
+            "phone_number": "", "notes": "", "items": items,
+            "total": round(sum(i["line_total"] for i in items), 2), "address": "Synthetic address",
+            "status": status, "pharmacy_ids": [first["pharmacy_id"]], "assigned_delivery_id": courier,
+            "created_at": created_at, "updated_at": created_at,
+        })
+    order_ids = _insert_batches(db.orders, order_docs)
+
+    for order, order_id in zip(order_docs, order_ids):
+        if order["status"] in ("Ready for Delivery", "Out for Delivery", "Delivered"):
+            asked = rnd.sample(courier_ids, min(len(courier_ids), rnd.randint(1, 5)))
+            if order["assigned_delivery_id"] and order["assigned_delivery_id"] not in asked:
+                asked[0] = order["assigned_delivery_id"]
+            for courier in asked:
+                if order["status"] == "Ready for Delivery":
+                    state = "pending"
+                else:
+                    state = "accepted" if courier == order["assigned_delivery_id"] else "rejected"
+                requests.append({
+                    "order_id": order_id, "delivery_user_id": courier, "delivery_user_name": "",
+                    "pharmacy_id": order["pharmacy_ids"][0], "status": state,
+                    "requested_at": order["created_at"], "responded_at": None if state == "pending" else order["created_at"],
+                    "order_details": {"total": order["total"], "items_count": len(order["items"]),
+                                      "address": order["address"]},
+                })
+        if order["status"] == "Delivered":
+            stars = lambda: rnd.choices([1, 2, 3, 4, 5], [3, 4, 10, 35, 48])[0]
+            if rnd.random() < 0.4:
+                reviews.append({"user_id": order["user_id"], "rating": stars(), "comment": "", "type": "pharmacy",
+                                "pharmacy_id": order["pharmacy_ids"][0], "created_at": order["created_at"]})
+            if rnd.random() < 0.25:
+                reviews.append({"user_id": order["user_id"], "rating": stars(), "comment": "", "type": "delivery",
+                                "delivery_person_id": str(order["assigned_delivery_id"]),
+                                "created_at": order["created_at"]})
+    _insert_batches(db.delivery_requests, requests)
+    _insert_batches(db.reviews, reviews)
+
+    complaints = [{
+        "subject": "Late delivery", "against_role": rnd.choice(["pharmacy", "delivery"]), "description": "",
+        "complainant_id": uid, "complainant_role": "user", "status": rnd.choice(["pending", "resolved"]),
+        "created_at": now - timedelta(days=rnd.randint(0, 90)), "updated_at": now,
+    } for uid in customer_ids if rnd.random() < 0.05]
+    _insert_batches(db.complaints, complaints)
+    schedules = []
+    for uid in customer_ids:
+        if rnd.random() < 0.2:
+            start = now - timedelta(days=rnd.randint(0, 60), minutes=rnd.randint(0, 24 * 60))
+            frequency = rnd.choice(["daily", "weekly", "weekly", "monthly"])
+            picked = rnd.sample(popular[:200], rnd.randint(1, 3))
+            schedules.append({
+                "user_id": uid, "frequency": frequency, "medicines": [m["name"] for m in picked],
+                "search_terms": schedule_search_terms([m["name"] for m in picked]), "notes": "",
+                "action": rnd.choice(["reminder", "cart"]), "start_date": start,
+                "next_run_at": next_occurrence(start, frequency, now), "created_at": start,
+            })
+    _insert_batches(db.schedules, schedules)
+
+    rebuild_entity_counters(db)
+    rebuild_rating_aggregates(db)
+    CatalogVersion().bump(db)
+    return {
+        "users": 1 + len(owner_ids) + len(courier_ids) + len(customer_ids), "pharmacies": len(pharmacy_ids),
+        "medicines": len(meds), "orders": len(order_ids), "delivery_requests": len(requests),
+        "reviews": len(reviews), "complaints": len(complaints), "schedules": len(schedules),
+    }
+
+
+class _HttpBenchClient:
+    """Minimal stand-in for Flask's test client that talks to a live server."""
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(self.cookies), self._NoRedirect()
+        )
+
+    def open(self, path, method="GET", data=None):
+        body = urllib.parse.urlencode(data or {}, doseq=True).encode() if method == "POST" else None
+        req = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            resp = self.opener.open(req, timeout=30)
+        except urllib.error.HTTPError as e:
+            resp = e
+        resp.read()
+        resp.status_code = resp.status if hasattr(resp, "status") else resp.code
+        return resp
+
+
+def _percentile(sorted_values, pct):
+    # Nearest rank: the ceil(pct/100 * n)-th smallest value (1-based)
+    if not sorted_values:
+        return None
+    rank = min(len(sorted_values), max(1, math.ceil(pct / 100 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def _bench_customer(req, sample, rnd):
+    med = rnd.choice(sample["medicines"])
+    prefix = med["name"][:3].lower()
+    req("search", "GET", f"/search?q={urllib.parse.quote(prefix)}")
+    req("api_medicines", "GET", f"/api/medicines?q={urllib.parse.quote(prefix)}")
+    req("cart_add", "POST", "/cart/add", {"med_id": str(med["_id"]), "qty": "1"})
+    req("cart_view", "GET", "/cart")
+    req("checkout_select", "POST", "/checkout", {"selected_items": [str(med["_id"])]})
+    resp = req("checkout_place", "POST", "/checkout", {"address": "Benchmark address"})
+    location = resp.headers.get("Location") or ""
+    match = re.search(r"/orders/([0-9a-f]{24})$", location)
+    if match:
+        req("order_detail", "GET", f"/orders/{match.group(1)}")
+    req("orders_list", "GET", "/orders")
+
+
+def _bench_pharmacy(req, sample, rnd):
+    req("pharmacy_dashboard", "GET", "/pharmacy/dashboard")
+    req("orders_list", "GET", "/orders")
+
+
+def _bench_admin(req, sample, rnd):
+    req("admin_pharmacies", "GET", "/admin/pharmacies")
+    req("admin_customers", "GET", "/admin/customers")
+    req("admin_complaints", "GET", "/admin/complaints")
+    req("admin_delivery_personnel", "GET", "/delivery/view")
+
+
+# Virtual user mix: (role, flow, share of the users)
+BENCH_FLOWS = [("user", _bench_customer, 6), ("pharmacy", _bench_pharmacy, 1), ("admin", _bench_admin, 1)]
+
+
+def run_benchmark(make_client, db, users=8, iterations=10, seed=42):
+    """Drive the main flows with `users` concurrent virtual users.
+
+    `make_client()` returns a fresh client with its own cookie jar (the
+    Flask test client, or _HttpBenchClient for a live server). Each user
+    logs in as a distinct synthetic account and runs its flow `iterations`
+    times. Mongo round trips come from the Server-Timing header, so the
+    server must run with SERVER_TIMING=1. Returns the JSON-ready report.
+    """
+    sample = {"medicines": list(db.medicines.find(
+        {"is_active": True, "stock": {"$gt": 10}}, {"_id": 1, "name": 1}).limit(500))}
+    if not sample["medicines"]:
+        raise ValueError("No medicines in stock; run `flask medpanda generate-data` first.")
+    roles = []
+    for role, flow, share in BENCH_FLOWS:
+        roles += [(role, flow)] * share
+    emails = {role: [u["email"] for u in db.users.find(
+        {"role": role, "email": {"$regex": f"@{re.escape(SYNTHETIC_DOMAIN)}$"}}, {"email": 1}).limit(users)]
+        for role, _, _ in BENCH_FLOWS}
+
+    samples = []
+    lock = threading.Lock()
+
+    def virtual_user(n):
+        rnd = random.Random(seed + n)
+        role, flow = roles[n % len(roles)]
+        if not emails[role]:
+            return
+        client = make_client()
+        email = emails[role][n % len(emails[role])]
+        client.open("/login", method="POST", data={"email": email, "password": SYNTHETIC_PASSWORD})
+
+        def req(route, method, path, data=None):
+            started = time.perf_counter()
+            resp = client.open(path, method=method, data=data)
+            elapsed = time.perf_counter() - started
+            timing = re.search(r'desc="(\d+) commands"', resp.headers.get("Server-Timing", ""))
+            with lock:
+                samples.append((route, elapsed, resp.status_code, int(timing.group(1)) if timing else None))
+            return resp
+
+        for _ in range(iterations):
+            flow(req, sample, rnd)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=virtual_user, args=(n,)) for n in range(users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    def summarize(rows):
+        latencies = sorted(r[1] * 1000 for r in rows)
+        trips = [r[3] for r in rows if r[3] is not None]
+        return {
+            "requests": len(rows),
+            "errors": sum(1 for r in rows if r[2] >= 500),
+            "p50_ms": _percentile(latencies, 50),
+            "p95_ms": _percentile(latencies, 95),
+            "p99_ms": _percentile(latencies, 99),
+            "mean_ms": sum(latencies) / len(latencies) if latencies else None,
+            "throughput_rps": len(rows) / wall if wall else None,
+            "mongo_round_trips_mean": sum(trips) / len(trips) if trips else None,
+        }
+
+    routes = {}
+    for row in samples:
+        routes.setdefault(row[0], []).append(row)
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "started_at": datetime.utcnow().isoformat(),
+        "config": {"users": users, "iterations": iterations, "seed": seed},
+        "wall_seconds": wall,
+        "total": summarize(samples),
+        "routes": {route: summarize(rows) for route, rows in sorted(routes.items())},
+    }
+
+
+async def _read_bench_connection(host, port, requests_, deadline, samples):
+    # One keep-alive HTTP/1.1 connection issuing requests back to back
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        i = 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            writer.write(requests_[i % len(requests_)])
+            await writer.drain()
+            head = await reader.readuntil(b"\r\n\r\n")
+            status = int(head.split(b" ", 2)[1])
+            length = re.search(rb"(?i)\r\ncontent-length:\s*(\d+)", head)
+            if length:
+                await reader.readexactly(int(length.group(1)))
+            samples.append((time.perf_counter() - started, status))
+            i += 1
+            if not length or re.search(rb"(?i)\r\nconnection:\s*close", head):
+                break
+    except (OSError, asyncio.IncompleteReadError):
+        samples.append((None, 0))
+    finally:
+        writer.close()
+
+
+def run_read_benchmark(base_url, paths, levels, duration=10.0, cookie=None):
+    """Hammer read endpoints of a running server at each concurrency level.
+
+    For every level in `levels`, that many keep-alive connections request
+    `paths` round-robin for `duration` seconds. Run it against one
+    `gunicorn -w 1 app:app` worker and one `uvicorn app:asgi_app` worker
+    to compare how throughput per worker scales with connections.
+    """
+    url = urllib.parse.urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+    extra = f"Cookie: {cookie}\r\n" if cookie else ""
+    requests_ = [f"GET {path} HTTP/1.1\r\nHost: {url.netloc}\r\n{extra}\r\n".encode() for path in paths]
+    results = []
+    for connections in levels:
+        samples = []
+
+        async def level():
+            deadline = time.perf_counter() + duration
+            await asyncio.gather(*[
+                _read_bench_connection(host, port, requests_, deadline, samples) for _ in range(connections)
+            ])
+
+        started = time.perf_counter()
+        asyncio.run(level())
+        wall = time.perf_counter() - started
+        latencies = sorted(s[0] * 1000 for s in samples if s[0] is not None)
+        results.append({
+            "connections": connections,
+            "requests": len(latencies),
+            "errors": sum(1 for s in samples if s[0] is None or s[1] >= 500),
+            "throughput_rps": len(latencies) / wall if wall else None,
+            "p50_ms": _percentile(latencies, 50),
+            "p95_ms": _percentile(latencies, 95),
+            "p99_ms": _percentile(latencies, 99),
+        })
+    return {"base_url": base_url, "paths": paths, "duration_seconds": duration, "levels": results}
@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the app module from the repository root. It connects lazily
+# (connect=False), so the import needs no running MongoDB.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A fresh in-memory database (mongomock) for helpers that take `db`."""
+    mongomock = pytest.importorskip("mongomock")
+    import mongomock.collection
+
+    # pymongo >= 4.9 passes sort= to the bulk builders; mongomock does not take it
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ("add_update", "add_replace"):
+        def without_sort(self, *args, _original=getattr(builder, name), sort=None, **kwargs):
+            return _original(self, *args, **kwargs)
+        monkeypatch.setattr(builder, name, without_sort)
+    return mongomock.MongoClient().medpanda
@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from app import (
+    PAGE_SIZE_DEFAULT, decode_cursor, encode_cursor, keyset_cursor, keyset_page, keyset_slice,
+)
+
+
+def _walk(fetch):
+    """Follow next tokens from the first page; return the pages' ids and the last page."""
+    pages, page = [], fetch(None, None)
+    while True:
+        pages.append([row["_id"] for row in page["items"]])
+        if not page["next"]:
+            return pages, page
+        page = fetch(decode_cursor(page["next"]), None)
+
+
+def _insert_orders(db, count, distinct_times=3):
+    # Few distinct created_at values, so most neighbours tie on the sort key
+    base = datetime(2024, 1, 1)
+    for i in range(count):
+        db.orders.insert_one({"created_at": base + timedelta(minutes=i % distinct_times), "n": i})
+
+
+def test_cursor_round_trip():
+    values = [datetime(2024, 5, 1, 12, 30), ObjectId()]
+    assert decode_cursor(encode_cursor(values)) == values
+    assert keyset_cursor(decode_cursor(encode_cursor(values))) == values
+
+
+def test_malformed_cursors_are_ignored():
+    assert decode_cursor("not base64!") is None
+    assert decode_cursor(encode_cursor([1])[:-2] + "$$") is None
+    assert keyset_cursor(["x"]) is None
+    assert keyset_cursor([{"$gt": 1}, ObjectId()]) is None
+    assert keyset_cursor([True, ObjectId()]) is None
+
+
+def test_keyset_page_walks_ties_without_gaps_or_repeats(db):
+    _insert_orders(db, 23)
+
+    def fetch(after, before):
+        return keyset_page(db.orders, {}, "created_at", after=after, before=before, limit=5)
+
+    pages, last = _walk(fetch)
+    seen = [oid for page in pages for oid in page]
+    expected = [row["_id"] for row in db.orders.find().sort([("created_at", -1), ("_id", -1)])]
+    assert seen == expected
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+
+    # Walking back with ?before= returns the previous pages unchanged
+    page = last
+    for expected_page in reversed(pages[:-1]):
+        page = fetch(None, decode_cursor(page["prev"]))
+        assert [row["_id"] for row in page["items"]] == expected_page
+    assert page["prev"] is None
+
+
+def test_keyset_page_reaches_documents_without_the_sort_key(db):
+    _insert_orders(db, 4)
+    missing = [db.orders.insert_one({"n": i}).inserted_id for i in range(3)]
+    db.orders.insert_one({"created_at": None, "n": 99})
+
+    def fetch(after, before):
+        return keyset_page(db.orders, {}, "created_at", after=after, before=before, limit=2)
+
+    pages, _ = _walk(fetch)
+    seen = [oid for page in pages for oid in page]
+    assert len(seen) == len(set(seen)) == 8
+    assert set(missing) <= set(seen)
+
+
+def test_keyset_slice_ties_and_both_directions():
+    rows = [{"name": name, "_id": str(i)} for i, name in enumerate("aabbbbccd")]
+    rows.sort(key=lambda row: [row["name"], row["_id"]])
+
+    def key(row):
+        return [row["name"], row["_id"]]
+
+    def fetch(after, before):
+        return keyset_slice(rows, key, limit=2, after=after, before=before)
+
+    pages, last = _walk(fetch)
+    assert [row_id for page in pages for row_id in page] == [row["_id"] for row in rows]
+    previous = fetch(None, decode_cursor(last["prev"]))
+    assert [row["_id"] for row in previous["items"]] == pages[-2]
+    assert last["total"] == len(rows)
+
+
+def test_keyset_slice_ignores_a_token_for_another_key():
+    rows = [{"name": "a", "_id": "1"}, {"name": "b", "_id": "2"}]
+    page = keyset_slice(rows, lambda row: [row["name"], row["_id"]], after=[3, "x", "y"])
+    assert page["items"] == rows
+    assert page["limit"] == PAGE_SIZE_DEFAULT
@@ -0,0 +1,97 @@
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+from app import StockShortage, place_order, release_order_lines
+
+
+@pytest.fixture
+def standalone(db, monkeypatch):
+    """`db` behaving like a standalone server: no transactions."""
+    def start_session(*args, **kwargs):
+        raise OperationFailure("Transaction numbers are only allowed on a replica set member or mongos", code=20)
+    monkeypatch.setattr(db.client, "start_session", start_session)
+    return db
+
+
+def _medicine(db, name, stock, is_active=True):
+    return db.medicines.insert_one({"name": name, "stock": stock, "is_active": is_active}).inserted_id
+
+
+def _order(db, lines, pharmacy_id):
+    user_id = db.users.insert_one({"name": "Customer"}).inserted_id
+    return {
+        "_id": ObjectId(),
+        "user_id": user_id,
+        "items": [{"medicine_id": mid, "qty": qty} for mid, qty in lines],
+        "total": 12.5,
+        "status": "Processing",
+        "pharmacy_ids": [pharmacy_id],
+        "created_at": datetime(2024, 3, 1),
+    }
+
+
+def _stock(db, mid):
+    return db.medicines.find_one({"_id": mid})["stock"]
+
+
+def test_place_order_reserves_stock_and_counts_the_order(standalone):
+    db = standalone
+    pharmacy_id = db.pharmacies.insert_one({"name": "P"}).inserted_id
+    a, b = _medicine(db, "A", 5), _medicine(db, "B", 2)
+    order = _order(db, [(a, 3), (b, 2), (a, 1)], pharmacy_id)
+
+    assert place_order(db, order) == order["_id"]
+    assert (_stock(db, a), _stock(db, b)) == (1, 0)
+    assert db.orders.count_documents({"_id": order["_id"]}) == 1
+    pharmacy = db.pharmacies.find_one({"_id": pharmacy_id})
+    assert (pharmacy["order_count"], pharmacy["revenue_total"]) == (1, 12.5)
+
+
+def test_shortage_lists_each_short_line_and_rolls_back(standalone):
+    db = standalone
+    pharmacy_id = db.pharmacies.insert_one({"name": "P"}).inserted_id
+    a = _medicine(db, "A", 10)
+    b = _medicine(db, "B", 1)
+    c = _medicine(db, "C", 50, is_active=False)
+    order = _order(db, [(a, 4), (b, 3), (c, 1)], pharmacy_id)
+
+    with pytest.raises(StockShortage) as exc:
+        place_order(db, order)
+
+    shortages = {s["medicine_id"]: s for s in exc.value.shortages}
+    assert set(shortages) == {b, c}
+    assert (shortages[b]["requested"], shortages[b]["available"], shortages[b]["name"]) == (3, 1, "B")
+    assert shortages[c]["available"] == 0  # inactive medicines cannot be ordered
+    # The line reserved before the short one got its stock back
+    assert (_stock(db, a), _stock(db, b), _stock(db, c)) == (10, 1, 50)
+    assert db.orders.count_documents({}) == 0
+    assert "order_count" not in db.pharmacies.find_one({"_id": pharmacy_id})
+
+
+def test_failed_insert_releases_the_reservation(standalone, monkeypatch):
+    db = standalone
+    pharmacy_id = db.pharmacies.insert_one({"name": "P"}).inserted_id
+    a = _medicine(db, "A", 3)
+
+    def insert_one(*args, **kwargs):
+        raise OperationFailure("insert failed")
+    monkeypatch.setattr(db.orders, "insert_one", insert_one)
+
+    with pytest.raises(OperationFailure):
+        place_order(db, _order(db, [(a, 2)], pharmacy_id))
+    assert _stock(db, a) == 3
+
+
+def test_release_order_lines_restores_stock_once(standalone):
+    db = standalone
+    pharmacy_id = db.pharmacies.insert_one({"name": "P"}).inserted_id
+    a, b = _medicine(db, "A", 5), _medicine(db, "B", 5)
+    order = _order(db, [(a, 2), (b, 1)], pharmacy_id)
+    place_order(db, order)
+
+    release_order_lines(db, order)
+    release_order_lines(db, order)  # a retried job
+    assert (_stock(db, a), _stock(db, b)) == (5, 5)
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import first_run_at, next_occurrence, run_due_schedules
+
+
+@pytest.mark.parametrize("start, frequency, after, expected", [
+    # Daily: the next run is on the following day, at the start's time of day
+    (datetime(2024, 3, 1, 23, 30), "daily", datetime(2024, 3, 1, 23, 45), datetime(2024, 3, 2, 23, 30)),
+    (datetime(2024, 3, 1, 8, 0), "daily", datetime(2024, 3, 2, 7, 59), datetime(2024, 3, 2, 8, 0)),
+    # A run exactly at `after` is not later than it
+    (datetime(2024, 3, 1, 8, 0), "daily", datetime(2024, 3, 2, 8, 0), datetime(2024, 3, 3, 8, 0)),
+    (datetime(2024, 2, 28, 9, 0), "daily", datetime(2024, 2, 28, 10, 0), datetime(2024, 2, 29, 9, 0)),
+    (datetime(2023, 12, 31, 9, 0), "daily", datetime(2023, 12, 31, 10, 0), datetime(2024, 1, 1, 9, 0)),
+    # Weekly across a month end
+    (datetime(2024, 1, 29, 9, 0), "weekly", datetime(2024, 1, 30), datetime(2024, 2, 5, 9, 0)),
+    # Monthly keeps the start's day, clamped to shorter months
+    (datetime(2024, 1, 31, 9, 0), "monthly", datetime(2024, 2, 1), datetime(2024, 2, 29, 9, 0)),
+    (datetime(2024, 1, 31, 9, 0), "monthly", datetime(2024, 2, 29, 9, 0), datetime(2024, 3, 31, 9, 0)),
+    (datetime(2023, 1, 31, 9, 0), "monthly", datetime(2023, 2, 1), datetime(2023, 2, 28, 9, 0)),
+    (datetime(2024, 11, 30, 9, 0), "monthly", datetime(2024, 12, 31), datetime(2025, 1, 30, 9, 0)),
+    (datetime(2024, 1, 15, 9, 0), "monthly", datetime(2024, 1, 15, 8, 0), datetime(2024, 1, 15, 9, 0)),
+])
+def test_next_occurrence(start, frequency, after, expected):
+    assert next_occurrence(start, frequency, after) == expected
+
+
+def test_next_occurrence_skips_missed_runs():
+    start = datetime(2020, 1, 1, 6, 0)
+    assert next_occurrence(start, "daily", datetime(2024, 7, 4, 12, 0)) == datetime(2024, 7, 5, 6, 0)
+    assert next_occurrence(start, "weekly", datetime(2020, 1, 8, 6, 0)) == datetime(2020, 1, 15, 6, 0)
+    assert next_occurrence(start, "monthly", datetime(2024, 7, 4)) == datetime(2024, 8, 1, 6, 0)
+
+
+def test_next_occurrence_before_the_start_is_the_start():
+    start = datetime(2024, 5, 1, 9, 0)
+    assert next_occurrence(start, "daily", datetime(2024, 4, 1)) == start
+
+
+def test_first_run_at():
+    now = datetime(2024, 3, 10, 15, 0)
+    # Today's date still fires today, even if its time has passed
+    assert first_run_at(datetime(2024, 3, 10), "daily", now) == datetime(2024, 3, 10)
+    assert first_run_at(datetime(2024, 3, 12), "weekly", now) == datetime(2024, 3, 12)
+    assert first_run_at(datetime(2024, 3, 1), "weekly", now) == datetime(2024, 3, 15)
+    assert first_run_at(datetime(2024, 1, 31), "monthly", now) == datetime(2024, 3, 31)
+
+
+def test_run_due_schedules_fires_once_and_advances(db):
+    now = datetime.utcnow().replace(microsecond=0)  # BSON keeps milliseconds
+    start = now - timedelta(days=2, hours=1)
+    sid = db.schedules.insert_one({
+        "user_id": "u", "medicines": ["Napa"], "notes": "", "action": "remind", "frequency": "daily",
+        "start_date": start, "next_run_at": now - timedelta(hours=1), "created_at": start,
+    }).inserted_id
+    db.schedules.insert_one({"user_id": "u", "frequency": "daily", "next_run_at": now + timedelta(hours=1)})
+
+    assert run_due_schedules(db, "w1") == 1
+    assert run_due_schedules(db, "w1") == 0
+
+    sched = db.schedules.find_one({"_id": sid})
+    assert sched["next_run_at"] == start + timedelta(days=3)
+    assert "claimed_by" not in sched
+    reminders = list(db.reminders.find({"schedule_id": sid}))
+    assert len(reminders) == 1
+    assert reminders[0]["due_at"] == sched["last_run_at"]